@@ -1,43 +1,685 @@
 import os
 import json
-import yaml
+import posixpath
+import hashlib
+import sqlite3
 from pathlib import Path
 from datetime import datetime
-from dotenv import load_dotenv
-import anthropic
 import argparse
-
-# Ladda API-nyckel från .env
-load_dotenv(Path(__file__).parent / ".env")
+import math
+import random
+import re
+import time
+from fnmatch import fnmatch
+import signal
+import atexit
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import zipfile
+import zlib
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Ladda konfiguration
 def load_config():
+    import yaml
+
     config_path = Path(__file__).parent / "config.yaml"
     with open(config_path, "r", encoding="utf-8") as f:
         return yaml.safe_load(f)
 
-# Ladda logg över redan processade filer
-def load_log(log_path):
-    if Path(log_path).exists():
-        with open(log_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# Logg över processade filer och analyscache i SQLite (WAL-läge)
+# files: filväg → innehållshash, analyses: innehållshash → analys.
+# Varje dokument skrivs i en egen transaktion, så en avbruten körning
+# lämnar aldrig en halvskriven logg, och "är filen redan gjord?" är en
+# enda indexuppslagning i stället för att läsa in hela historiken.
+class LogStore:
+    # Öka när rapportfragmentens layout ändras, så att de renderas om
+    FRAGMENT_VERSION = 2
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS analyses (
+            hash TEXT PRIMARY KEY,
+            analysis TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            processed TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+        CREATE TABLE IF NOT EXISTS scan_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS scan_dirs (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            subdirs TEXT NOT NULL,
+            files TEXT NOT NULL,
+            fingerprint TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS report_fragments (
+            path TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            type TEXT NOT NULL,
+            fragment TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS reports (
+            path TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS exported (
+            hash TEXT PRIMARY KEY,
+            exported TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS exports (
+            path TEXT PRIMARY KEY,
+            complete INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS signatures (
+            hash TEXT PRIMARY KEY,
+            signature TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS failures (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            failed TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = str(db_path)
+        # Flera arbetare på samma dator kan dela loggen (arbetskö)
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < self.FRAGMENT_VERSION:
+            with self.conn:
+                self.conn.execute("DELETE FROM report_fragments")
+                self.conn.execute("DELETE FROM reports")
+            self.conn.execute(f"PRAGMA user_version = {self.FRAGMENT_VERSION}")
+
+    def __contains__(self, filepath):
+        return self.conn.execute("SELECT 1 FROM files WHERE path = ?", (filepath,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # Cachad analys för en innehållshash, eller None
+    def analysis(self, file_hash):
+        row = self.conn.execute("SELECT analysis FROM analyses WHERE hash = ?", (file_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Första filen i loggen med ett visst innehåll
+    def path_for(self, file_hash):
+        row = self.conn.execute("SELECT path FROM files WHERE hash = ? ORDER BY rowid", (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def has_analysis(self, file_hash):
+        return self.conn.execute("SELECT 1 FROM analyses WHERE hash = ?", (file_hash,)).fetchone() is not None
+
+    # Spara analysen (om den är ny) och filens hash i en transaktion
+    def record(self, filepath, file_hash, analysis, processed=None):
+        cached = {k: v for k, v in analysis.items() if k != "filepath"}
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO analyses (hash, analysis) VALUES (?, ?)",
+                (file_hash, json.dumps(cached, ensure_ascii=False)),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, hash, processed) VALUES (?, ?, ?)",
+                (filepath, file_hash, processed or datetime.now().isoformat()),
+            )
+
+    # Alla analyser i loggen, med filväg
+    def results(self):
+        rows = self.conn.execute(
+            "SELECT files.path, analyses.analysis FROM files JOIN analyses USING (hash) ORDER BY files.rowid"
+        )
+        return [{**json.loads(analysis), "filepath": filepath} for filepath, analysis in rows]
+
+    # Ett (hash, analys) per innehållshash, med första filvägen, utan att
+    # läsa in alla analyser. Med `unexported` bara de som inte exporterats.
+    def iter_unique(self, unexported=False):
+        rows = self.conn.execute(
+            f"""SELECT files.path, files.hash, analyses.analysis FROM files JOIN analyses USING (hash)
+                WHERE files.rowid IN (SELECT MIN(rowid) FROM files GROUP BY hash)
+                {"AND files.hash NOT IN (SELECT hash FROM exported)" if unexported else ""}
+                ORDER BY files.rowid"""
+        )
+        for filepath, file_hash, analysis in rows:
+            yield file_hash, {**json.loads(analysis), "filepath": filepath}
+
+    # MinHash-signaturer för innehåll som har en analys och en fil i
+    # loggen: (hash, signatur). Ändrade och borttagna filers gamla innehåll
+    # ska inte bli källa för nära kopior.
+    def signatures(self):
+        rows = self.conn.execute(
+            """SELECT hash, signature FROM signatures JOIN analyses USING (hash)
+               WHERE hash IN (SELECT hash FROM files)"""
+        )
+        for file_hash, signature in rows:
+            yield file_hash, [int(value, 16) for value in signature.split()]
+
+    def save_signature(self, file_hash, signature):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO signatures (hash, signature) VALUES (?, ?)",
+                (file_hash, " ".join(f"{value:x}" for value in signature)),
+            )
+
+    # Grupper av nära kopior i loggen: (antal källdokument, antal kopior)
+    def near_duplicate_clusters(self):
+        return self.conn.execute(
+            """SELECT COUNT(DISTINCT json_extract(analysis, '$.near_duplicate_of')), COUNT(*)
+               FROM files JOIN analyses USING (hash)
+               WHERE json_extract(analysis, '$.near_duplicate_of') IS NOT NULL"""
+        ).fetchone()
+
+    # Innehåll vars extraktion (timeout, oom, crashed) eller batchanalys
+    # (batch_errored, batch_expired) misslyckats; hoppas över tills det
+    # ändras eller körs om med --retry-failed
+    def failure(self, file_hash):
+        row = self.conn.execute("SELECT reason FROM failures WHERE hash = ?", (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def record_failure(self, filepath, file_hash, reason):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO failures (hash, path, reason, failed) VALUES (?, ?, ?, ?)",
+                (file_hash, str(filepath), reason, datetime.now().isoformat()),
+            )
+
+    def clear_failures(self):
+        with self.conn:
+            return self.conn.execute("DELETE FROM failures").rowcount
+
+    def exported_hashes(self):
+        return {row[0] for row in self.conn.execute("SELECT hash FROM exported")}
+
+    # RIS-filen kan bara byggas på om förra exporten till den blev klar
+    # och allt som exporterats fortfarande finns i loggen. Annars har en
+    # körning avbrutits mitt i, eller filer analyserats om eller tagits bort.
+    def export_current(self, path):
+        row = self.conn.execute("SELECT complete FROM exports WHERE path = ?", (str(path),)).fetchone()
+        if not row or not row[0]:
+            return False
+        return self.conn.execute(
+            "SELECT 1 FROM exported WHERE hash NOT IN (SELECT hash FROM files) LIMIT 1"
+        ).fetchone() is None
+
+    # Markeras innan RIS-filen ändras; avbryts körningen skrivs filen om nästa gång
+    def begin_export(self, path):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO exports (path, complete) VALUES (?, 0)", (str(path),))
+
+    # Nya poster och en klar export sparas i samma transaktion. Efter en
+    # omskrivning glöms poster vars innehåll inte längre finns i loggen.
+    def finish_export(self, path, hashes, rewritten=False):
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO exported (hash, exported) VALUES (?, ?)", ((h, now) for h in hashes)
+            )
+            if rewritten:
+                self.conn.execute("DELETE FROM exported WHERE hash NOT IN (SELECT hash FROM files)")
+            self.conn.execute("INSERT OR REPLACE INTO exports (path, complete) VALUES (?, 1)", (str(path),))
+
+    def paths(self):
+        return [row[0] for row in self.conn.execute("SELECT path FROM files")]
+
+    # Glöm filer i loggen, t.ex. borttagna eller ändrade filer, och
+    # signaturerna för innehåll som ingen fil längre har
+    def forget(self, paths):
+        paths = list(paths)
+        with self.conn:
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                hashes = [row[0] for row in self.conn.execute(
+                    f"SELECT DISTINCT hash FROM files WHERE path IN ({marks})", chunk
+                )]
+                self.conn.execute(f"DELETE FROM files WHERE path IN ({marks})", chunk)
+                self.conn.executemany(
+                    "DELETE FROM signatures WHERE hash = ? AND hash NOT IN (SELECT hash FROM files)",
+                    ((h,) for h in hashes),
+                )
+
+    # Nära kopior av borttagna filer blir egna dokument igen: länken tas
+    # bort, så att de kommer med i RIS-exporten och får hela rapportposter
+    def detach_near_duplicates(self, paths):
+        paths = list(paths)
+        with self.conn:
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                hashes = [row[0] for row in self.conn.execute(
+                    f"""SELECT hash FROM analyses
+                        WHERE json_extract(analysis, '$.near_duplicate_of') IN ({",".join("?" * len(chunk))})""",
+                    chunk,
+                )]
+                self.conn.executemany(
+                    """UPDATE analyses SET analysis = json_remove(analysis, '$.near_duplicate_of', '$.similarity')
+                       WHERE hash = ?""",
+                    ((h,) for h in hashes),
+                )
+                self.conn.executemany("DELETE FROM report_fragments WHERE hash = ?", ((h,) for h in hashes))
+
+    # Katalogindexet: filväg → (storlek, mtime, inode)
+    def scan_index(self):
+        rows = self.conn.execute("SELECT path, size, mtime_ns, inode FROM scan_files")
+        return {path: (size, mtime_ns, inode) for path, size, mtime_ns, inode in rows}
+
+    # Mappindexet: mapp → (mtime, undermappar, filer, fingerprint)
+    def dir_index(self):
+        rows = self.conn.execute("SELECT path, mtime_ns, subdirs, files, fingerprint FROM scan_dirs")
+        return {
+            path: (mtime_ns, json.loads(subdirs), json.loads(files), fingerprint)
+            for path, mtime_ns, subdirs, files, fingerprint in rows
+        }
+
+    # Spara resultatet av en skanning i en transaktion
+    def save_scan(self, file_rows, dir_rows, removed_files, removed_dirs):
+        with self.conn:
+            self.conn.executemany("DELETE FROM scan_files WHERE path = ?", ((p,) for p in removed_files))
+            self.conn.executemany("DELETE FROM scan_dirs WHERE path = ?", ((p,) for p in removed_dirs))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scan_files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)", file_rows
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scan_dirs (path, mtime_ns, subdirs, files, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                dir_rows,
+            )
+
+    # Fingeravtryck för mängden analyser i loggen (filväg, hash och
+    # ordning); ändras bara när en rapport skulle få nytt innehåll
+    def fingerprint(self):
+        digest = hashlib.blake2b(digest_size=20)
+        for path, file_hash in self.conn.execute(
+            "SELECT path, hash FROM files JOIN analyses USING (hash) ORDER BY files.rowid"
+        ):
+            digest.update(f"{path}\0{file_hash}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def report_fingerprint(self, output_path):
+        row = self.conn.execute("SELECT fingerprint FROM reports WHERE path = ?", (str(output_path),)).fetchone()
+        return row[0] if row else None
+
+    def save_report_fingerprint(self, output_path, fingerprint):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reports (path, fingerprint) VALUES (?, ?)", (str(output_path), fingerprint)
+            )
+
+    # Renderade rapportfragment, grupperade per typ. Fragment som saknas
+    # eller hör till en äldre hash renderas med `render` och sparas.
+    # Nära kopior kommer direkt efter dokumentet de liknar.
+    # Ger (typ, fragment) utan att hela rapporten hålls i minnet.
+    def report_fragments(self, render):
+        stale = [row[0] for row in self.conn.execute(
+            """SELECT files.path FROM files
+               LEFT JOIN report_fragments AS rf ON rf.path = files.path AND rf.hash = files.hash
+               WHERE rf.path IS NULL"""
+        )]
+        # I omgångar, så att ett helt nytt arkiv inte renderas i minnet på en gång
+        for start in range(0, len(stale), 500):
+            chunk = stale[start:start + 500]
+            rows = []
+            for path, file_hash, analysis in self.conn.execute(
+                f"""SELECT files.path, files.hash, analyses.analysis FROM files JOIN analyses USING (hash)
+                    WHERE files.path IN ({",".join("?" * len(chunk))})""",
+                chunk,
+            ).fetchall():
+                item = {**json.loads(analysis), "filepath": path}
+                rows.append((path, file_hash, item.get("type") or "övrigt", render(item)))
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO report_fragments (path, hash, type, fragment) VALUES (?, ?, ?, ?)", rows
+                )
+        yield from self.conn.execute(
+            """SELECT rf.type, rf.fragment FROM files
+               JOIN analyses USING (hash)
+               JOIN report_fragments AS rf ON rf.path = files.path AND rf.hash = files.hash
+               LEFT JOIN files AS source ON source.path = json_extract(analyses.analysis, '$.near_duplicate_of')
+               ORDER BY rf.type, COALESCE(source.rowid, files.rowid), source.rowid IS NOT NULL, files.rowid"""
+        )
 
-# Spara logg
-def save_log(log_path, log_data):
-    Path(log_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(log_path, "w", encoding="utf-8") as f:
-        json.dump(log_data, f, ensure_ascii=False, indent=2)
+    def analysed_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files JOIN analyses USING (hash)").fetchone()[0]
+
+    # Ta bort cachade analyser som ingen fil i loggen längre pekar på
+    def prune(self):
+        with self.conn:
+            removed = self.conn.execute(
+                "DELETE FROM analyses WHERE hash NOT IN (SELECT hash FROM files)"
+            ).rowcount
+            self.conn.execute("DELETE FROM report_fragments WHERE path NOT IN (SELECT path FROM files)")
+            self.conn.execute("DELETE FROM signatures WHERE hash NOT IN (SELECT hash FROM files)")
+        self.conn.execute("VACUUM")
+        return removed
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM files")
+            self.conn.execute("DELETE FROM analyses")
+            self.conn.execute("DELETE FROM report_fragments")
+            self.conn.execute("DELETE FROM reports")
+            self.conn.execute("DELETE FROM exported")
+            self.conn.execute("DELETE FROM exports")
+            self.conn.execute("DELETE FROM signatures")
+            self.conn.execute("DELETE FROM failures")
+
+    def close(self):
+        self.conn.close()
+
+    # Engångsimport av den gamla JSON-loggen och analyscachen. Poster i
+    # det äldsta formatet, med hela analysen i loggen, hashas om filen
+    # finns kvar och får annars en nyckel byggd på sökvägen.
+    def import_json(self, log_path, cache_path, stats=None):
+        with open(log_path, "r", encoding="utf-8") as f:
+            log = json.load(f)
+        cache = {}
+        if Path(cache_path).exists():
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO analyses (hash, analysis) VALUES (?, ?)",
+                ((h, json.dumps(a, ensure_ascii=False)) for h, a in cache.items()),
+            )
+            for filepath, entry in log.items():
+                file_hash = entry.get("hash")
+                analysis = entry.get("analysis") or cache.get(file_hash)
+                if not analysis:
+                    continue
+                if not file_hash:
+                    if Path(filepath).exists():
+                        file_hash = hash_file(filepath, stats)
+                    else:
+                        file_hash = "legacy-" + hashlib.blake2b(filepath.encode("utf-8"), digest_size=20).hexdigest()
+                cached = {k: v for k, v in analysis.items() if k != "filepath"}
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO analyses (hash, analysis) VALUES (?, ?)",
+                    (file_hash, json.dumps(cached, ensure_ascii=False)),
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files (path, hash, processed) VALUES (?, ?, ?)",
+                    (filepath, file_hash, entry.get("processed") or datetime.now().isoformat()),
+                )
+
+        for path in (log_path, cache_path):
+            if Path(path).exists():
+                os.replace(path, f"{path}.migrated")
+        return len(log)
+
+# Öppna loggen. En äldre processed_files.json (och analysis_cache.json)
+# bredvid databasen importeras en gång och döps sedan om till *.migrated
+def load_log(db_path, stats=None):
+    store = LogStore(db_path)
+    json_path = Path(db_path).with_suffix(".json")
+    if json_path.exists():
+        migrated = store.import_json(json_path, json_path.parent / "analysis_cache.json", stats)
+        print(f"Loggen flyttad till {Path(db_path).name}: {migrated} poster importerade.")
+    return store
+
+# Sekunder mellan försöken med filer som andra arbetare har tagit
+QUEUE_POLL = 2
+
+# Delad arbetskö när flera processer eller datorer analyserar samma arkiv.
+# Varje innehållshash tas med en lease som en bakgrundstråd förnyar var
+# `lease / 4` sekund; en arbetare som kraschar slutar förnya, och när
+# leasen gått ut tas filen över av någon annan. Färdiga analyser sparas i
+# kön, så att varje arbetare för in de andras resultat i sin logg utan nya
+# anrop. Kön har vanlig journal i stället för WAL, eftersom WAL kräver
+# delat minne och inte fungerar mellan datorer på en nätverksdisk. Journalen
+# behålls mellan transaktionerna (PERSIST); att skapa och ta bort den för
+# varje fil kostar annars tiotals millisekunder per transaktion.
+class WorkQueue:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS work (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            worker TEXT,
+            expires REAL,
+            analysis TEXT,
+            claims INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS work_worker ON work(worker);
+    """
+
+    def __init__(self, db_path, lease=120):
+        import socket
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = str(db_path)
+        self.lease = lease
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.conn = self._connect()
+        self.conn.execute("PRAGMA journal_mode=PERSIST")
+        self.conn.executescript(self.SCHEMA)
+        self.stats = {"claimed": 0, "taken_over": 0, "from_queue": 0, "deferred": 0, "heartbeat_errors": 0}
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    # Lång väntetid på låset: de andra arbetarna håller det bara en kort
+    # stund per fil, men på en nätverksdisk kan det ta tid
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    # Ta innehållet. Ger ("claimed", None), ("done", analys) om någon
+    # redan har analyserat det, eller ("leased", None) om en annan
+    # arbetare har en giltig lease på det
+    def claim(self, file_hash, filepath):
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT worker, expires, analysis, claims FROM work WHERE hash = ?", (file_hash,)
+            ).fetchone()
+            if row is not None and row[2] is not None:
+                self.stats["from_queue"] += 1
+                return "done", json.loads(row[2])
+            if row is not None and row[0] not in (None, self.worker):
+                if row[1] > now:
+                    self.stats["deferred"] += 1
+                    return "leased", None
+                self.stats["taken_over"] += 1
+            self.conn.execute(
+                "INSERT OR REPLACE INTO work (hash, path, worker, expires, analysis, claims) VALUES (?, ?, ?, ?, NULL, ?)",
+                (file_hash, str(filepath), self.worker, now + self.lease, (row[3] if row else 0) + 1),
+            )
+            self.stats["claimed"] += 1
+            return "claimed", None
+
+    # Spara analysen för de andra arbetarna; leasen är därmed slut
+    def complete(self, file_hash, filepath, analysis):
+        cached = {k: v for k, v in analysis.items() if k != "filepath"}
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO work (hash, path) VALUES (?, ?)", (file_hash, str(filepath))
+            )
+            self.conn.execute(
+                "UPDATE work SET path = ?, worker = ?, expires = NULL, analysis = ? WHERE hash = ?",
+                (str(filepath), self.worker, json.dumps(cached, ensure_ascii=False), file_hash),
+            )
+
+    # Lämna tillbaka innehåll som inte kunde analyseras, så att någon annan
+    # kan försöka utan att vänta ut leasen
+    def release(self, file_hash):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE work SET worker = NULL, expires = NULL WHERE hash = ? AND worker = ? AND analysis IS NULL",
+                (file_hash, self.worker),
+            )
+
+    def _heartbeat(self):
+        conn = self._connect()
+        try:
+            while not self.stopped.wait(self.lease / 4):
+                try:
+                    with conn:
+                        conn.execute(
+                            "UPDATE work SET expires = ? WHERE worker = ? AND analysis IS NULL",
+                            (time.time() + self.lease, self.worker),
+                        )
+                except sqlite3.OperationalError:
+                    # Låst längre än timeouten; leasen räcker till nästa försök
+                    self.stats["heartbeat_errors"] += 1
+        finally:
+            conn.close()
+
+    # Sluta förnya och lämna tillbaka allt som inte hann analyseras
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        with self.conn:
+            self.conn.execute(
+                "UPDATE work SET worker = NULL, expires = NULL WHERE worker = ? AND analysis IS NULL", (self.worker,)
+            )
+        self.conn.close()
+
+# Öka när textextraktionen ändras, så att gamla texter i cachen inte används
+EXTRACTOR_VERSION = 3
+
+# Cache för extraherad text, zlib-komprimerad i en egen SQLite-fil och
+# nycklad på innehållshash och extraktorversion (inklusive teckenbudget),
+# så att --refresh och ändrade promptar inte läser om alla filer. När
+# cachen växer över `max_bytes` tas de minst nyligen använda texterna bort.
+class TextCache:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS texts (
+            hash TEXT NOT NULL,
+            version TEXT NOT NULL,
+            data BLOB NOT NULL,
+            signature TEXT,
+            size INTEGER NOT NULL,
+            raw_size INTEGER NOT NULL,
+            used REAL NOT NULL,
+            PRIMARY KEY (hash, version)
+        );
+        CREATE INDEX IF NOT EXISTS texts_used ON texts(used);
+    """
+
+    def __init__(self, db_path, version, max_bytes):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.version = str(version)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(str(db_path), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.size, self.raw_size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0) FROM texts"
+        ).fetchone()
+        self.stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "evicted": 0}
+
+    # (text, signatur) för ett innehåll, eller None. `filepath` används bara
+    # för att räkna hur många byte källfil som inte behövde läsas.
+    def get(self, file_hash, filepath=None):
+        row = self.conn.execute(
+            "SELECT data, signature FROM texts WHERE hash = ? AND version = ?", (file_hash, self.version)
+        ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        with self.conn:
+            self.conn.execute(
+                "UPDATE texts SET used = ? WHERE hash = ? AND version = ?", (time.time(), file_hash, self.version)
+            )
+        self.stats["hits"] += 1
+        if filepath:
+            try:
+                self.stats["bytes_saved"] += os.path.getsize(filepath)
+            except OSError:
+                pass
+        signature = [int(value, 16) for value in row[1].split()] if row[1] else None
+        return zlib.decompress(row[0]).decode("utf-8"), signature
+
+    def put(self, file_hash, text, signature=None):
+        raw = text.encode("utf-8")
+        data = zlib.compress(raw, 6)
+        if len(data) > self.max_bytes:
+            return
+        signature = " ".join(f"{value:x}" for value in signature) if signature else None
+        with self.conn:
+            old = self.conn.execute(
+                "SELECT size, raw_size FROM texts WHERE hash = ? AND version = ?", (file_hash, self.version)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO texts (hash, version, data, signature, size, raw_size, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_hash, self.version, data, signature, len(data), len(raw), time.time()),
+            )
+        if old:
+            self.size -= old[0]
+            self.raw_size -= old[1]
+        self.size += len(data)
+        self.raw_size += len(raw)
+        if self.size > self.max_bytes:
+            self._evict()
+
+    # Ta bort de minst nyligen använda texterna tills cachen är under 90 %
+    # av taket, så att inte varje ny text ger en ny rensning
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        removed = []
+        for file_hash, version, size, raw_size in self.conn.execute(
+            "SELECT hash, version, size, raw_size FROM texts ORDER BY used"
+        ).fetchall():
+            if self.size <= target:
+                break
+            removed.append((file_hash, version))
+            self.size -= size
+            self.raw_size -= raw_size
+        with self.conn:
+            self.conn.executemany("DELETE FROM texts WHERE hash = ? AND version = ?", removed)
+        self.stats["evicted"] += len(removed)
+
+    def close(self):
+        self.conn.close()
+
+# Skriv JSON till en temporär fil och byt namn, så att en krasch aldrig lämnar en halv fil
+def write_json_atomic(path, data):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+# Beräkna innehållshash (BLAKE2b) för en fil, så att flyttade, omdöpta
+# och kopierade filer känns igen
+def hash_file(filepath, stats=None):
+    digest = hashlib.blake2b(digest_size=20)
+    size = 0
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    if stats is not None:
+        stats["bytes_hashed"] += size
+    return digest.hexdigest()
 
 # LireOffice-extraktion som fallback för ODT/ODP/SDW eller när odfpy misslyckas
 def _libreoffice_extract(filepath, config):
-    import subprocess
-    import tempfile
+    config = config or {}
     lo_path = config.get("libreoffice_path", "soffice")
     with tempfile.TemporaryDirectory() as tmpdir:
         result = subprocess.run(
             [lo_path, "--headless", "--convert-to", "txt:Text", "--outdir", tmpdir, filepath],
-            capture_output=True, text=True, timeout=30
+            capture_output=True, text=True, timeout=config.get("libreoffice_timeout", 60)
         )
         txt_file = Path(tmpdir) / (Path(filepath).stem + ".txt")
         if txt_file.exists():
@@ -45,63 +687,451 @@ def _libreoffice_extract(filepath, config):
                 return f.read()
     return None
 
-# Läs textinnehåll från fil
-def read_file(filepath, config=None):
+# Signalerar att en fil behöver LibreOffice; fångas av huvudprocessen som
+# skickar filen till LibreOfficePool i stället för att starta soffice per fil
+class NeedsLibreOffice(Exception):
+    pass
+
+# Pool av headless LibreOffice-instanser för textkonvertering. Varje
+# instans har en egen användarprofil och konverterar många filer per start
+# (soffice --convert-to med flera filer), så startkostnaden på flera
+# sekunder delas av hela satsen. Kraschar en sats, eller går det längre än
+# timeout per fil utan att nästa fil blir klar, dödas processen och filerna
+# som inte hann konverteras körs om, så att en trasig fil inte fäller
+# resten. Profilerna och eventuella kvarvarande processer städas bort vid
+# close() och vid programslut.
+class LibreOfficePool:
+    def __init__(self, lo_path="soffice", instances=2, batch_size=20, timeout=60, chars=None):
+        self.lo_path = lo_path
+        self.instances = instances
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # Högst så många tecken läses ur varje konverterad fil (extract_chars)
+        self.chars = chars
+        self.capacity = instances * batch_size
+        self.queue = queue.Queue()
+        self.threads = []
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.workdir = None
+        self.closed = False
+        self.stats = {"launches": 0, "converted": 0, "failed": 0, "restarts": 0}
+        # Konverteringstid per fil: satsens tid delad på antalet filer
+        self.timings = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Köa en fil för konvertering; returnerar en Future med texten (eller None)
+    def submit(self, filepath):
+        future = Future()
+        with self.lock:
+            if not self.threads:
+                self.workdir = tempfile.mkdtemp(prefix="analyzer-lo-")
+                atexit.register(self.close)
+                for index in range(self.instances):
+                    thread = threading.Thread(target=self._run, args=(index,), daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put((filepath, future))
+        return future
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            threads, self.threads = self.threads, []
+            for process in list(self.processes):
+                process.kill()
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(timeout=5)
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    def _run(self, index):
+        profile = Path(self.workdir) / f"profile{index}"
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Samla ihop det som köas inom kort, men aldrig två filer med
+            # samma namn i en sats – utfilerna hamnar i samma mapp
+            stems = {Path(item[0]).stem.lower()}
+            deadline = time.monotonic() + 0.2
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                if Path(item[0]).stem.lower() in stems:
+                    self.queue.put(item)
+                    break
+                stems.add(Path(item[0]).stem.lower())
+                batch.append(item)
+            batch = [(fp, future) for fp, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self._convert(batch, profile, index)
+
+    def _convert(self, batch, profile, index):
+        if self.closed:
+            for _, future in batch:
+                future.set_result(None)
+            return
+        outdir = Path(self.workdir) / f"out{index}"
+        shutil.rmtree(outdir, ignore_errors=True)
+        outdir.mkdir()
+        command = [
+            self.lo_path, f"-env:UserInstallation={profile.as_uri()}",
+            "--headless", "--norestore", "--convert-to", "txt:Text", "--outdir", str(outdir),
+            *[fp for fp, _ in batch],
+        ]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with self.lock:
+            self.processes.add(process)
+            self.stats["launches"] += 1
+        # Timeout per fil: processen dödas om ingen ny utfil dykt upp på
+        # `timeout` sekunder
+        try:
+            done_count, last_progress = 0, time.monotonic()
+            while True:
+                try:
+                    process.wait(timeout=0.5)
+                    failed = process.returncode != 0
+                    break
+                except subprocess.TimeoutExpired:
+                    count = len(os.listdir(outdir))
+                    if count > done_count:
+                        done_count, last_progress = count, time.monotonic()
+                    elif time.monotonic() - last_progress > self.timeout:
+                        process.kill()
+                        process.wait()
+                        failed = True
+                        break
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+
+        retry = []
+        share = (time.perf_counter() - started) / len(batch)
+        for filepath, future in batch:
+            txt_file = outdir / (Path(filepath).stem + ".txt")
+            if txt_file.exists():
+                self.timings[filepath] = share
+                with open(txt_file, "r", encoding="utf-8", errors="ignore") as f:
+                    future.set_result(f.read(self.chars))
+                self.stats["converted"] += 1
+            elif failed and len(batch) > 1:
+                retry.append((filepath, future))
+            else:
+                future.set_result(None)
+                self.stats["failed"] += 1
+
+        # Krasch eller timeout: LibreOffice konverterar i tur och ordning, så
+        # den första filen utan resultat är den troliga boven. Den körs om
+        # ensam och resten som en ny sats.
+        if retry:
+            self.stats["restarts"] += 1
+            self._convert(retry[:1], profile, index)
+            if retry[1:]:
+                self._convert(retry[1:], profile, index)
+
+# Textbitar (stycken, bilder, ramar) ur en fil i dokumentordning.
+# Generatorerna läser bara så långt som konsumenten ber om, så en bok på
+# 500 sidor behöver inte extraheras helt för att fylla prompten.
+def iter_text(filepath, config=None, use_libreoffice=True):
+    suffix = Path(filepath).suffix.lower()
+    if suffix == ".txt":
+        with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+            for block in iter(lambda: f.read(1 << 16), ""):
+                yield block
+
+    elif suffix == ".docx":
+        from docx import Document
+        doc = Document(filepath)
+        for p in doc.paragraphs:
+            yield p.text
+
+    elif suffix in (".ppt", ".pptx"):
+        from pptx import Presentation
+        prs = Presentation(filepath)
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if shape.has_text_frame and shape.text_frame.text.strip():  # type: ignore[union-attr]
+                    yield shape.text_frame.text  # type: ignore[union-attr]
+
+    elif suffix in (".odt", ".odp"):
+        try:
+            from odf import draw, teletype  # type: ignore[import-untyped]
+            from odf.opendocument import load as odf_load  # type: ignore[import-untyped]
+            doc = odf_load(filepath)
+            if suffix == ".odt":
+                nodes = doc.text.childNodes  # type: ignore[union-attr]
+            else:
+                nodes = doc.presentation.getElementsByType(draw.Frame)  # type: ignore[union-attr]
+        except Exception:
+            if not use_libreoffice:
+                raise NeedsLibreOffice(filepath)
+            yield _libreoffice_extract(filepath, config) or ""
+            return
+        for node in nodes:
+            yield teletype.extractText(node)
+
+    elif suffix == ".sdw":
+        if not use_libreoffice:
+            raise NeedsLibreOffice(filepath)
+        yield _libreoffice_extract(filepath, config) or ""
+
+    elif suffix == ".pdf":
+        from pypdf import PdfReader
+        reader = PdfReader(filepath)
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+# Slå ihop textbitar tills budgeten (antal tecken) är fylld
+def _take(chunks, budget=None, sep="\n"):
+    texts = []
+    total = 0
+    for chunk in chunks:
+        texts.append(chunk)
+        total += len(chunk) + len(sep)
+        if budget and total >= budget:
+            break
+    text = sep.join(texts)
+    return text[:budget] if budget else text
+
+# PDF med budget: de sista `tail_pages` sidorna (kolofon, ISBN-sida) läses
+# först och delar på högst en fjärdedel av budgeten; resten fylls från
+# början. Sidorna däremellan tolkas aldrig. Sidorna skiljs åt med
+# sidbrytning (\f) så att utdraget kan välja bland dem.
+def _read_pdf(filepath, budget=None, tail_pages=0):
+    from pypdf import PdfReader
+    reader = PdfReader(filepath)
+    pages = reader.pages
+    tail_pages = min(tail_pages, max(0, len(pages) - 1)) if budget else 0
+    if not tail_pages:
+        return _take((page.extract_text() or "" for page in pages), budget, "\f")
+
+    gap = "\f[...]\f"
+    share = budget // 4 // tail_pages
+    tail = "\f".join(
+        (pages[i].extract_text() or "")[:share] for i in range(len(pages) - tail_pages, len(pages))
+    )
+    head_budget = budget - len(tail) - len(gap)
+    head = _take((pages[i].extract_text() or "" for i in range(len(pages) - tail_pages)), head_budget, "\f")
+    # Fick hela början plats finns inget utelämnat mellan delarna
+    return head + ("\f" if len(head) < head_budget else gap) + tail
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DRAWING_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+PRESENTATION_NS = "http://schemas.openxmlformats.org/presentationml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+MC_NS = "http://schemas.openxmlformats.org/markup-compatibility/2006"
+OOXML_HEADER_PART = re.compile(r"word/(header|footer)\d*\.xml")
+
+# Stycken ur en OOXML-del (WordprocessingML med `ns` = W_NS, DrawingML med
+# DRAWING_NS), lästa med en inkrementell parser. Varje element tas bort ur
+# trädet när det är läst, så minnet beror inte på delens storlek. Stycken
+# i tabellceller kommer i dokumentordning, textrutor inne i ett stycke
+# blir egna stycken och kopian av textrutan i mc:Fallback hoppas över,
+# liksom fält med bildnummer.
+def _ooxml_paragraphs(stream, ns):
+    paragraph, text = f"{{{ns}}}p", f"{{{ns}}}t"
+    breaks = {f"{{{ns}}}br": "\n", f"{{{ns}}}cr": "\n", f"{{{ns}}}tab": "\t"}
+    tab_stops = {f"{{{ns}}}tabs", f"{{{ns}}}tabLst"}
+    fallback, field = f"{{{MC_NS}}}Fallback", f"{{{DRAWING_NS}}}fld"
+    path = []
+    texts = []
+    skipping = 0
+    for event, element in ElementTree.iterparse(stream, ("start", "end")):
+        tag = element.tag
+        skipped = tag == fallback or (tag == field and element.get("type") == "slidenum")
+        if event == "start":
+            path.append(element)
+            if skipped:
+                skipping += 1
+            elif tag == paragraph and not skipping:
+                texts.append([])
+            continue
+        path.pop()
+        if skipped:
+            skipping -= 1
+        elif skipping or not texts:
+            pass
+        elif tag == text:
+            texts[-1].append(element.text or "")
+        # Brytningar och tabbar oavsett attribut (w:br w:type="page" m.fl.),
+        # men inte tabbstoppen i styckeformatet (w:tabs, a:tabLst)
+        elif tag in breaks and not (path and path[-1].tag in tab_stops):
+            texts[-1].append(breaks[tag])
+        elif tag == paragraph:
+            yield "".join(texts.pop())
+        if path:
+            del path[-1][:]
+
+# Delarna som en OOXML-del pekar på med en viss relationstyp, som
+# {relations-id: sökväg i zip-filen}
+def _ooxml_targets(package, part, rel_type):
+    folder = posixpath.dirname(part)
+    try:
+        rels = ElementTree.fromstring(package.read(f"{folder}/_rels/{posixpath.basename(part)}.rels"))
+    except KeyError:
+        return {}
+    targets = {}
+    for rel in rels.iter(f"{{{PACKAGE_REL_NS}}}Relationship"):
+        if rel.get("Type", "").endswith(f"/{rel_type}") and rel.get("TargetMode") != "External":
+            target = rel.get("Target", "")
+            targets[rel.get("Id")] = (target.lstrip("/") if target.startswith("/")
+                                      else posixpath.normpath(posixpath.join(folder, target)))
+    return targets
+
+# Text ur DOCX och PPTX direkt ur zip-filen, utan python-docx/python-pptx
+# objektmodeller. DOCX: brödtexten med tabeller, sedan sidhuvuden och
+# sidfötter (samma text bara en gång). PPTX: bilderna i visningsordning,
+# var och en följd av talaranteckningarna. Läses styckevis, så läsningen
+# slutar när budgeten i _take är fylld.
+def _iter_ooxml(filepath):
+    with zipfile.ZipFile(filepath) as package:
+        if Path(filepath).suffix.lower() == ".docx":
+            yield from _ooxml_paragraphs(package.open("word/document.xml"), W_NS)
+            seen = set()
+            names = sorted(n for n in package.namelist() if OOXML_HEADER_PART.fullmatch(n))
+            for name in sorted(names, key=lambda n: n.startswith("word/footer")):
+                for text in _ooxml_paragraphs(package.open(name), W_NS):
+                    if text.strip() and text not in seen:
+                        seen.add(text)
+                        yield text
+            return
+
+        slides = _ooxml_targets(package, "ppt/presentation.xml", "slide")
+        presentation = ElementTree.fromstring(package.read("ppt/presentation.xml"))
+        for slide_id in presentation.iter(f"{{{PRESENTATION_NS}}}sldId"):
+            slide = slides[slide_id.get(f"{{{REL_NS}}}id")]
+            parts = [slide, *_ooxml_targets(package, slide, "notesSlide").values()]
+            for part in parts:
+                for text in _ooxml_paragraphs(package.open(part), DRAWING_NS):
+                    if text.strip():
+                        yield text
+
+# Läs textinnehåll från fil, högst `budget` tecken (standard: extract_chars
+# i config, ingen gräns utan config). För PDF:er tas även de sista
+# `tail_pages` sidorna med. DOCX och PPTX läses direkt ur zip-filen
+# (_iter_ooxml); går det inte används python-docx/python-pptx.
+# Med use_libreoffice=False kastas NeedsLibreOffice i stället för att starta
+# soffice för just den här filen
+def read_file(filepath, config=None, use_libreoffice=True, budget=None, tail_pages=None):
+    config = config or {}
+    budget = budget if budget is not None else config.get("extract_chars")
+    tail_pages = tail_pages if tail_pages is not None else config.get("tail_pages", 0)
     suffix = Path(filepath).suffix.lower()
     try:
-        if suffix == ".txt":
-            with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-                return f.read()
-        
-        elif suffix == ".docx":
-            from docx import Document
-            doc = Document(filepath)
-            return "\n".join([p.text for p in doc.paragraphs])
-        
-        elif suffix in (".ppt", ".pptx"):
-            from pptx import Presentation
-            prs = Presentation(filepath)
-            texts = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if shape.has_text_frame and shape.text_frame.text.strip():  # type: ignore[union-attr]
-                        texts.append(shape.text_frame.text)  # type: ignore[union-attr]
-            return "\n".join(texts)
-        
-        elif suffix == ".odt":
-            try:
-                from odf import text, teletype  # type: ignore[import-untyped]
-                from odf.opendocument import load as odf_load  # type: ignore[import-untyped]
-                doc = odf_load(filepath)
-                return teletype.extractText(doc.text)  # type: ignore[union-attr]
-            except Exception:
-                return _libreoffice_extract(filepath, config)
-
-        elif suffix == ".odp":
+        if suffix == ".pdf":
+            return _read_pdf(filepath, budget, tail_pages)
+        if suffix not in (".txt", ".docx", ".ppt", ".pptx", ".odt", ".odp", ".sdw"):
+            return None
+        if suffix in (".docx", ".pptx"):
             try:
-                from odf import draw, teletype  # type: ignore[import-untyped]
-                from odf.opendocument import load as odf_load  # type: ignore[import-untyped]
-                doc = odf_load(filepath)
-                texts = []
-                for frame in doc.presentation.getElementsByType(draw.Frame):  # type: ignore[union-attr]
-                    texts.append(teletype.extractText(frame))
-                return "\n".join(texts)
+                return _take(_iter_ooxml(filepath), budget)
+            except MemoryError:
+                raise
             except Exception:
-                return _libreoffice_extract(filepath, config)
-
-        elif suffix == ".sdw":
-            return _libreoffice_extract(filepath, config)
-        
-        elif suffix == ".pdf":
-            from pypdf import PdfReader
-            reader = PdfReader(filepath)
-            return "\n".join([page.extract_text() or "" for page in reader.pages])
-        else:
-            return None
+                pass  # trasig eller ovanlig fil: python-docx/python-pptx nedan
+        return _take(iter_text(filepath, config, use_libreoffice), budget)
+    except (NeedsLibreOffice, MemoryError):
+        raise
     except Exception as e:
         print(f"  Kunde inte läsa {filepath}: {e}")
         return None
 
+SHINGLE_WORDS = 5
+MINHASH_SIZE = 128
+MINHASH_MASK = (1 << 64) - 1
+# (a, b) för permutationerna a·x + b mod 2^64; a udda så att de är bijektiva
+MINHASH_PERMUTATIONS = [
+    (int.from_bytes(digest[:8], "big") | 1, int.from_bytes(digest[8:], "big"))
+    for digest in (hashlib.blake2b(f"minhash-{i}".encode(), digest_size=16).digest() for i in range(MINHASH_SIZE))
+]
+
+# MinHash-signatur för en text: för varje permutation det minsta värdet
+# över textens överlappande femordsfraser. Andelen lika värden i två
+# signaturer skattar Jaccard-likheten mellan texterna. None för texter
+# som är för korta för att jämföras.
+def text_signature(text):
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) < 4 * SHINGLE_WORDS:
+        return None
+    shingles = {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    return [min((a * x + b) & MINHASH_MASK for x in shingles) for a, b in MINHASH_PERMUTATIONS]
+
+# Läs en fil och beräkna signaturen i samma arbetsprocess. Returnerar
+# (text, signatur, sekunder för extraktionen)
+def read_file_signed(filepath, config, signed=True):
+    started = time.perf_counter()
+    content = read_file(filepath, config, False)
+    seconds = time.perf_counter() - started
+    return content, text_signature(content) if signed else None, seconds
+
+# LSH-index över MinHash-signaturer. Signaturen delas i band; dokument som
+# delar minst ett helt band är kandidater, och kandidaterna jämförs sedan
+# med skattad likhet mot tröskeln. Antalet band väljs så att LSH-tröskeln
+# (1/band)^(1/rader) ligger en bit under `threshold`.
+class NearDuplicateIndex:
+    def __init__(self, threshold, signatures=()):
+        self.threshold = threshold
+        self.bands, self.rows = min(
+            ((bands, MINHASH_SIZE // bands) for bands in (8, 16, 32, 64)),
+            key=lambda shape: abs((1 / shape[0]) ** (1 / shape[1]) - (threshold - 0.1)),
+        )
+        self.buckets = {}
+        self.signatures = {}
+        for key, signature in signatures:
+            self.add(key, signature)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, tuple(signature[band * self.rows:(band + 1) * self.rows])
+
+    def add(self, key, signature):
+        if signature is None or key in self.signatures:
+            return
+        self.signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self.buckets.setdefault(band_key, []).append(key)
+
+    # Det mest lika dokumentet över tröskeln: (nyckel, likhet), eller None
+    def find(self, signature):
+        if signature is None:
+            return None
+        candidates = {key for band_key in self._band_keys(signature) for key in self.buckets.get(band_key, ())}
+        best = None
+        for key in candidates:
+            other = self.signatures[key]
+            similarity = sum(a == b for a, b in zip(signature, other)) / MINHASH_SIZE
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+# Analysen för en nära kopia: källans analys med en länk tillbaka
+def linked_analysis(analysis, source_path, similarity):
+    linked = {k: v for k, v in analysis.items() if k not in ("filepath", "near_duplicate_of", "similarity")}
+    return {**linked, "near_duplicate_of": source_path, "similarity": round(similarity, 2)}
+
 # Kontrollera om filen är låst (öppen i annat program)
 def check_file_locked(filepath):
     try:
@@ -111,144 +1141,2004 @@ def check_file_locked(filepath):
     except IOError:
         return True
 
-# Analysera dokument med Claude
-def analyze_document(client, model, max_tokens, filepath, content, default_author=""):
-    prompt = f"""Analysera följande dokument och svara ENDAST med ett JSON-objekt i detta exakta format (inga kommentarer, inga markdown-kodblock):
-{{
-  "title": "dokumentets titel eller ett beskrivande namn om titel saknas",
-  "author": "författare i formatet 'Efternamn, Förnamn' eller 'Okänd' om det inte framgår. Flera författare separeras med semikolon",
-  "summary": "sammanfattning på svenska med 30-150 ord beroende på innehållets komplexitet",
-  "type": "en av: artikel, uppsats, bok, predikan, studie, övrigt (använd 'bok' även för äldre böcker utan ISBN)",
-  "year": "utgivningsår som heltal eller null om okänt",
-  "date_full": "exakt datum i formatet YYYY-MM-DD om det går att fastställa, annars null",
-  "is_citable": true eller false,
-
-  "publication": "tidskrift eller bok som artikeln publicerats i, eller null om ej artikel",
-
-  "publisher": "förlagets namn eller null om okänt eller ej bok",
-  "publisher_place": "utgivningsort eller null om okänd eller ej bok",
-  "isbn": "ISBN om det finns angivet, annars null",
-  "pages_total": "totalt antal sidor som heltal eller null om okänt",
-  "edition": "upplaga t.ex. '2nd edition' eller null om ej angiven",
-
-  "institution": "lärosäte för uppsats/avhandling eller null om ej tillämpligt",
-  "institution_place": "ort för lärosätet eller null om ej tillämpligt",
-  "thesis_type": "t.ex. 'Kandidatuppsats', 'Masteruppsats', 'Doktorsavhandling' eller null om ej tillämpligt"
-}}
-
-Filnamn: {Path(filepath).name}
+# Mönster som pekar ut sidor med metadata, med vikt för utdraget
+EXCERPT_PATTERNS = [
+    (5, re.compile(r"\bISBN\b|©|\bcopyright\b|\bförlag|\btryck|\bprinted\b|\bpublish|\bupplaga\b|\bedition\b", re.I)),
+    (3, re.compile(r"\babstract\b|\bsammanfattning\b|\bsummary\b|\bförord\b|\bpreface\b", re.I)),
+    (3, re.compile(r"\buppsats|\bavhandling|\bthesis\b|\bhandledare\b|\bexamensarbete|\bhögskola|\buniversitet", re.I)),
+    (2, re.compile(r"\binnehåll(sförteckning)?\b|\bcontents\b", re.I)),
+]
+TOC_LINE = re.compile(r"(\.{2,}|\s)\s*\d{1,3}\s*$", re.M)
+
+# Uppskattat antal tokens (ca 3,5 tecken per token för svensk och engelsk text)
+def estimate_tokens(text):
+    return math.ceil(len(text) / 3.5)
+
+# Dela upp text i avsnitt: sidor om texten har sidbrytningar, annars
+# rader grupperade till ungefär `size` tecken
+def _sections(text, size=1500):
+    if "\f" in text:
+        return text.split("\f")
+    sections, current = [], []
+    length = 0
+    for line in text.split("\n"):
+        current.append(line)
+        length += len(line) + 1
+        if length >= size:
+            sections.append("\n".join(current))
+            current, length = [], 0
+    if current:
+        sections.append("\n".join(current))
+    return sections
+
+# Poäng för ett avsnitt: titelsida, kolofon/ISBN, sammanfattning,
+# innehållsförteckning och första brödtextsidan prioriteras. None = tomt.
+def _score_section(index, section, first_body):
+    body = section.strip()
+    if len(body) < 15:
+        return None
+    score = sum(weight for weight, pattern in EXCERPT_PATTERNS if pattern.search(body))
+    if index == 0:
+        score += 4
+    elif index < 3 and len(body) < 800:
+        score += 2
+    if len(TOC_LINE.findall(body)) >= 5:
+        score += 2
+    if index == first_body:
+        score += 2
+    return score - index * 0.05
+
+# Bygg ett utdrag på högst `token_budget` tokens av de högst poängsatta
+# avsnitten, i dokumentordning. Korta texter skickas hela.
+def build_excerpt(text, token_budget):
+    if not token_budget or estimate_tokens(text) <= token_budget:
+        return text
+    sections = _sections(text)
+    first_body = next((i for i, sec in enumerate(sections) if i > 0 and len(sec.strip()) >= 1000), None)
+    scored = [(score, i) for i, sec in enumerate(sections)
+              if (score := _score_section(i, sec, first_body)) is not None]
+    remaining = int(token_budget * 3.5)
+    chosen = {}
+    for score, i in sorted(scored, reverse=True):
+        if remaining < 200:
+            break
+        piece = sections[i].strip()[:remaining]
+        chosen[i] = piece
+        remaining -= len(piece) + 7
+    parts = []
+    previous = None
+    for i in sorted(chosen):
+        if parts:
+            parts.append("\n" if i == previous + 1 else "\n[...]\n")
+        parts.append(chosen[i])
+        previous = i
+    return "".join(parts)
+
+# Utdragets storlek när excerpt_tokens saknas i config, ungefär de 6000
+# tecken som skickades innan utdragen fanns
+DEFAULT_EXCERPT_TOKENS = 1500
+
+# Gör om extraherad text till utdraget som skickas, och räkna hur många
+# tokens det sparar jämfört med att skicka de första 6000 tecknen
+def prepare_content(content, config, stats):
+    excerpt = build_excerpt(content, config.get("excerpt_tokens") or DEFAULT_EXCERPT_TOKENS)
+    stats["excerpt_tokens"] += estimate_tokens(excerpt)
+    stats["baseline_tokens"] += estimate_tokens(content[:6000])
+    return excerpt
+
+DOCUMENT_TYPES = ["artikel", "uppsats", "bok", "predikan", "studie", "övrigt"]
+
+# Fasta instruktioner. Skickas som systemprompt med cache_control, så att
+# de (tillsammans med verktygsschemat) läses från promptcachen i stället
+# för att betalas fullt i varje anrop – om prefixet når modellens
+# minsta cachebara längd, se cacheable_prefix.
+SYSTEM_PROMPT = """Du analyserar dokument ur ett personligt arkiv med predikningar, studier, uppsatser, artiklar och böcker, främst på svenska.
+
+Läs dokumentet i användarmeddelandet och spara resultatet genom att anropa verktyget spara_analys exakt en gång. Fyll i alla fält enligt beskrivningarna i verktygets schema.
+
+- Titel: dokumentets titel, eller ett beskrivande namn om titel saknas.
+- Författare i formatet 'Efternamn, Förnamn', eller 'Okänd' om det inte framgår. Flera författare separeras med semikolon.
+- Sammanfattningen skrivs på svenska med 30–150 ord beroende på innehållets komplexitet.
+- Typ är en av: artikel, uppsats, bok, predikan, studie, övrigt. Använd 'bok' även för äldre böcker utan ISBN.
+- År anges som heltal. Exakt datum anges bara om det går att fastställa.
+- Fält som inte går att fastställa, eller inte gäller dokumenttypen, sätts till null.
+- Innehållet kan vara ett utdrag; [...] markerar utelämnade delar."""
+
+def _nullable(kind, description):
+    return {"type": [kind, "null"], "description": description}
+
+# Verktyget som tvingar fram svaret som strukturerad data enligt schemat
+ANALYSIS_TOOL = {
+    "name": "spara_analys",
+    "description": "Spara analysen av dokumentet.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "description": "dokumentets titel eller ett beskrivande namn om titel saknas"},
+            "author": {"type": "string", "description": "författare i formatet 'Efternamn, Förnamn' eller 'Okänd'; flera separeras med semikolon"},
+            "summary": {"type": "string", "description": "sammanfattning på svenska med 30-150 ord"},
+            "type": {"type": "string", "enum": DOCUMENT_TYPES, "description": "dokumenttyp ('bok' även för äldre böcker utan ISBN)"},
+            "year": _nullable("integer", "utgivningsår som heltal"),
+            "date_full": _nullable("string", "exakt datum i formatet YYYY-MM-DD"),
+            "is_citable": {"type": "boolean", "description": "om dokumentet går att citera som källa"},
+            "publication": _nullable("string", "tidskrift eller bok som artikeln publicerats i"),
+            "publisher": _nullable("string", "förlagets namn"),
+            "publisher_place": _nullable("string", "utgivningsort"),
+            "isbn": _nullable("string", "ISBN om det finns angivet"),
+            "pages_total": _nullable("integer", "totalt antal sidor"),
+            "edition": _nullable("string", "upplaga, t.ex. '2nd edition'"),
+            "institution": _nullable("string", "lärosäte för uppsats/avhandling"),
+            "institution_place": _nullable("string", "ort för lärosätet"),
+            "thesis_type": _nullable("string", "t.ex. 'Kandidatuppsats', 'Masteruppsats', 'Doktorsavhandling'"),
+        },
+        "required": ["title", "author", "summary", "type", "year", "is_citable"],
+    },
+}
+
+# Verktyget för triagemodellens första analys: samma fält och en
+# självskattad säkerhet som avgör om dokumentet skickas vidare
+TRIAGE_TOOL = {
+    **ANALYSIS_TOOL,
+    "input_schema": {
+        **ANALYSIS_TOOL["input_schema"],
+        "properties": {
+            **ANALYSIS_TOOL["input_schema"]["properties"],
+            "confidence": {"type": "number", "description": "hur säker du är på titel, författare, typ och år, från 0 (gissning) till 1 (framgår tydligt)"},
+        },
+        "required": ANALYSIS_TOOL["input_schema"]["required"] + ["confidence"],
+    },
+}
+
+# Skäl att skicka ett dokument vidare från triagemodellen, i den ordning
+# de prövas: fält saknas, typen ska alltid till den större modellen, eller
+# för låg säkerhet; "error" när triageanropet misslyckades
+ESCALATION_REASONS = ("missing", "type", "confidence", "error")
+
+# Verktyget för flera korta dokument i samma anrop: en analys per
+# dokument, med filnamnet som nyckel
+PACK_TOOL = {
+    "name": "spara_analyser",
+    "description": "Spara analysen av varje dokument.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "analyses": {
+                "type": "array",
+                "description": "en analys per dokument, i samma ordning som dokumenten",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "filename": {"type": "string", "description": "dokumentets filnamn, exakt som det anges"},
+                        **ANALYSIS_TOOL["input_schema"]["properties"],
+                    },
+                    "required": ["filename"] + ANALYSIS_TOOL["input_schema"]["required"],
+                },
+            },
+        },
+        "required": ["analyses"],
+    },
+}
+
+# Bygg användarmeddelandet för ett dokument
+def build_prompt(filepath, content):
+    return f"""Filnamn: {Path(filepath).name}
 
 Dokumentets innehåll (kan vara avkortat):
-{content[:6000]}
+{content}
 """
-    message = client.messages.create(
-        model=model,
-        max_tokens=max_tokens,
-        messages=[{"role": "user", "content": prompt}]
-    )
-    raw = message.content[0].text.strip()
+
+# Bygg användarmeddelandet för flera korta dokument i samma anrop
+def build_pack_prompt(documents):
+    parts = [f"Här följer {len(documents)} korta dokument. Analysera vart och ett för sig och spara alla "
+             f"analyserna med ett anrop till verktyget spara_analyser, en analys per dokument med filnamnet "
+             f"exakt som det anges."]
+    for number, (filepath, content) in enumerate(documents, 1):
+        parts.append(f"=== Dokument {number} ===\n{build_prompt(filepath, content)}")
+    return "\n\n".join(parts)
+
+# Minsta prefix (verktyg + systemprompt) i tokens som API:t cachar, per
+# modellfamilj; övriga modeller cachar från 1024 tokens. Kortare prefix
+# cachas inte alls, och cache_control skickas då inte.
+MIN_CACHE_TOKENS = [("haiku-4-5", 4096), ("opus-4-5", 4096), ("3-5-haiku", 2048), ("3-haiku", 2048)]
+DEFAULT_MIN_CACHE_TOKENS = 1024
+
+def min_cache_tokens(model):
+    return next((tokens for family, tokens in MIN_CACHE_TOKENS if family in model), DEFAULT_MIN_CACHE_TOKENS)
+
+# Uppskattad längd på det fasta prefixet för ett verktyg
+def prefix_tokens(tool):
+    return estimate_tokens(SYSTEM_PROMPT + json.dumps(tool, ensure_ascii=False))
+
+def cacheable_prefix(model, tool=ANALYSIS_TOOL):
+    return prefix_tokens(tool) >= min_cache_tokens(model)
+
+# Parametrar till messages.create – delas av direktanrop och Message Batches.
+# Med `prompt` skickas den i stället för meddelandet för ett dokument.
+def request_params(model, max_tokens, filepath, content, tool=ANALYSIS_TOOL, prompt=None):
+    system = {"type": "text", "text": SYSTEM_PROMPT}
+    if cacheable_prefix(model, tool):
+        system["cache_control"] = {"type": "ephemeral"}
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "system": [system],
+        "tools": [tool],
+        "tool_choice": {"type": "tool", "name": tool["name"]},
+        "messages": [{"role": "user", "content": prompt or build_prompt(filepath, content)}],
+    }
+
+# Laga vanliga JSON-fel lokalt: kodblock, text runt objektet, avslutande
+# kommatecken och Python-literaler
+def repair_json(raw):
+    raw = raw.strip()
     if raw.startswith("```"):
         raw = raw.split("```")[1]
         if raw.startswith("json"):
             raw = raw[4:]
-    result = json.loads(raw.strip())
-    if default_author and result.get("author", "").lower() in ("okänd", "unknown", ""):
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1 and end > start:
+        raw = raw[start:end + 1]
+    raw = re.sub(r",\s*([}\]])", r"\1", raw)
+    raw = re.sub(r"\bNone\b", "null", raw)
+    raw = re.sub(r"\bTrue\b", "true", raw)
+    raw = re.sub(r"\bFalse\b", "false", raw)
+    return raw
+
+# Tolka ett textsvar till ett analysobjekt
+def parse_analysis(raw, default_author=""):
+    try:
+        result = json.loads(raw.strip())
+    except json.JSONDecodeError:
+        result = json.loads(repair_json(raw))
+    if default_author and (result.get("author") or "").lower() in ("okänd", "unknown", ""):
+        result["author"] = default_author
+    return result
+
+def _as_int(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    match = re.search(r"\d+", str(value or ""))
+    return int(match.group()) if match else None
+
+# Kontrollera fälten och rätta det som går att rätta lokalt (år och
+# sidantal som heltal, typ bland de tillåtna, datumformat). Returnerar
+# namnen på de fält som rättades.
+def validate_analysis(result):
+    fixed = []
+    for field in ("year", "pages_total"):
+        value = result.get(field)
+        if value is not None and not (isinstance(value, int) and not isinstance(value, bool)):
+            result[field] = _as_int(value)
+            fixed.append(field)
+    doc_type = str(result.get("type") or "").strip().lower()
+    if doc_type == "avhandling":
+        doc_type = "uppsats"
+    if doc_type not in DOCUMENT_TYPES:
+        doc_type = "övrigt"
+    if doc_type != result.get("type"):
+        result["type"] = doc_type
+        fixed.append("type")
+    date_full = result.get("date_full")
+    if date_full is not None and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", str(date_full)):
+        result["date_full"] = None
+        fixed.append("date_full")
+    if not isinstance(result.get("is_citable"), bool):
+        result["is_citable"] = str(result.get("is_citable")).lower() in ("true", "ja", "yes", "1")
+        fixed.append("is_citable")
+    for field in ("title", "author", "summary"):
+        if not isinstance(result.get(field), str):
+            result[field] = "" if result.get(field) is None else str(result[field])
+            fixed.append(field)
+    return fixed
+
+# Plocka ut analysen ur ett svar. Normalt kommer den som verktygsanrop;
+# annars (eller om fälten är fel) lagas svaret lokalt i stället för att
+# göra om hela anropet. Tokenförbrukning och tolkningsutfall läggs i `usage`.
+def analysis_from_message(message, default_author="", usage=None):
+    usage = usage if usage is not None else {}
+    message_usage(message, usage)
+    result = next((dict(block.input) for block in message.content if block.type == "tool_use"), None)
+    if result is None:
+        usage["unstructured"] = 1
+        result = parse_analysis("".join(block.text for block in message.content if block.type == "text"))
+    usage["fixed_fields"] = len(validate_analysis(result))
+    if default_author and result["author"].lower() in ("okänd", "unknown", ""):
         result["author"] = default_author
     return result
 
-# Hitta alla filer att processa
-def find_files(folders, extensions, log):
+# Tokenförbrukningen för ett svar
+def message_usage(message, usage):
+    meta = message.usage
+    usage["calls"] = 1
+    usage["input_tokens"] = meta.input_tokens or 0
+    usage["output_tokens"] = meta.output_tokens or 0
+    usage["cache_read_tokens"] = getattr(meta, "cache_read_input_tokens", None) or 0
+    usage["cache_write_tokens"] = getattr(meta, "cache_creation_input_tokens", None) or 0
+
+# Plocka ut analyserna ur svaret på ett packat anrop som {filnamn: analys}.
+# Analyser som inte går att tolka, saknar titel eller sammanfattning eller
+# har ett okänt filnamn utelämnas; de dokumenten analyseras var för sig.
+def analyses_from_message(message, filenames, default_author="", usage=None):
+    usage = usage if usage is not None else {}
+    message_usage(message, usage)
+    result = next((block.input for block in message.content if block.type == "tool_use"), None)
+    if result is None:
+        usage["unstructured"] = 1
+        try:
+            result = parse_analysis("".join(block.text for block in message.content if block.type == "text"))
+        except ValueError:
+            result = {}
+    items = result.get("analyses") if isinstance(result, dict) else result
+    analyses = {}
+    usage["fixed_fields"] = 0
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict) or item.get("filename") not in filenames or item["filename"] in analyses:
+            continue
+        item = dict(item)
+        filename = item.pop("filename")
+        fixed = validate_analysis(item)
+        if not (item["title"] and item["summary"]):
+            continue
+        usage["fixed_fields"] += len(fixed)
+        if default_author and item["author"].lower() in ("okänd", "unknown", ""):
+            item["author"] = default_author
+        analyses[filename] = item
+    return analyses
+
+# Hastighetsbegränsning och omförsök för anrop till Claude.
+# Två tokenhinkar håller anrop och inputtokens per minut under gränsen
+# (från config.yaml, annars från svarens rate-limit-huvuden). Antalet
+# samtidiga anrop styrs AIMD-mässigt: det ökar med ungefär ett per
+# lyckat varv och halveras när API:t svarar 429 eller 529. Misslyckade
+# anrop görs om med exponentiell backoff med slumpad jitter, eller efter
+# den tid som retry-after anger.
+class RateLimiter:
+    def __init__(self, max_concurrency=1, rpm=None, tpm=None, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = float(rpm or 0)
+        self.tokens = float(tpm or 0)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.active = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.stats = {"retries": 0, "throttled": 0, "given_up": 0, "min_concurrency": max_concurrency}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    # Sekunder tills ett anrop som kostar `cost` tokens får gå, 0 om genast,
+    # None om alla platser är upptagna
+    def _delay(self, cost):
+        if self.active >= max(1, int(self.concurrency)):
+            return None
+        delay = self.paused_until - time.monotonic()
+        if self.rpm and self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm and self.tokens < min(cost, self.tpm):
+            delay = max(delay, (min(cost, self.tpm) - self.tokens) * 60 / self.tpm)
+        return max(delay, 0.0)
+
+    def _acquire(self, cost):
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("avbrutet")
+                self._refill()
+                delay = self._delay(cost)
+                if delay == 0:
+                    break
+                # Väck regelbundet så att close() och Ctrl-C hinner fram
+                self.cond.wait(min(delay or 1.0, 1.0))
+            self.active += 1
+            if self.rpm:
+                self.requests -= 1
+            if self.tpm:
+                self.tokens -= cost
+
+    def _release(self, headers=None, cost=0, used=None, throttled=False):
+        with self.cond:
+            self.active -= 1
+            self._refill()
+            if used is not None and self.tpm:
+                self.tokens += cost - used
+            if headers is not None:
+                self._read_headers(headers)
+            if throttled:
+                # Halvera bara en gång per överbelastning, inte en gång per samtidigt anrop
+                now = time.monotonic()
+                if now - self.last_decrease > self.base_delay:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.last_decrease = now
+                    self.stats["min_concurrency"] = min(self.stats["min_concurrency"], int(self.concurrency))
+            elif used is not None:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.cond.notify_all()
+
+    # Justera hinkarna efter vad API:t säger finns kvar. Hinkarna fylls på
+    # kontinuerligt, så *-reset (när hinken är full igen) behövs inte.
+    def _read_headers(self, headers):
+        for kind, limit_attr, level_attr in (("requests", "rpm", "requests"), ("input-tokens", "tpm", "tokens")):
+            limit = headers.get(f"anthropic-ratelimit-{kind}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining")
+            if limit and getattr(self, limit_attr) is None:
+                setattr(self, limit_attr, int(limit))
+                setattr(self, level_attr, float(remaining or limit))
+            if remaining is not None and getattr(self, limit_attr):
+                setattr(self, level_attr, min(getattr(self, level_attr), float(remaining)))
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        with self.cond:
+            while not self.closed and time.monotonic() < deadline:
+                self.cond.wait(min(deadline - time.monotonic(), 1.0))
+
+    # Skicka ett anrop med omförsök och returnera svaret
+    def call(self, client, params, cost):
+        import anthropic
+
+        client = client.with_options(max_retries=0)
+        for attempt in range(self.max_retries + 1):
+            self._acquire(cost)
+            try:
+                raw = client.messages.with_raw_response.create(**params)
+            except anthropic.APIStatusError as e:
+                throttled = e.status_code in (429, 529)
+                self._release(e.response.headers, throttled=throttled)
+                if not (throttled or e.status_code >= 500) or attempt == self.max_retries:
+                    self._give_up()
+                    raise
+                retry_after = e.response.headers.get("retry-after")
+                if throttled:
+                    with self.cond:
+                        self.stats["throttled"] += 1
+            except anthropic.APIConnectionError:
+                self._release()
+                if attempt == self.max_retries:
+                    self._give_up()
+                    raise
+                retry_after = None
+            else:
+                message = raw.parse()
+                used = (message.usage.input_tokens or 0) + (getattr(message.usage, "cache_creation_input_tokens", None) or 0)
+                self._release(raw.headers, cost, used)
+                return message
+
+            backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+            try:
+                delay = float(retry_after) + random.uniform(0, self.base_delay)
+            except (TypeError, ValueError):
+                delay = random.uniform(backoff / 2, backoff)
+            if retry_after is not None:
+                with self.cond:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            with self.cond:
+                self.stats["retries"] += 1
+            self._sleep(delay)
+            if self.closed:
+                raise RuntimeError("avbrutet")
+
+    def _give_up(self):
+        with self.cond:
+            self.stats["given_up"] += 1
+
+    # Väck väntande trådar och låt dem ge upp (vid Ctrl-C)
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+# Skicka ett anrop, genom RateLimiter om det finns en
+def send_request(client, params, limiter=None):
+    if limiter is None:
+        return client.messages.create(**params)
+    return limiter.call(client, params, estimate_tokens(params["messages"][0]["content"]))
+
+# Varför triagemodellens analys inte räcker (ett av ESCALATION_REASONS),
+# eller None om den kan sparas som den är. Tar bort säkerheten ur analysen.
+def escalation_reason(result, triage):
+    confidence = result.pop("confidence", None)
+    if not all(result.get(field) for field in ("title", "author", "summary")):
+        return "missing"
+    if result.get("type") in (triage.get("escalate_types") or []):
+        return "type"
+    try:
+        confidence = float(confidence)
+    except (TypeError, ValueError):
+        return "confidence"
+    if confidence < triage.get("min_confidence", 0.7):
+        return "confidence"
+    return None
+
+# Analysera dokument med Claude. Med en RateLimiter hålls anropen under
+# kontots gränser och misslyckade anrop görs om; utan skickas anropet
+# direkt med SDK:ns egna omförsök.
+# Med `triage` (avsnittet triage i config.yaml) analyserar först en snabb,
+# billig modell dokumentet och anger hur säker den är. Bara osäkra eller
+# ofullständiga svar och dokument av typerna i escalate_types skickas
+# vidare till `model`. Triageanropets förbrukning läggs i `usage` med
+# prefixet triage_.
+def analyze_document(client, model, max_tokens, filepath, content, default_author="", usage=None, limiter=None,
+                     triage=None):
+    usage = usage if usage is not None else {}
+    if triage and triage.get("model"):
+        triage_usage = {}
+        started = time.perf_counter()
+        params = request_params(triage["model"], triage.get("max_tokens") or max_tokens, filepath, content,
+                                TRIAGE_TOOL)
+        # Standardförfattaren sätts först efter kontrollen, så att en saknad
+        # författare skickar dokumentet vidare. Misslyckas triageanropet
+        # analyserar den större modellen dokumentet i stället.
+        try:
+            result = analysis_from_message(send_request(client, params, limiter), "", triage_usage)
+            reason = escalation_reason(result, triage)
+        except Exception:
+            reason = "error"
+        usage.update({f"triage_{key}": value for key, value in triage_usage.items()})
+        usage["triage_seconds"] = time.perf_counter() - started
+        usage["triaged"] = 1
+        if reason is None:
+            usage["escalated"] = 0
+            usage["unstructured"] = triage_usage.get("unstructured", 0)
+            usage["fixed_fields"] = triage_usage.get("fixed_fields", 0)
+            if default_author and result["author"].lower() in ("okänd", "unknown"):
+                result["author"] = default_author
+            return result
+        usage["escalated"] = 1
+        usage[f"escalated_{reason}"] = 1
+
+    params = request_params(model, max_tokens, filepath, content)
+    return analysis_from_message(send_request(client, params, limiter), default_author, usage)
+
+# En analys som misslyckades; förbrukningen från anrop som ändå gjordes
+# (triageanropet före ett misslyckat eskalerat anrop) följer med felet
+class AnalysisFailed(Exception):
+    def __init__(self, error, usage):
+        super().__init__(str(error))
+        self.usage = usage
+
+# Analysera extraherad text – körs i en arbetstråd
+# Returnerar (analys, förbrukning) så att statistiken bara uppdateras i huvudtråden
+def analyze_content(client, filepath, content, config, limiter=None):
+    usage = {}
+    started = time.perf_counter()
+    try:
+        analysis = analyze_document(
+            client,
+            config["anthropic"]["model"],
+            config["anthropic"]["max_tokens"],
+            filepath,
+            content,
+            config.get("default_author", "Okänd"),
+            usage,
+            limiter,
+            config.get("triage"),
+        )
+    except Exception as e:
+        usage["api_seconds"] = time.perf_counter() - started
+        raise AnalysisFailed(e, usage) from e
+    # Inklusive väntan på hastighetsbegränsningen och omförsök
+    usage["api_seconds"] = time.perf_counter() - started
+    return analysis, usage
+
+# Analysera flera korta dokument i ett anrop – körs i en arbetstråd.
+# `documents` är (filväg, text)-par med olika filnamn; svaret får
+# max_tokens per dokument. Returnerar ({filnamn: analys}, förbrukning).
+# Packade dokument går direkt till anthropic.model, utan triage.
+def analyze_pack(client, documents, config, limiter=None):
+    usage = {}
+    started = time.perf_counter()
+    params = request_params(config["anthropic"]["model"], config["anthropic"]["max_tokens"] * len(documents),
+                            None, None, PACK_TOOL, build_pack_prompt(documents))
+    analyses = analyses_from_message(send_request(client, params, limiter),
+                                     {Path(filepath).name for filepath, _ in documents},
+                                     config.get("default_author", "Okänd"), usage)
+    usage["api_seconds"] = time.perf_counter() - started
+    return analyses, usage
+
+# Lägg ihop förbrukning från ett anrop i körningens statistik
+def add_usage(stats, usage):
+    for key, value in usage.items():
+        stats[key] = stats.get(key, 0) + value
+
+# Priser relativt modellens: läsning ur och skrivning till promptcachen
+# jämfört med vanliga inputtokens, och Message Batches jämfört med
+# direkta anrop
+CACHE_READ_PRICE = 0.1
+CACHE_WRITE_PRICE = 1.25
+BATCH_PRICE = 0.5
+
+TOKEN_KEYS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+
+# Fördela förbrukningen för ett packat anrop på dess dokument efter deras
+# andel av texten (`weights`). Anropet och tolkningen räknas på det första
+# dokumentet; anropstiden gäller alla, eftersom alla väntade på svaret.
+def split_usage(usage, weights):
+    total = sum(weights) or 1
+    seconds = usage.get("api_seconds", 0.0)
+    parts = [{"packed": 1, "api_seconds": seconds} for _ in weights]
+    for key in TOKEN_KEYS:
+        value = usage.get(key, 0)
+        for part, weight in zip(parts[1:], weights[1:]):
+            part[key] = value * weight // total
+        parts[0][key] = value - sum(part[key] for part in parts[1:])
+    for key in ("calls", "unstructured", "fixed_fields"):
+        parts[0][key] = usage.get(key, 0)
+    parts[0].update(packs=1, pack_seconds=seconds)
+    return parts
+
+# Percentil (0–100) av en sorterad lista
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+# Steg som anropar Claude. Bara de skriver metrics.json och
+# prometheus_textfile med tokens och kostnad; övriga steg skriver egna
+# filer (metrics-report.json osv.) så att analysens siffror finns kvar.
+API_COMMANDS = ("all", "analyze")
+
+# Mätvärden för en körning: tid per steg, extraktionstid per fil och
+# extraktor (filformat, eller libreoffice), anropstid, tokens och
+# uppskattad kostnad per dokument. Allt registreras från huvudtråden.
+# Triagemodellens tokens prissätts med dess egna priser.
+# Skrivs som JSON-sammanfattning och, om så önskas, som textfil för
+# Prometheus (node_exporters textfile-collector).
+class Metrics:
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    SLOWEST = 10
+
+    def __init__(self, input_price=0.0, output_price=0.0, command="", triage_input_price=0.0,
+                 triage_output_price=0.0):
+        self.input_price = input_price or 0.0
+        self.output_price = output_price or 0.0
+        self.triage_input_price = triage_input_price or 0.0
+        self.triage_output_price = triage_output_price or 0.0
+        self.command = command
+        self.started = datetime.now()
+        self.stages = {}
+        self.documents = {}
+        self.extractors = {}
+        self.counters = {}
+        self.cost = 0.0
+
+    # Ta tid på ett steg; tiden läggs till stegets tidigare tid
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    # Kostnad i USD för tokens med ett visst prefix i `usage`, med priser
+    # per miljon tokens
+    @staticmethod
+    def _token_cost(usage, prefix, input_price, output_price):
+        return (usage.get(f"{prefix}input_tokens", 0) * input_price
+                + usage.get(f"{prefix}cache_read_tokens", 0) * input_price * CACHE_READ_PRICE
+                + usage.get(f"{prefix}cache_write_tokens", 0) * input_price * CACHE_WRITE_PRICE
+                + usage.get(f"{prefix}output_tokens", 0) * output_price) / 1_000_000
+
+    # Uppskattad kostnad i USD för förbrukningen i `usage`
+    def estimate_cost(self, usage, batch=False):
+        cost = (self._token_cost(usage, "", self.input_price, self.output_price)
+                + self._token_cost(usage, "triage_", self.triage_input_price, self.triage_output_price))
+        return cost * BATCH_PRICE if batch else cost
+
+    # Vad triagen sparade på ett dokument jämfört med att bara använda den
+    # större modellen: stannade det hos triagemodellen sparas skillnaden i
+    # pris för samma tokens (och dessa tokens hos den större modellen),
+    # annars kostade triageanropet extra
+    def _triage_saving(self, usage):
+        triage_cost = self._token_cost(usage, "triage_", self.triage_input_price, self.triage_output_price)
+        if usage.get("escalated"):
+            return -triage_cost, 0
+        tokens = sum(usage.get(f"triage_{key}", 0) for key in TOKEN_KEYS)
+        return self._token_cost(usage, "triage_", self.input_price, self.output_price) - triage_cost, tokens
+
+    def _document(self, filepath):
+        return self.documents.setdefault(str(filepath), {"format": Path(filepath).suffix.lower()})
+
+    # Histogrammets fack är kumulativa, som i Prometheus: antal filer som
+    # tog högst så många sekunder
+    def extraction(self, filepath, seconds, chars, extractor=None):
+        extractor = extractor or Path(filepath).suffix.lower() or "?"
+        self._document(filepath).update(extractor=extractor, extract_seconds=round(seconds, 4), chars=chars)
+        histogram = self.extractors.setdefault(
+            extractor, {"count": 0, "seconds": 0.0, "buckets": [0] * len(self.BUCKETS)}
+        )
+        histogram["count"] += 1
+        histogram["seconds"] += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+
+    def analysis(self, filepath, usage, batch=False):
+        cost = self.estimate_cost(usage, batch)
+        self.cost += cost
+        document = self._document(filepath)
+        document.update({key: usage.get(key, 0) for key in TOKEN_KEYS}, cost=round(cost, 6))
+        if "api_seconds" in usage:
+            document["api_seconds"] = round(usage["api_seconds"], 3)
+        if batch:
+            document["batch"] = True
+        if usage.get("packed"):
+            document["pack"] = "fallback" if usage.get("pack_fallback") else "packed"
+        if usage.get("triaged"):
+            saved_usd, saved_tokens = self._triage_saving(usage)
+            document["triage"] = {
+                "escalated": bool(usage.get("escalated")),
+                "reason": next((r for r in ESCALATION_REASONS if usage.get(f"escalated_{r}")), None),
+                "seconds": round(usage.get("triage_seconds", 0.0), 3),
+                **{key: usage.get(f"triage_{key}", 0) for key in TOKEN_KEYS},
+                "saved_tokens": saved_tokens,
+                "saved_usd": round(saved_usd, 6),
+            }
+
+    # Triagen samlat: andel eskalerade dokument och varför, anropstider för
+    # triageanropet och för hela analysen med och utan eskalering, samt
+    # tokens och kostnad som sparades jämfört med bara den större modellen
+    def _triage_summary(self):
+        triaged = [doc for doc in self.documents.values() if "triage" in doc]
+        if not triaged:
+            return None
+        escalated = [doc for doc in triaged if doc["triage"]["escalated"]]
+        kept = [doc for doc in triaged if not doc["triage"]["escalated"]]
+        triage_seconds = sorted(doc["triage"]["seconds"] for doc in triaged)
+        kept_seconds = sorted(doc.get("api_seconds", 0.0) for doc in kept)
+        escalated_seconds = sorted(doc.get("api_seconds", 0.0) for doc in escalated)
+        return {
+            "documents": len(triaged),
+            "escalated": len(escalated),
+            "escalation_rate": round(len(escalated) / len(triaged), 3),
+            "reasons": {reason: sum(1 for doc in escalated if doc["triage"]["reason"] == reason)
+                        for reason in ESCALATION_REASONS},
+            "p50_triage_seconds": round(_percentile(triage_seconds, 50), 3),
+            "p50_kept_seconds": round(_percentile(kept_seconds, 50), 3),
+            "p50_escalated_seconds": round(_percentile(escalated_seconds, 50), 3),
+            "tokens": {key: sum(doc["triage"][key] for doc in triaged) for key in TOKEN_KEYS},
+            "saved_tokens": sum(doc["triage"]["saved_tokens"] for doc in triaged),
+            "saved_usd": round(sum(doc["triage"]["saved_usd"] for doc in triaged), 4),
+        }
+
+    # Packningen samlat: packade anrop, dokument som fick sin analys därifrån
+    # och som fick göras om var för sig, sparade anrop, samt anropstid per
+    # dokument – väntan på svaret och anropstiden delad på dokumenten – jämfört
+    # med dokument som skickades ensamma
+    def _pack_summary(self):
+        analysis = self.counters.get("analysis", {})
+        requests = analysis.get("packs", 0)
+        if not requests:
+            return None
+        docs = self.documents.values()
+        packed = sorted(doc.get("api_seconds", 0.0) for doc in docs if doc.get("pack") == "packed")
+        fallback = sorted(doc.get("api_seconds", 0.0) for doc in docs if doc.get("pack") == "fallback")
+        single = sorted(doc["api_seconds"] for doc in docs if "api_seconds" in doc and "pack" not in doc)
+        in_packs = analysis.get("packed", 0)
+        return {
+            "requests": requests,
+            "documents": len(packed),
+            "fallbacks": len(fallback),
+            "documents_per_request": round(in_packs / requests, 2),
+            "requests_saved": len(packed) - requests,
+            "p50_packed_seconds": round(_percentile(packed, 50), 3),
+            "p50_fallback_seconds": round(_percentile(fallback, 50), 3),
+            "p50_single_seconds": round(_percentile(single, 50), 3) if single else None,
+            "seconds_per_document": round(analysis.get("pack_seconds", 0.0) / max(in_packs, 1), 3),
+        }
+
+    def _slowest(self, key):
+        timed = [(doc[key], path) for path, doc in self.documents.items() if key in doc]
+        timed.sort(reverse=True)
+        return [{"path": path, "seconds": round(seconds, 3)} for seconds, path in timed[:self.SLOWEST]]
+
+    def summary(self):
+        api = sorted(doc["api_seconds"] for doc in self.documents.values() if "api_seconds" in doc)
+        analysis = self.counters.get("analysis", {})
+        return {
+            "command": self.command,
+            "started": self.started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "tokens": {key: analysis.get(key, 0) for key in TOKEN_KEYS},
+            "cost_usd": round(self.cost, 4),
+            "extractors": {
+                name: {
+                    "count": h["count"],
+                    "seconds": round(h["seconds"], 3),
+                    "mean_seconds": round(h["seconds"] / h["count"], 4),
+                    "buckets": dict(zip(map(str, self.BUCKETS), h["buckets"])),
+                }
+                for name, h in sorted(self.extractors.items())
+            },
+            "api": {
+                "calls": len(api),
+                "seconds": round(sum(api), 3),
+                "p50_seconds": round(_percentile(api, 50), 3),
+                "p95_seconds": round(_percentile(api, 95), 3),
+                "max_seconds": round(api[-1], 3) if api else 0.0,
+            },
+            "triage": self._triage_summary(),
+            "packing": self._pack_summary(),
+            "slowest_extraction": self._slowest("extract_seconds"),
+            "slowest_analysis": self._slowest("api_seconds"),
+            "counters": self.counters,
+            "documents": self.documents,
+        }
+
+    # Mätvärdena i Prometheus textformat
+    def prometheus(self):
+        lines = []
+        base = {"command": self.command}
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP analyzer_{name} {help_text}")
+            lines.append(f"# TYPE analyzer_{name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join(f'{key}="{label}"' for key, label in {**base, **labels}.items())
+            lines.append(f"analyzer_{name}{{{label_text}}} {value}")
+
+        header("last_run_timestamp_seconds", "gauge", "End of the last run (Unix time).")
+        sample("last_run_timestamp_seconds", {}, round(time.time()))
+        header("stage_seconds", "gauge", "Wall time per stage in the last run.")
+        for name, seconds in self.stages.items():
+            sample("stage_seconds", {"stage": name}, round(seconds, 3))
+
+        analysis = self.counters.get("analysis", {})
+        triage = self._triage_summary()
+        packing = self._pack_summary()
+        if self.command in API_COMMANDS:
+            header("tokens", "gauge", "Tokens used in the last run.")
+            for key in TOKEN_KEYS:
+                sample("tokens", {"kind": key[:-len("_tokens")]}, analysis.get(key, 0))
+            header("cost_usd", "gauge", "Estimated API cost of the last run in USD.")
+            sample("cost_usd", {}, round(self.cost, 6))
+        if triage:
+            header("triage_escalation_ratio", "gauge", "Share of triaged documents sent on to the larger model.")
+            sample("triage_escalation_ratio", {}, triage["escalation_rate"])
+            header("triage_saved_usd", "gauge", "Estimated saving from triage compared with the larger model only.")
+            sample("triage_saved_usd", {}, triage["saved_usd"])
+        if packing:
+            header("pack_requests_saved", "gauge", "Requests saved by packing short documents together.")
+            sample("pack_requests_saved", {}, packing["requests_saved"])
+
+        header("extract_seconds", "histogram", "Text extraction time per file in the last run.")
+        for name, h in sorted(self.extractors.items()):
+            for bound, count in zip(self.BUCKETS, h["buckets"]):
+                sample("extract_seconds_bucket", {"extractor": name, "le": bound}, count)
+            sample("extract_seconds_bucket", {"extractor": name, "le": "+Inf"}, h["count"])
+            sample("extract_seconds_sum", {"extractor": name}, round(h["seconds"], 3))
+            sample("extract_seconds_count", {"extractor": name}, h["count"])
+
+        for section, counters in sorted(self.counters.items()):
+            numeric = {key: value for key, value in counters.items()
+                       if isinstance(value, (int, float)) and not isinstance(value, bool)}
+            if numeric:
+                header(f"{section}_total", "gauge", f"Counters from {section} in the last run.")
+                for key, value in numeric.items():
+                    sample(f"{section}_total", {"counter": key}, round(value, 3))
+        return "\n".join(lines) + "\n"
+
+    # Skriv JSON-sammanfattningen och, om en sökväg anges, Prometheus-filen.
+    # Båda skrivs atomiskt så att en läsare aldrig ser en halv fil.
+    def write(self, json_path, prometheus_path=None):
+        write_json_atomic(json_path, self.summary())
+        if prometheus_path:
+            tmp_path = f"{prometheus_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, prometheus_path)
+
+# Extraktionsprocesserna ignorerar Ctrl-C; huvudprocessen bestämmer när de ska sluta
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class ExtractionFailed(Exception):
+    def __init__(self, filepath, reason):
+        super().__init__(f"Extraktionen misslyckades ({reason})")
+        self.filepath = filepath
+        self.reason = reason
+
+# Arbetsprocess för textextraktion. Minnet begränsas med RLIMIT_AS (finns
+# inte på Windows), så att en PDF som sväller ger MemoryError här i stället
+# för att tränga undan allt annat. Efter ett minnesfel avslutas processen
+# och poolen startar en ny.
+def _extraction_worker(conn, config, memory_mb):
+    _ignore_sigint()
+    if memory_mb:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        filepath, signed = task
+        try:
+            conn.send(("ok", read_file_signed(filepath, config, signed)))
+        except NeedsLibreOffice:
+            conn.send(("libreoffice", None))
+        except MemoryError:
+            conn.send(("oom", None))
+            return
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+# Isolerade arbetsprocesser för textextraktion (pypdf m.fl. är CPU-tunga
+# och blockerar annars GIL:en). Varje fil får högst `timeout` sekunder;
+# svarar processen inte i tid dödas den och filen räknas som misslyckad
+# (timeout). En process som får slut på minne (`memory_mb`) eller kraschar
+# ersätts med en ny, och varje process startas om efter `recycle` filer så
+# att läckor inte växer under en hel körning. En tråd per process skickar
+# filerna och väntar på svaren; submit() ger en Future med
+# (text, signatur, sekunder) eller ExtractionFailed/NeedsLibreOffice.
+class ExtractionPool:
+    def __init__(self, config, workers=1, timeout=120, memory_mb=2048, recycle=200):
+        self.config = config
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.recycle = recycle
+        self.queue = queue.Queue()
+        self.threads = []
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.error = None
+        self.stats = {"started": 0, "recycled": 0, "timeout": 0, "oom": 0, "crashed": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, filepath, signed=False):
+        future = Future()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        with self.lock:
+            if not self.threads and not self.closed:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._run, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put((filepath, signed, future))
+        return future
+
+    # Döda processerna direkt; köade filer som inte hunnit skickas avbryts
+    def close(self):
+        with self.lock:
+            self.closed = True
+            threads, self.threads = self.threads, []
+            for process in list(self.processes):
+                process.kill()
+        for _ in threads:
+            self.queue.put(None)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[2].cancel()
+
+    # Det gick inte att starta en arbetsprocess (t.ex. saknat
+    # if __name__ == "__main__"-skydd med spawn): filen och alla köade filer
+    # får felet i stället för att vänta för evigt, liksom senare submit()
+    def _fail(self, future, error):
+        with self.lock:
+            self.error = error
+        future.set_exception(error)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                self.queue.put(None)
+                return
+            if item[2].set_running_or_notify_cancel():
+                item[2].set_exception(error)
+
+    def _start(self, context):
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_extraction_worker, args=(child_conn, self.config, self.memory_mb),
+                                  daemon=True)
+        process.start()
+        child_conn.close()
+        with self.lock:
+            self.processes.add(process)
+            self.stats["started"] += 1
+            if self.closed:
+                process.kill()
+        return process, conn
+
+    def _stop(self, process, conn, kill=False):
+        if kill:
+            process.kill()
+        else:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+        with self.lock:
+            self.processes.discard(process)
+
+    def _run(self):
+        import multiprocessing
+
+        # spawn även på Linux: en fork av en process med trådar kan ärva låsta lås
+        context = multiprocessing.get_context("spawn")
+        process, conn, done = None, None, 0
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None or self.closed:
+                    return
+                filepath, signed, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if process is not None and done >= self.recycle:
+                    self._stop(process, conn)
+                    process = None
+                    with self.lock:
+                        self.stats["recycled"] += 1
+                if process is None:
+                    try:
+                        process, conn = self._start(context)
+                    except Exception as e:
+                        self._fail(future, e)
+                        return
+                    done = 0
+                done += 1
+
+                try:
+                    conn.send((filepath, signed))
+                    status, payload = conn.recv() if conn.poll(self.timeout) else ("timeout", None)
+                except (EOFError, OSError):
+                    status, payload = "crashed", None
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+
+                if status == "ok":
+                    future.set_result(payload)
+                elif status == "libreoffice":
+                    future.set_exception(NeedsLibreOffice(filepath))
+                elif status == "error":
+                    future.set_exception(Exception(payload))
+                else:
+                    # Processen har hängt sig, slutat svara eller avslutats
+                    self._stop(process, conn, kill=status != "oom")
+                    process = None
+                    if self.closed:
+                        return  # dödad av close(); ingen väntar på svaret
+                    with self.lock:
+                        self.stats[status] += 1
+                    future.set_exception(ExtractionFailed(filepath, status))
+        finally:
+            if process is not None:
+                self._stop(process, conn, kill=self.closed)
+
+# Extraktionspoolen enligt config: timeout per fil, minnesgräns per process
+# och antal filer innan processen startas om
+def extraction_pool(config, extract_workers):
+    return ExtractionPool(
+        config,
+        extract_workers,
+        config.get("extract_timeout", 120),
+        config.get("extract_memory_mb", 2048),
+        config.get("extract_recycle", 200),
+    )
+
+# Skriv en färdig analys till cachen och filen till loggen
+def record_analysis(log, filepath, file_hash, analysis, metrics=None):
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.stage("log_write"):
+        log.record(filepath, file_hash, analysis)
+    print(f"  ✓ {analysis.get('author', 'Okänd')} – {analysis.get('title', 'Utan titel')}")
+
+# Analysera filerna i två steg: textextraktion i en processpool med
+# `extract_workers` processer, och högst `workers` samtidiga anrop till
+# Claude i en trådpool. Extraktionen av kommande dokument pågår medan
+# tidigare dokument analyseras. Högst `queue_size` extraherade texter
+# väntar på ett ledigt anrop, så minnet hålls begränsat även för enorma mappar.
+# Filer vars innehåll redan finns i cachen, eller som är kopior av en fil
+# som analyseras just nu, kostar inget anrop.
+# Med en TextCache hoppas extraktionen över för innehåll som lästs förut.
+# Med ett NearDuplicateIndex återanvänds analysen för texter som är nästan
+# identiska med ett redan analyserat (eller pågående) dokument.
+# Extraktions- och anropstider, tokens och kostnad registreras i `metrics`.
+# Med en WorkQueue analyseras bara innehåll som ingen annan arbetare har
+# tagit; det som andra har analyserat hämtas från kön.
+# Med pack_max_tokens i config.yaml samlas korta utdrag och skickas flera
+# i samma anrop (upp till pack_budget tokens och pack_size dokument);
+# dokument som saknas i svaret analyseras var för sig.
+# Ctrl-C slutar skicka nya anrop men sparar de som redan är på väg;
+# ett andra Ctrl-C avbryter direkt
+def run_analysis(client, files, config, log, stats, lo_pool, workers=1, extract_workers=1, queue_size=None,
+                 limiter=None, near_index=None, text_cache=None, metrics=None, work_queue=None):
+    metrics = metrics if metrics is not None else Metrics()
+    queue_size = queue_size or 2 * workers
+    results = []
+    remaining = iter(files)
+    extracting = {}
+    converting = {}
+    held = None
+    ready = deque()
+    analyzing = {}
+    pack = []
+    pack_tokens = 0
+    packs = {}
+    pack_max = config.get("pack_max_tokens") or 0
+    pack_size = config.get("pack_size") or 8
+    pack_budget = config.get("pack_budget") or pack_max * pack_size
+    copies = {}
+    near_copies = {}
+    leased = deque()
+    rechecked = 0.0
+    waiting_note = 0
+    completed = 0
+    stopping = False
+    extractor = extraction_pool(config, extract_workers)
+    metrics.counters["extraction"] = extractor.stats
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def record(filepath, file_hash, analysis):
+        results.append({**analysis, "filepath": filepath})
+        record_analysis(log, filepath, file_hash, analysis, metrics)
+
+    def progress(filepaths, note=""):
+        nonlocal completed
+        completed += len(filepaths)
+        print(f"[{completed}/{len(files)}] {', '.join(Path(fp).name for fp in filepaths)}{note}")
+
+    # Dela en färdig analys med de andra arbetarna i kön
+    def share(filepath, file_hash, analysis):
+        if work_queue is not None:
+            work_queue.complete(file_hash, filepath, analysis)
+
+    def release(file_hash):
+        if work_queue is not None:
+            work_queue.release(file_hash)
+
+    # Om filen ska analyseras här: inte redan i cachen, inte en kopia av en
+    # fil som är på väg, inte misslyckad tidigare och (med arbetskö) inte
+    # analyserad eller tagen av en annan arbetare
+    def needs_analysis(filepath, file_hash):
+        cached = log.analysis(file_hash)
+        if cached is not None:
+            stats["hits"] += 1
+            progress([filepath], " (oförändrat innehåll, från cache)")
+            record(filepath, file_hash, cached)
+            return False
+        if file_hash in copies:
+            stats["hits"] += 1
+            copies[file_hash].append(filepath)
+            return False
+        reason = log.failure(file_hash)
+        if reason is not None:
+            stats["failed_skipped"] += 1
+            progress([filepath], f" (misslyckades tidigare: {reason}, hoppas över)")
+            return False
+        if work_queue is not None:
+            state, analysis = work_queue.claim(file_hash, filepath)
+            if state == "done":
+                stats["hits"] += 1
+                progress([filepath], " (analyserad av en annan arbetare)")
+                record(filepath, file_hash, analysis)
+                return False
+            if state == "leased":
+                leased.append((filepath, file_hash))
+                return False
+        stats["misses"] += 1
+        copies[file_hash] = []
+        return True
+
+    # Nästa fil som inte redan finns i cachen eller är på väg
+    def next_uncached():
+        for filepath in remaining:
+            try:
+                file_hash = hash_file(filepath, stats)
+            except OSError as e:
+                progress([filepath])
+                print(f"  Kunde inte läsa {filepath}: {e}")
+                continue
+            if needs_analysis(filepath, file_hash):
+                return filepath, file_hash
+        return next_leased()
+
+    # Filer som andra arbetare har tagit prövas igen när resten är
+    # genomgånget, högst var QUEUE_POLL sekund: då är de klara, eller så har
+    # leasen gått ut (arbetaren har kraschat) och filen tas över
+    def next_leased():
+        nonlocal rechecked, waiting_note
+        while leased:
+            wait_for = rechecked + QUEUE_POLL - time.monotonic()
+            if wait_for > 0:
+                if extracting or converting or ready or analyzing or pack or packs:
+                    return None
+                if waiting_note != len(leased):
+                    waiting_note = len(leased)
+                    print(f"Väntar på {len(leased)} filer som analyseras av andra arbetare...")
+                time.sleep(wait_for)
+            rechecked = time.monotonic()
+            for _ in range(len(leased)):
+                item = leased.popleft()
+                if needs_analysis(*item):
+                    # Fortsätt gå igenom resten direkt vid nästa anrop
+                    rechecked = 0.0
+                    return item
+        return None
+
+    # SDW-filer går direkt till LibreOffice-poolen, som behöver många filer
+    # i kö för att kunna konvertera dem i satser; övriga till processpoolen
+    def fill():
+        nonlocal held
+        while ready and len(analyzing) + len(packs) < workers:
+            item = ready.popleft()
+            if pack_max and estimate_tokens(item[2]) <= pack_max:
+                add_to_pack(item)
+            else:
+                submit(*item)
+        while not stopping and len(ready) < queue_size:
+            item, held = held or next_uncached_text(), None
+            if item is None:
+                break
+            if Path(item[0]).suffix.lower() == ".sdw":
+                if len(converting) >= lo_pool.capacity:
+                    held = item
+                    break
+                converting[lo_pool.submit(item[0])] = item
+            else:
+                if len(extracting) >= extract_workers:
+                    held = item
+                    break
+                future = extractor.submit(item[0], near_index is not None)
+                extracting[future] = item
+        # Inget mer kommer från extraktionen: skicka det som väntar på att packas
+        if pack and not (ready or extracting or converting) and len(analyzing) + len(packs) < workers:
+            send_pack()
+
+    # `prior` är förbrukningen från ett packat anrop där dokumentet saknades
+    # i svaret; den räknas in när dokumentet har analyserats för sig
+    def submit(filepath, file_hash, content, signature, prior=None):
+        future = executor.submit(analyze_content, client, filepath, content, config, limiter)
+        analyzing[future] = (filepath, file_hash, signature, prior)
+
+    # Samla korta utdrag; packen skickas när nästa inte får plats. Filnamnen
+    # är nycklar i svaret och måste vara olika inom en pack.
+    def add_to_pack(item):
+        nonlocal pack_tokens
+        tokens = estimate_tokens(item[2])
+        name = Path(item[0]).name
+        if pack and (pack_tokens + tokens > pack_budget or any(Path(fp).name == name for fp, *_ in pack)):
+            send_pack()
+        pack.append(item)
+        pack_tokens += tokens
+        if len(pack) >= pack_size:
+            send_pack()
+
+    def send_pack():
+        nonlocal pack_tokens
+        if len(pack) == 1:
+            submit(*pack[0])
+        else:
+            documents = [(filepath, content) for filepath, _, content, _ in pack]
+            packs[executor.submit(analyze_pack, client, documents, config, limiter)] = list(pack)
+        pack.clear()
+        pack_tokens = 0
+
+    # Nästa fil som behöver extraheras; filer vars text finns i textcachen
+    # går direkt vidare utan att läsas
+    def next_uncached_text():
+        while True:
+            item = next_uncached()
+            if item is None or text_cache is None:
+                return item
+            hit = text_cache.get(item[1], item[0])
+            if hit is None:
+                return item
+            content, signature = hit
+            if near_index is not None and signature is None:
+                signature = text_signature(content)
+            accept(*item, content, signature)
+
+    # Spara en nära kopia med källans analys (och kopior med samma innehåll)
+    def record_near(filepath, file_hash, signature, source_path, analysis, similarity):
+        same_content = [filepath] + copies.pop(file_hash)
+        progress(same_content, f" (nästan identisk med {Path(source_path).name}, {similarity:.0%})")
+        stats["near_duplicates"] += 1
+        linked = linked_analysis(analysis, source_path, similarity)
+        for fp in same_content:
+            record(fp, file_hash, linked)
+        share(filepath, file_hash, linked)
+        log.save_signature(file_hash, signature)
+        near_index.add(file_hash, signature)
+
+    def extracted(future, filepath, file_hash, signed=False):
+        signature = None
+        try:
+            content = future.result()
+            if signed:
+                content, signature, seconds = content
+                metrics.extraction(filepath, seconds, len(content or ""))
+            else:
+                metrics.extraction(filepath, lo_pool.timings.pop(filepath, 0.0), len(content or ""), "libreoffice")
+                if near_index is not None:
+                    signature = text_signature(content)
+        except NeedsLibreOffice:
+            converting[lo_pool.submit(filepath)] = (filepath, file_hash)
+            return
+        except ExtractionFailed as e:
+            # Sparas i loggen och försöks bara igen med --retry-failed
+            stats["extraction_failed"] += 1
+            log.record_failure(filepath, file_hash, e.reason)
+            release(file_hash)
+            progress([filepath] + copies.pop(file_hash))
+            print(f"  ✗ {e}")
+            return
+        except Exception as e:
+            print(f"  Kunde inte läsa {filepath}: {e}")
+            content = None
+        if text_cache is not None and content:
+            text_cache.put(file_hash, content, signature)
+        accept(filepath, file_hash, content, signature)
+
+    # Ta emot extraherad text: hoppa över tomma filer, återanvänd analysen
+    # för nära kopior och köa resten för analys
+    def accept(filepath, file_hash, content, signature):
+        if not content or len(content.strip()) < 50:
+            release(file_hash)
+            progress([filepath] + copies.pop(file_hash))
+            print("  Hoppar över – tomt eller oläsbart innehåll")
+            return
+
+        match = near_index.find(signature) if near_index is not None else None
+        if match is not None:
+            source_hash, similarity = match
+            if source_hash in near_copies:
+                # Källan analyseras just nu; vänta in dess resultat
+                near_copies[source_hash].append((filepath, file_hash, signature, similarity))
+                return
+            # Källan måste finnas kvar i loggen och vara en annan fil, inte
+            # den här filens tidigare innehåll
+            source_path = log.path_for(source_hash)
+            cached = log.analysis(source_hash)
+            if cached is not None and source_path is not None and source_path != filepath:
+                record_near(filepath, file_hash, signature, source_path, cached, similarity)
+                return
+        if near_index is not None and signature is not None:
+            near_index.add(file_hash, signature)
+            near_copies[file_hash] = []
+        ready.append((filepath, file_hash, prepare_content(content, config, stats), signature))
+
+    def analyzed(future, filepath, file_hash, signature, prior=None):
+        try:
+            analysis, usage = future.result()
+        except Exception as e:
+            # Triageanrop och packade anrop före felet kostade ändå
+            spent = dict(getattr(e, "usage", None) or {})
+            if prior:
+                add_usage(spent, prior)
+            if any(spent.get(key) or spent.get(f"triage_{key}") for key in TOKEN_KEYS):
+                add_usage(stats, spent)
+                metrics.analysis(filepath, spent)
+            failed(filepath, file_hash, e)
+            return
+        if prior:
+            add_usage(usage, prior)
+        add_usage(stats, usage)
+        metrics.analysis(filepath, usage)
+        finish(filepath, file_hash, signature, analysis)
+
+    # Fördela svaret på ett packat anrop på dokumenten. De som saknas i
+    # svaret, eller alla om anropet misslyckades, analyseras var för sig.
+    def packed(future, items):
+        try:
+            analyses, usage = future.result()
+        except Exception as e:
+            add_usage(stats, {"pack_failed": 1})
+            print(f"  Packat anrop med {len(items)} dokument misslyckades ({e}) – analyseras var för sig")
+            analyses, parts = {}, [None] * len(items)
+        else:
+            parts = split_usage(usage, [estimate_tokens(content) for _, _, content, _ in items])
+        missing = 0
+        for (filepath, file_hash, content, signature), part in zip(items, parts):
+            analysis = analyses.get(Path(filepath).name)
+            if analysis is not None:
+                add_usage(stats, part)
+                metrics.analysis(filepath, part)
+                finish(filepath, file_hash, signature, analysis)
+                continue
+            missing += 1
+            if part is not None:
+                part["pack_fallback"] = 1
+            if stopping:
+                if part is not None:
+                    add_usage(stats, part)
+                release(file_hash)
+            else:
+                submit(filepath, file_hash, content, signature, part)
+        if missing and parts[0] is not None:
+            print(f"  {missing} av {len(items)} dokument saknades i det packade svaret – analyseras var för sig")
+
+    def failed(filepath, file_hash, error):
+        same_content = [filepath] + copies.pop(file_hash)
+        waiting = near_copies.pop(file_hash, [])
+        progress(same_content)
+        stats["failed"] += 1
+        print(f"  ✗ Fel vid analys: {error}")
+        release(file_hash)
+        # Nära kopior försöker igen nästa körning
+        for near_path, near_hash, _, _ in waiting:
+            release(near_hash)
+            progress([near_path] + copies.pop(near_hash), " (hoppas över – källan kunde inte analyseras)")
+
+    def finish(filepath, file_hash, signature, analysis):
+        same_content = [filepath] + copies.pop(file_hash)
+        waiting = near_copies.pop(file_hash, [])
+        progress(same_content)
+        for fp in same_content:
+            record(fp, file_hash, analysis)
+        share(filepath, file_hash, analysis)
+        if signature is not None:
+            log.save_signature(file_hash, signature)
+        for near_path, near_hash, near_signature, similarity in waiting:
+            record_near(near_path, near_hash, near_signature, filepath, analysis, similarity)
+
+    def drain(timeout):
+        # Kort timeout så att Ctrl-C hinner fram även på Windows
+        done, _ = wait([*extracting, *converting, *analyzing, *packs], timeout=timeout,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in extracting:
+                extracted(future, *extracting.pop(future), signed=True)
+            elif future in converting:
+                extracted(future, *converting.pop(future))
+            elif future in packs:
+                packed(future, packs.pop(future))
+            else:
+                analyzed(future, *analyzing.pop(future))
+
+    try:
+        fill()
+        while extracting or converting or ready or analyzing or pack or packs:
+            drain(0.5)
+            fill()
+    except KeyboardInterrupt:
+        stopping = True
+        # Nära kopior som väntar på en källa räknas inte som klara
+        near_copies.clear()
+        for future in [*extracting, *converting]:
+            future.cancel()
+        extracting.clear()
+        converting.clear()
+        ready.clear()
+        pack.clear()
+        print(f"\nAvbryter – väntar på {len(analyzing) + len(packs)} pågående anrop "
+              f"(Ctrl-C igen för att avbryta direkt)...")
+        try:
+            while analyzing or packs:
+                drain(0.5)
+        except KeyboardInterrupt:
+            print(f"Avbrutet. {len(analyzing) + len(packs)} pågående anrop kastas.")
+            raise
+    finally:
+        if limiter is not None:
+            limiter.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+        extractor.close()
+        # Det som inte hann analyseras lämnas tillbaka till kön
+        if work_queue is not None:
+            work_queue.close()
+
+    return results
+
+# Extrahera text för (filväg, hash)-par i processpoolen (SDW och
+# odfpy-fallbacks i LibreOffice-poolen), högst `ahead` filer i förväg.
+# Ger (filväg, hash, text, signatur) i den ordning de blir klara; med
+# `signed` beräknas MinHash-signaturen för texten, annars är den None.
+# Filer vars extraktion misslyckas (timeout, minne) sparas i `log` och
+# ges inte vidare.
+def extract_ahead(items, config, lo_pool, extract_workers, ahead=None, signed=False, text_cache=None,
+                  metrics=None, log=None):
+    metrics = metrics if metrics is not None else Metrics()
+    ahead = ahead or 2 * extract_workers + lo_pool.capacity
+    items = iter(items)
+    pending = {}
+    with extraction_pool(config, extract_workers) as extractor:
+        metrics.counters["extraction"] = extractor.stats
+        while True:
+            for item in items:
+                hit = text_cache.get(item[1], item[0]) if text_cache is not None else None
+                if hit is not None:
+                    content, signature = hit
+                    if signed and signature is None:
+                        signature = text_signature(content)
+                    yield *item, content, signature
+                    continue
+                if Path(item[0]).suffix.lower() == ".sdw":
+                    pending[lo_pool.submit(item[0])] = item
+                else:
+                    pending[extractor.submit(item[0], signed)] = item
+                if len(pending) >= ahead:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath, file_hash = pending.pop(future)
+                signature = None
+                try:
+                    content = future.result()
+                    if isinstance(content, tuple):
+                        content, signature, seconds = content
+                        metrics.extraction(filepath, seconds, len(content or ""))
+                    else:
+                        seconds = lo_pool.timings.pop(filepath, 0.0)
+                        metrics.extraction(filepath, seconds, len(content or ""), "libreoffice")
+                        if signed:
+                            signature = text_signature(content)
+                except NeedsLibreOffice:
+                    pending[lo_pool.submit(filepath)] = (filepath, file_hash)
+                    continue
+                except ExtractionFailed as e:
+                    print(f"  ✗ {Path(filepath).name}: {e}")
+                    if log is not None:
+                        log.record_failure(filepath, file_hash, e.reason)
+                    continue
+                except Exception as e:
+                    print(f"  Kunde inte läsa {filepath}: {e}")
+                    content = None
+                if text_cache is not None and content:
+                    text_cache.put(file_hash, content, signature)
+                yield filepath, file_hash, content, signature
+
+# Läs in väntande batcher (batch-id → custom_id → filväg)
+def load_batches(batch_path):
+    if Path(batch_path).exists():
+        with open(batch_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+# Spara väntande batcher
+def save_batches(batch_path, batches):
+    write_json_atomic(batch_path, batches)
+
+# Hämta resultat från avslutade batcher och skriv in dem i loggen
+# custom_id är "doc-" + innehållshashen, så samma innehåll skickas bara en gång
+def collect_batches(client, batches, batch_path, log, stats, default_author="", metrics=None):
+    metrics = metrics if metrics is not None else Metrics()
+    results = []
+    for batch_id in list(batches):
+        requests = batches[batch_id]["requests"]
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            counts = batch.request_counts
+            print(f"Batch {batch_id}: pågår ({counts.succeeded + counts.errored}/{len(requests)} klara)")
+            continue
+
+        print(f"Batch {batch_id}: klar, hämtar {len(requests)} resultat")
+        for entry in client.messages.batches.results(batch_id):
+            filepath = requests.get(entry.custom_id)
+            if filepath is None:
+                continue
+            print(f"{Path(filepath).name}")
+            if entry.result.type != "succeeded":
+                # Som misslyckade extraktioner: hoppas över tills filen
+                # ändras eller körs om med --retry-failed
+                stats["failed"] += 1
+                log.record_failure(filepath, entry.custom_id[4:], f"batch_{entry.result.type}")
+                print(f"  ✗ Fel vid analys: {entry.result.type}")
+                continue
+            try:
+                usage = {}
+                analysis = analysis_from_message(entry.result.message, default_author, usage)
+                add_usage(stats, usage)
+                metrics.analysis(filepath, usage, batch=True)
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"  ✗ Fel vid analys: {e}")
+                continue
+            results.append({**analysis, "filepath": filepath})
+            record_analysis(log, filepath, entry.custom_id[4:], analysis, metrics)
+
+        # Dokument vars svar inte gick att tolka plockas upp av nästa --batch-körning
+        del batches[batch_id]
+        save_batches(batch_path, batches)
+    return results
+
+# Skicka filerna som Message Batches, högst batch_size dokument per batch
+# Varje batch sparas direkt efter att den skapats så att en omstart
+# aldrig skickar samma dokument två gånger
+def submit_batches(client, files, config, batches, batch_path, log, stats, lo_pool, batch_size=1000,
+                   extract_workers=1, near_index=None, text_cache=None, metrics=None):
+    metrics = metrics if metrics is not None else Metrics()
+    model = config["anthropic"]["model"]
+    max_tokens = config["anthropic"]["max_tokens"]
+    requests = {}
+
+    def flush():
+        batch = client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": params,
+            }
+            for custom_id, (filepath, params) in requests.items()
+        ])
+        batches[batch.id] = {
+            "submitted": datetime.now().isoformat(),
+            "requests": {custom_id: filepath for custom_id, (filepath, params) in requests.items()},
+        }
+        save_batches(batch_path, batches)
+        print(f"Batch {batch.id} skickad med {len(requests)} dokument")
+        requests.clear()
+
+    # Hasha och sortera bort cachat innehåll innan något extraheras
+    def uncached():
+        for i, filepath in enumerate(files, 1):
+            print(f"[{i}/{len(files)}] Förbereder: {Path(filepath).name}")
+            try:
+                file_hash = hash_file(filepath, stats)
+            except OSError as e:
+                print(f"  Kunde inte läsa {filepath}: {e}")
+                continue
+            cached = log.analysis(file_hash)
+            if cached is not None:
+                stats["hits"] += 1
+                print("  Oförändrat innehåll, från cache")
+                record_analysis(log, filepath, file_hash, cached, metrics)
+                continue
+            reason = log.failure(file_hash)
+            if reason is not None:
+                stats["failed_skipped"] += 1
+                print(f"  Misslyckades tidigare ({reason}), hoppas över")
+                continue
+            custom_id = f"doc-{file_hash}"
+            if custom_id in queued or any(custom_id in batch["requests"] for batch in batches.values()):
+                stats["hits"] += 1
+                print("  Samma innehåll väntar redan i en batch")
+                continue
+            stats["misses"] += 1
+            queued.add(custom_id)
+            yield filepath, file_hash
+
+    queued = set()
+    signed = near_index is not None
+    for filepath, file_hash, content, signature in extract_ahead(uncached(), config, lo_pool, extract_workers,
+                                                                 signed=signed, text_cache=text_cache,
+                                                                 metrics=metrics, log=log):
+        if not content or len(content.strip()) < 50:
+            print(f"  Hoppar över – tomt eller oläsbart innehåll: {Path(filepath).name}")
+            continue
+        # Nära kopior av redan analyserade dokument skickas inte; kopior av
+        # dokument i samma batch jämförs först nästa körning
+        match = near_index.find(signature) if signed else None
+        source_path = log.path_for(match[0]) if match is not None else None
+        if source_path is not None and source_path != filepath:
+            print(f"  Nästan identisk med {Path(source_path).name} ({match[1]:.0%}), återanvänder analysen")
+            stats["near_duplicates"] += 1
+            linked = linked_analysis(log.analysis(match[0]), source_path, match[1])
+            record_analysis(log, filepath, file_hash, linked, metrics)
+            log.save_signature(file_hash, signature)
+            near_index.add(file_hash, signature)
+            continue
+        if signature is not None:
+            log.save_signature(file_hash, signature)
+        excerpt = prepare_content(content, config, stats)
+        requests[f"doc-{file_hash}"] = (filepath, request_params(model, max_tokens, filepath, excerpt))
+        if len(requests) >= batch_size:
+            flush()
+    if requests:
+        flush()
+
+# Matcha ett fil- eller mappnamn, eller sökvägen relativt rotmappen, mot glob-mönster
+def _matches(name, relpath, patterns):
+    return any(fnmatch(name, pattern) or fnmatch(relpath, pattern) for pattern in patterns)
+
+# Lista en mapp: (undermappar, [(filnamn, storlek, mtime, inode)])
+def _list_dir(dirpath, root, extensions, include, exclude, skip_dirs):
+    subdirs, files = [], []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            relpath = os.path.relpath(entry.path, root).replace(os.sep, "/")
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in skip_dirs and not _matches(entry.name, relpath, exclude):
+                    subdirs.append(entry.name)
+            elif entry.is_file():
+                if os.path.splitext(entry.name)[1].lower() not in extensions:
+                    continue
+                if _matches(entry.name, relpath, exclude):
+                    continue
+                if include and not _matches(entry.name, relpath, include):
+                    continue
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime_ns, entry.inode()))
+    return subdirs, files
+
+# Stat:a filerna i en mapp vars innehållsförteckning inte ändrats
+def _stat_known(dirpath, filenames):
     files = []
+    for name in filenames:
+        st = os.stat(os.path.join(dirpath, name))
+        files.append((name, st.st_size, st.st_mtime_ns, st.st_ino))
+    return files
+
+# Skanna mapparna mot katalogindexet i loggen. Mappar vars mtime inte
+# ändrats sedan förra körningen listas inte om; bara deras kända filer
+# stat:as för att hitta ändrade filer. Returnerar nya, ändrade,
+# oförändrade och borttagna filvägar.
+def scan_folders(folders, extensions, log, include=None, exclude=None, skip_dirs=()):
+    include = include or []
+    exclude = exclude or []
+    skip_dirs = set(skip_dirs)
+    fingerprint = json.dumps([sorted(extensions), include, exclude, sorted(skip_dirs)])
+    known_files = log.scan_index()
+    known_dirs = log.dir_index()
+    new, changed, unchanged = [], [], []
+    file_rows, dir_rows = [], []
+    seen_dirs = set()
+    roots, unreadable = [], []
+
     for folder in folders:
-        for root, dirs, filenames in os.walk(folder):
-            # Hoppa över analyzer-mappar
-            dirs[:] = [d for d in dirs if d != "analyzer"]
-            for filename in filenames:
-                filepath = str(Path(root) / filename)
-                if Path(filepath).suffix.lower() in extensions:
-                    if filepath not in log:
-                        files.append(filepath)
-                    else:
-                        print(f"  Hoppar över (redan processad): {filename}")
+        root = str(Path(folder))
+        if not os.path.isdir(root):
+            print(f"  Varning: mappen {root} finns inte – hoppar över")
+            continue
+        roots.append(root)
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                dir_mtime = os.stat(dirpath).st_mtime_ns
+                cached = known_dirs.get(dirpath)
+                try:
+                    if not cached or cached[0] != dir_mtime or cached[3] != fingerprint:
+                        raise FileNotFoundError
+                    subdirs, files = cached[1], _stat_known(dirpath, cached[2])
+                except FileNotFoundError:
+                    subdirs, files = _list_dir(dirpath, root, extensions, include, exclude, skip_dirs)
+            except OSError as e:
+                print(f"  Kunde inte läsa mappen {dirpath}: {e}")
+                unreadable.append(dirpath)
+                continue
+
+            seen_dirs.add(dirpath)
+            dir_rows.append((dirpath, dir_mtime, json.dumps(subdirs), json.dumps([f[0] for f in files]), fingerprint))
+            for name, size, mtime_ns, inode in files:
+                filepath = os.path.join(dirpath, name)
+                file_rows.append((filepath, size, mtime_ns, inode))
+                previous = known_files.get(filepath)
+                if previous is None:
+                    new.append(filepath)
+                elif previous != (size, mtime_ns, inode):
+                    changed.append(filepath)
+                else:
+                    unchanged.append(filepath)
+            stack.extend(os.path.join(dirpath, d) for d in reversed(subdirs))
+
+    # Borttaget = känt under en skannad rotmapp men inte sett nu. Filer i
+    # mappar som inte gick att läsa räknas inte som borttagna.
+    def vanished(path):
+        return (
+            any(path.startswith(root + os.sep) for root in roots)
+            and not any(path == d or path.startswith(d + os.sep) for d in unreadable)
+        )
+
+    seen_files = {row[0] for row in file_rows}
+    deleted = [p for p in set(known_files) | set(log.paths()) if p not in seen_files and vanished(p)]
+    stale_dirs = [d for d in known_dirs if d not in seen_dirs and vanished(d)]
+    log.save_scan(file_rows, dir_rows, deleted, stale_dirs)
+    return new, changed, unchanged, deleted
+
+# Hitta alla filer att processa: nya filer, ändrade filer och filer som
+# ännu inte analyserats. Ändrade och borttagna filer tas bort ur loggen.
+def find_files(folders, extensions, log, include=None, exclude=None, skip_dirs=()):
+    started = time.perf_counter()
+    new, changed, unchanged, deleted = scan_folders(folders, extensions, log, include, exclude, skip_dirs)
+    log.forget(changed + deleted)
+    log.detach_near_duplicates(deleted)
+    done = set(log.paths())
+    files = [fp for fp in new + changed + unchanged if fp not in done]
+    print(f"Skanning klar på {time.perf_counter() - started:.2f} s: {len(new)} nya, {len(changed)} ändrade, "
+          f"{len(unchanged)} oförändrade, {len(deleted)} borttagna")
     return files
 
-# Generera Word-rapport
-def generate_word_report(results, output_path, folder_name=""):
-    from docx import Document as DocxDocument
-    from docx.shared import Pt, RGBColor
-    from docx.enum.text import WD_ALIGN_PARAGRAPH
+XML_INVALID = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Ett stycke i WordprocessingML; radbrytningar i texten blir <w:br/>
+def ooxml_paragraph(text="", style=None, italic=False, small=False, center=False):
+    props = (f'<w:pStyle w:val="{style}"/>' if style else "") + ('<w:jc w:val="center"/>' if center else "")
+    run_props = ("<w:i/>" if italic else "") + ('<w:color w:val="808080"/><w:sz w:val="18"/>' if small else "")
+    xml = "<w:p>" + (f"<w:pPr>{props}</w:pPr>" if props else "")
+    if text:
+        lines = XML_INVALID.sub("", str(text)).split("\n")
+        xml += "<w:r>" + (f"<w:rPr>{run_props}</w:rPr>" if run_props else "")
+        xml += "<w:br/>".join(f'<w:t xml:space="preserve">{escape(line)}</w:t>' for line in lines)
+        xml += "</w:r>"
+    return xml + "</w:p>"
+
+# Rendera ett dokuments avsnitt i rapporten. Fragmenten cachas i loggen
+# per fil och hash, så bara nya och ändrade dokument renderas om.
+def report_fragment(item, folder_name=""):
+    file_folder = Path(item["filepath"]).parent.name
+
+    # Nära kopia av ett annat dokument (analysen återanvänd): en rad under
+    # källan i stället för ett eget avsnitt
+    if item.get("near_duplicate_of"):
+        similarity = item.get("similarity") or 0
+        folder = f", mapp {file_folder}" if file_folder != folder_name else ""
+        return ooxml_paragraph(
+            f"Annan version: {Path(item['filepath']).name}{folder} – {similarity:.0%} lik "
+            f"{Path(item['near_duplicate_of']).name}", small=True
+        )
 
-    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-    if check_file_locked(output_path):
-        print(f"\n⚠️  Kan inte spara rapporten – filen är öppen i Word:")
-        print(f"   {output_path}")
-        print(f"   Stäng filen och tryck Enter för att försöka igen...")
-        input()
-    doc = DocxDocument()
+    # Rubrik
+    parts = [ooxml_paragraph(item.get("title", "Utan titel"), "Heading2")]
 
-    # Titel
-    title = doc.add_heading(f"Analys av innehåll i mappen {folder_name}", 0)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    # Författare och år/datum
+    date_str = item.get("date_full") or item.get("year") or "okänt"
+    parts.append(ooxml_paragraph(f"Författare: {item.get('author', 'Okänd')}  |  År: {date_str}", italic=True))
 
-    # Datum
-    date_para = doc.add_paragraph(f"Genererad: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    date_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    doc.add_paragraph()
+    # Artikelspecifikt: publikation
+    if item.get("type") == "artikel" and item.get("publication"):
+        parts.append(ooxml_paragraph(f"Publikation: {item['publication']}", italic=True))
+
+    # Uppsatsspecifikt: lärosäte
+    if item.get("type") in ("uppsats", "avhandling") and item.get("institution"):
+        inst_str = item["institution"]
+        if item.get("institution_place"):
+            inst_str += f", {item['institution_place']}"
+        if item.get("thesis_type"):
+            inst_str += f" ({item['thesis_type']})"
+        parts.append(ooxml_paragraph(f"Lärosäte: {inst_str}", italic=True))
+
+    # Filnamn
+    parts.append(ooxml_paragraph(f"Fil: {Path(item['filepath']).name}", small=True))
+
+    # Undermapp (om filen inte ligger direkt i rotmappen)
+    if file_folder != folder_name:
+        parts.append(ooxml_paragraph(f"Mapp: {file_folder}", small=True))
 
     # Sammanfattning
-    doc.add_heading(f"Totalt analyserade dokument: {len(results)}", level=2)
-    doc.add_paragraph()
-
-    # Gruppera efter typ
-    by_type = {}
-    for r in results:
-        t = r.get("type", "övrigt")
-        by_type.setdefault(t, []).append(r)
-
-    for doc_type, items in sorted(by_type.items()):
-        doc.add_heading(doc_type.capitalize(), level=1)
-        for item in items:
-            # Rubrik
-            doc.add_heading(item.get("title", "Utan titel"), level=2)
-
-            # Författare och år/datum
-            date_str = item.get("date_full") or item.get("year") or "okänt"
-            meta = f"Författare: {item.get('author', 'Okänd')}  |  År: {date_str}"
-            p = doc.add_paragraph(meta)
-            p.runs[0].italic = True
-
-            # Artikelspecifikt: publikation
-            if item.get("type") == "artikel" and item.get("publication"):
-                pub = doc.add_paragraph(f"Publikation: {item['publication']}")
-                pub.runs[0].italic = True
-
-            # Uppsatsspecifikt: lärosäte
-            if item.get("type") in ("uppsats", "avhandling") and item.get("institution"):
-                inst_str = item["institution"]
-                if item.get("institution_place"):
-                    inst_str += f", {item['institution_place']}"
-                if item.get("thesis_type"):
-                    inst_str += f" ({item['thesis_type']})"
-                ins = doc.add_paragraph(f"Lärosäte: {inst_str}")
-                ins.runs[0].italic = True
-
-            # Filnamn
-            fn = doc.add_paragraph(f"Fil: {Path(item['filepath']).name}")
-            fn.runs[0].font.size = Pt(9)
-            fn.runs[0].font.color.rgb = RGBColor(128, 128, 128)
-
-            # Undermapp (om filen inte ligger direkt i rotmappen)
-            file_folder = Path(item['filepath']).parent.name
-            if file_folder != folder_name:
-                mapp = doc.add_paragraph(f"Mapp: {file_folder}")
-                mapp.runs[0].font.size = Pt(9)
-                mapp.runs[0].font.color.rgb = RGBColor(128, 128, 128)
-
-            # Sammanfattning
-            doc.add_paragraph(item.get("summary", ""))
-            doc.add_paragraph()
+    parts.append(ooxml_paragraph(item.get("summary", "")))
+    parts.append(ooxml_paragraph())
+    return "".join(parts)
+
+# Rapportens innehåll som en ström av OOXML-stycken: titel, datum,
+# sammanfattning och sedan dokumenten grupperade efter typ
+def report_parts(log, folder_name=""):
+    yield ooxml_paragraph(f"Analys av innehåll i mappen {folder_name}", "Title", center=True)
+    yield ooxml_paragraph(f"Genererad: {datetime.now().strftime('%Y-%m-%d %H:%M')}", center=True)
+    yield ooxml_paragraph()
+    yield ooxml_paragraph(f"Totalt analyserade dokument: {log.analysed_count()}", "Heading2")
+    yield ooxml_paragraph()
+    current = None
+    for doc_type, fragment in log.report_fragments(lambda item: report_fragment(item, folder_name)):
+        if doc_type != current:
+            yield ooxml_paragraph(doc_type.capitalize(), "Heading1")
+            current = doc_type
+        yield fragment
+
+# Bygg rapporten med python-docx: standardmallen, med de renderade
+# fragmenten inklistrade före sektionsinställningarna
+def _write_docx_report(parts, output_path):
+    from docx import Document as DocxDocument
+    from docx.oxml import parse_xml
 
+    doc = DocxDocument()
+    sect_pr = doc.element.body.sectPr
+    for part in parts:
+        for element in parse_xml(f'<w:body xmlns:w="{W_NS}">{part}</w:body>'):
+            sect_pr.addprevious(element)
     doc.save(output_path)
+
+OOXML_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+OOXML_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+OOXML_DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+# Samma formatmallar som används i rapporten (motsvarar python-docx standardmall)
+OOXML_STYLES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="{W_NS}">
+<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:cs="Calibri"/><w:sz w:val="22"/></w:rPr></w:rPrDefault>
+<w:pPrDefault><w:pPr><w:spacing w:after="200" w:line="276" w:lineRule="auto"/></w:pPr></w:pPrDefault></w:docDefaults>
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>
+<w:pPr><w:pBdr><w:bottom w:val="single" w:sz="8" w:space="4" w:color="4F81BD"/></w:pBdr><w:spacing w:after="300" w:line="240" w:lineRule="auto"/></w:pPr>
+<w:rPr><w:color w:val="17365D"/><w:spacing w:val="5"/><w:kern w:val="28"/><w:sz w:val="52"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>
+<w:pPr><w:keepNext/><w:keepLines/><w:spacing w:before="480" w:after="0"/><w:outlineLvl w:val="0"/></w:pPr>
+<w:rPr><w:b/><w:bCs/><w:color w:val="365F91"/><w:sz w:val="28"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/>
+<w:pPr><w:keepNext/><w:keepLines/><w:spacing w:before="200" w:after="0"/><w:outlineLvl w:val="1"/></w:pPr>
+<w:rPr><w:b/><w:bCs/><w:color w:val="4F81BD"/><w:sz w:val="26"/></w:rPr></w:style>
+</w:styles>"""
+
+# Skriv .docx-paketet direkt, utan python-docx. document.xml strömmas
+# till zip-filen, så minnet är detsamma oavsett antal dokument.
+def _write_ooxml_report(parts, output_path):
+    tmp_path = f"{output_path}.tmp"
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", OOXML_CONTENT_TYPES)
+        package.writestr("_rels/.rels", OOXML_RELS)
+        package.writestr("word/_rels/document.xml.rels", OOXML_DOCUMENT_RELS)
+        package.writestr("word/styles.xml", OOXML_STYLES)
+        with package.open("word/document.xml", "w") as document:
+            document.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           f'<w:document xmlns:w="{W_NS}"><w:body>'.encode("utf-8"))
+            for part in parts:
+                document.write(part.encode("utf-8"))
+            document.write(b'<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+                           b'<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800" '
+                           b'w:header="720" w:footer="720" w:gutter="0"/></w:sectPr></w:body></w:document>')
+    os.replace(tmp_path, output_path)
+
+# Generera Word-rapport från loggen. Byggs bara om när mängden analyser
+# (eller skrivaren) ändrats sedan förra rapporten. `writer` är "docx"
+# (python-docx) eller "ooxml" (skriver XML direkt, för mycket stora rapporter).
+def generate_word_report(log, output_path, folder_name="", writer="docx"):
+    fingerprint = f"{writer}:{folder_name}:{log.fingerprint()}"
+    if Path(output_path).exists() and log.report_fingerprint(output_path) == fingerprint:
+        print(f"Word-rapporten är oförändrad: {output_path}")
+        return
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    if check_file_locked(output_path):
+        print("\n⚠️  Kan inte spara rapporten – filen är öppen i Word:")
+        print(f"   {output_path}")
+        print("   Stäng filen och tryck Enter för att försöka igen...")
+        input()
+
+    parts = report_parts(log, folder_name)
+    if writer == "ooxml":
+        _write_ooxml_report(parts, output_path)
+    else:
+        _write_docx_report(parts, output_path)
+    log.save_report_fingerprint(output_path, fingerprint)
     print(f"Word-rapport sparad: {output_path}")
 
 # Formatera författarnamn för RIS (efternamn, förnamn)
@@ -270,172 +3160,605 @@ def filepath_to_uri(filepath):
     uri = path.as_uri()
     return uri
 
-# Generera Zotero RIS-export
-def generate_zotero_export(results, output_path):
+NON_CITABLE_TYPES = {"predikan", "övrigt"}
+NON_CITABLE_EXTENSIONS = {".ppt", ".pptx"}
+
+RIS_TYPES = {
+    "artikel": "JOUR",
+    "uppsats": "THES",
+    "avhandling": "THES",
+    "bok": "BOOK",
+    "studie": "RPRT",
+}
+
+def is_citable(item):
+    return (
+        item.get("is_citable")
+        and item.get("type") not in NON_CITABLE_TYPES
+        and Path(item.get("filepath", "")).suffix.lower() not in NON_CITABLE_EXTENSIONS
+    )
+
+# En RIS-post för en analys
+def ris_record(item):
+    lines = []
+    ris_type = RIS_TYPES.get(item.get("type", ""), "GEN")
+    lines.append(f"TY  - {ris_type}")
+    lines.append(f"TI  - {item.get('title', 'Utan titel')}")
+    if item.get("filepath"):
+        lines.append(f"L1  - {filepath_to_uri(item['filepath'])}")
+
+    author = item.get("author", "Okänd")
+    for a in author.split(";"):
+        lines.append(f"AU  - {format_ris_author(a)}")
+
+    # Datum
+    if item.get("date_full"):
+        lines.append(f"DA  - {item['date_full']}")
+    elif item.get("year"):
+        lines.append(f"PY  - {item['year']}")
+
+    # Sammanfattning
+    if item.get("summary"):
+        lines.append(f"N2  - {item['summary']}")
+
+    # Artikelspecifikt
+    if item.get("publication"):
+        lines.append(f"JO  - {item['publication']}")
+
+    # Bokspecifikt
+    if item.get("publisher"):
+        lines.append(f"PB  - {item['publisher']}")
+    if item.get("publisher_place"):
+        lines.append(f"CY  - {item['publisher_place']}")
+    if item.get("isbn"):
+        lines.append(f"SN  - {item['isbn']}")
+    if item.get("pages_total"):
+        lines.append(f"SP  - {item['pages_total']} sidor")
+    if item.get("edition"):
+        lines.append(f"ET  - {item['edition']}")
+
+    # Uppsatsspecifikt
+    if item.get("institution"):
+        lines.append(f"PB  - {item['institution']}")
+    if item.get("institution_place"):
+        lines.append(f"CY  - {item['institution_place']}")
+    if item.get("thesis_type"):
+        lines.append(f"M3  - {item['thesis_type']}")
+
+    lines.append("ER  - ")
+    return "\n".join(lines) + "\n\n"
+
+# Generera Zotero RIS-export. Posterna strömmas från loggen och skrivs
+# en i taget, en per innehållshash. Nära kopior av ett annat dokument
+# hoppas över, så att samma verk inte blir flera poster. Med `delta_path`
+# är exporten inkrementell: bara poster som inte exporterats tidigare
+# läggs till i `output_path`, och samma poster skrivs till `delta_path`
+# för import i Zotero utan dubbletter. Hela filen skrivs om (deltafilen
+# får då fortfarande bara de nya posterna) med `full`, om `output_path`
+# saknas, om förra exporten avbröts eller om exporterade filer har
+# analyserats om eller tagits bort ur loggen.
+def generate_zotero_export(log, output_path, delta_path=None, full=False):
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-    NON_CITABLE_TYPES = {"predikan", "övrigt"}
-    NON_CITABLE_EXTENSIONS = {".ppt", ".pptx"}
-    
-    citable = [
-        r for r in results
-        if r.get("is_citable")
-        and r.get("type") not in NON_CITABLE_TYPES
-        and Path(r.get("filepath", "")).suffix.lower() not in NON_CITABLE_EXTENSIONS
-    ]
-
-    type_map = {
-        "artikel": "JOUR",
-        "uppsats": "THES",
-        "avhandling": "THES",
-        "bok": "BOOK",
-        "studie": "RPRT",
+    rewrite = delta_path is None or full or not Path(output_path).exists() or not log.export_current(output_path)
+    exported = log.exported_hashes() if delta_path else set()
+
+    main_path = f"{output_path}.tmp" if rewrite else output_path
+    if not rewrite:
+        log.begin_export(output_path)
+    count = 0
+    new = []
+    with open(main_path, "w" if rewrite else "a", encoding="utf-8") as f, \
+            open(f"{delta_path}.tmp" if delta_path else os.devnull, "w", encoding="utf-8") as delta:
+        for file_hash, item in log.iter_unique(unexported=not rewrite):
+            if not is_citable(item) or item.get("near_duplicate_of"):
+                continue
+            record = ris_record(item)
+            f.write(record)
+            count += 1
+            if delta_path and file_hash not in exported:
+                delta.write(record)
+                new.append(file_hash)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if rewrite:
+        log.begin_export(output_path)
+        if not count:
+            os.remove(main_path)
+            if Path(output_path).exists():
+                os.remove(output_path)
+            print("Inga citeringsbara poster – RIS-fil skapas inte.")
+        else:
+            os.replace(main_path, output_path)
+            print(f"Zotero RIS-fil sparad: {output_path} ({count} poster)")
+    elif count:
+        print(f"Zotero RIS-fil uppdaterad: {output_path} (+{count} poster)")
+
+    if delta_path:
+        if new:
+            os.replace(f"{delta_path}.tmp", delta_path)
+        else:
+            os.remove(f"{delta_path}.tmp")
+        log.finish_export(output_path, new, rewritten=rewrite)
+        if new:
+            print(f"Nya poster att importera i Zotero: {delta_path} ({len(new)} poster)")
+        else:
+            print("Zotero: inga nya poster sedan förra exporten.")
+
+
+# Claude-klienten. anthropic och API-nyckeln i .env läses först här, så
+# att steg som inte anropar Claude startar snabbt.
+def make_client():
+    import anthropic
+    from dotenv import load_dotenv
+
+    load_dotenv(Path(__file__).parent / ".env")
+    return anthropic.Anthropic()
+
+# Mappen för loggen, textcachen, väntande batcher och mätvärden. Varje
+# dator har en egen, så att en SQLite-fil aldrig skrivs från flera datorer
+# via Dropbox: med data_dir i config (eller --data-dir) en undermapp per
+# analyserad mapp där, annars analyzer/<datornamn> i den analyserade mappen
+def data_dir(config, folder):
+    if config.get("data_dir"):
+        key = hashlib.blake2b(str(folder).encode("utf-8"), digest_size=4).hexdigest()
+        return Path(config["data_dir"]).expanduser() / f"{folder.name}-{key}"
+    import socket
+
+    host = re.sub(r"[^\w.-]", "_", socket.gethostname().lower()) or "dator"
+    return folder / "analyzer" / host
+
+# Utdatafilerna för den analyserade mappen. Rapporten och RIS-filerna
+# hamnar i analyzer-mappen, resten i datorns datamapp (data_dir)
+def output_paths(config):
+    folder = Path(config["folders"][0])
+    folder_name = folder.name
+    base_output = folder / "analyzer"
+    data = data_dir(config, folder)
+    return {
+        "folder_name": folder_name,
+        "base": base_output,
+        "data": data,
+        "log": str(data / "processed_files.db"),
+        "batches": str(data / "pending_batches.json"),
+        "report": str(base_output / f"analys-{folder_name}.docx"),
+        "zotero": str(base_output / f"zotero-import-{folder_name}.ris"),
+        "zotero_delta": str(base_output / f"zotero-import-{folder_name}-nya.ris"),
+        "text_cache": data / "text_cache.db",
+        "metrics": data / "metrics.json",
+        "profile": data / "profile.prof",
     }
 
-    lines = []
-    for item in citable:
-        ris_type = type_map.get(item.get("type", ""), "GEN")
-        lines.append(f"TY  - {ris_type}")
-        lines.append(f"TI  - {item.get('title', 'Utan titel')}")
-        if item.get("filepath"):
-            lines.append(f"L1  - {filepath_to_uri(item['filepath'])}")
-
-        author = item.get("author", "Okänd")
-        for a in author.split(";"):
-            lines.append(f"AU  - {format_ris_author(a)}")
-
-        # Datum
-        if item.get("date_full"):
-            lines.append(f"DA  - {item['date_full']}")
-        elif item.get("year"):
-            lines.append(f"PY  - {item['year']}")
-
-        # Sammanfattning
-        if item.get("summary"):
-            lines.append(f"N2  - {item['summary']}")
-
-        # Artikelspecifikt
-        if item.get("publication"):
-            lines.append(f"JO  - {item['publication']}")
-
-        # Bokspecifikt
-        if item.get("publisher"):
-            lines.append(f"PB  - {item['publisher']}")
-        if item.get("publisher_place"):
-            lines.append(f"CY  - {item['publisher_place']}")
-        if item.get("isbn"):
-            lines.append(f"SN  - {item['isbn']}")
-        if item.get("pages_total"):
-            lines.append(f"SP  - {item['pages_total']} sidor")
-        if item.get("edition"):
-            lines.append(f"ET  - {item['edition']}")
-
-        # Uppsatsspecifikt
-        if item.get("institution"):
-            lines.append(f"PB  - {item['institution']}")
-        if item.get("institution_place"):
-            lines.append(f"CY  - {item['institution_place']}")
-        if item.get("thesis_type"):
-            lines.append(f"M3  - {item['thesis_type']}")
+# Loggen låg tidigare direkt i analyzer-mappen, gemensam för alla datorer.
+# Finns ingen logg i datorns datamapp kopieras den gamla dit (eller den
+# äldsta JSON-loggen importeras), så att inget behöver analyseras om.
+# Originalet lämnas kvar åt de andra datorerna.
+def adopt_shared_log(paths):
+    log_path = Path(paths["log"])
+    legacy = paths["base"] / "processed_files.db"
+    legacy_json = paths["base"] / "processed_files.json"
+    if log_path.exists() or log_path == legacy:
+        return
+    if legacy.exists():
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        source = sqlite3.connect(str(legacy), timeout=30)
+        target = sqlite3.connect(str(log_path))
+        with target:
+            source.backup(target)
+        source.close()
+        target.close()
+        print(f"Loggen kopierad från {legacy} till {log_path}.")
+    elif legacy_json.exists():
+        store = LogStore(log_path)
+        migrated = store.import_json(legacy_json, paths["base"] / "analysis_cache.json")
+        store.close()
+        print(f"Loggen flyttad till {log_path}: {migrated} poster importerade.")
+
+def new_stats():
+    return {"hits": 0, "misses": 0, "bytes_hashed": 0, "excerpt_tokens": 0, "baseline_tokens": 0,
+            "calls": 0, "input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0,
+            "cache_write_tokens": 0, "unstructured": 0, "fixed_fields": 0, "failed": 0,
+            "near_duplicates": 0, "extraction_failed": 0, "failed_skipped": 0}
+
+# Öppna loggen för steg som bara läser den (report, export)
+def open_existing_log(paths):
+    if not Path(paths["log"]).exists() and not (paths["base"] / "processed_files.json").exists():
+        print(f"Ingen logg i {paths['data']} – kör först analyze.")
+        return None
+    return load_log(paths["log"])
 
-        lines.append("ER  - ")
-        lines.append("")
+def open_text_cache(config, paths):
+    if not config.get("text_cache_mb"):
+        return None
+    version = f"{EXTRACTOR_VERSION}:{config.get('extract_chars')}:{config.get('tail_pages', 0)}"
+    return TextCache(paths["text_cache"], version, config["text_cache_mb"] * 1_000_000)
+
+def open_lo_pool(config):
+    return LibreOfficePool(
+        config.get("libreoffice_path", "soffice"),
+        config.get("libreoffice_instances", 2),
+        config.get("libreoffice_batch", 20),
+        config.get("libreoffice_timeout", 60),
+        config.get("extract_chars"),
+    )
 
-    if not citable:
-        print("Inga citeringsbara poster – RIS-fil skapas inte.")
+# Arbetskön från --queue eller config.yaml, eller None. Används inte med
+# --batch: batcherna följs redan upp i pending_batches.json.
+def open_work_queue(args, config):
+    queue_path = args.queue or config.get("work_queue")
+    if not queue_path:
+        return None
+    return WorkQueue(queue_path, config.get("work_queue_lease", 120))
+
+# --retry-failed: glöm filer vars extraktion misslyckats, så att de försöks igen
+def retry_failed(args, log):
+    if args.retry_failed:
+        print(f"Försöker igen med {log.clear_failures()} filer vars extraktion eller batchanalys misslyckats.")
+
+# Skanna mapparna enligt config; returnerar filerna som behöver analyseras
+def scan_config_folders(config, log, paths):
+    include = config.get("include") or []
+    exclude = config.get("exclude", ["analyzer"]) or []
+    # Utdatamappen skannas aldrig, oavsett mönster
+    skip_dirs = [str(paths["base"]), str(paths["data"])]
+    return find_files(config["folders"], config["extensions"], log, include, exclude, skip_dirs)
+
+def print_lo_stats(lo_pool):
+    if lo_pool.stats["launches"]:
+        lo = lo_pool.stats
+        print(f"LibreOffice: {lo['converted']} filer konverterade på {lo['launches']} starter "
+              f"({lo['failed']} misslyckade, {lo['restarts']} omstarter).")
+
+def print_text_cache_stats(text_cache):
+    tc = text_cache.stats
+    looked_up = tc["hits"] + tc["misses"]
+    print(f"Textcache: {tc['hits']} träffar, {tc['misses']} missar ({tc['hits'] / max(looked_up, 1):.0%}), "
+          f"{tc['bytes_saved'] / 1_000_000:.1f} MB källfiler behövde inte läsas; "
+          f"{text_cache.size / 1_000_000:.1f} MB på disk för {text_cache.raw_size / 1_000_000:.1f} MB text"
+          + (f", {tc['evicted']} texter rensade." if tc["evicted"] else "."))
+
+ESCALATION_TEXTS = {"missing": "saknade fält", "type": "typ", "confidence": "låg säkerhet",
+                    "error": "triageanropet misslyckades"}
+
+# Triagen: hur många dokument som skickades vidare och varför, tider och
+# vad som sparades jämfört med att bara använda den större modellen
+def print_triage(metrics, config):
+    triage = metrics.summary()["triage"]
+    reasons = ", ".join(f"{ESCALATION_TEXTS[reason]} {count}" for reason, count in triage["reasons"].items() if count)
+    saved = f", ${triage['saved_usd']:.2f}" if metrics.input_price else ""
+    print(f"Triage: {triage['documents']} dokument till {config['triage']['model']}, {triage['escalated']} "
+          f"skickade vidare till {config['anthropic']['model']} ({triage['escalation_rate']:.0%}"
+          f"{': ' + reasons if reasons else ''}). Median {triage['p50_triage_seconds']:.1f} s per triageanrop, "
+          f"{triage['p50_kept_seconds']:.1f} s utan och {triage['p50_escalated_seconds']:.1f} s med eskalering; "
+          f"{triage['saved_tokens']} tokens till den större modellen sparade{saved}.")
+
+# Packningen: anrop, dokument per anrop, sparade anrop och anropstid per
+# dokument med och utan packning
+def print_packing(metrics):
+    packing = metrics.summary()["packing"]
+    fallbacks = f", {packing['fallbacks']} fick analyseras var för sig" if packing["fallbacks"] else ""
+    single = packing["p50_single_seconds"]
+    single = f" mot {single:.1f} s för dokument som skickades ensamma" if single is not None else ""
+    print(f"Packning: {packing['documents']} korta dokument i {packing['requests']} anrop "
+          f"({packing['documents_per_request']:.1f} per anrop{fallbacks}), {packing['requests_saved']} anrop "
+          f"sparade. Median {packing['p50_packed_seconds']:.1f} s väntan per packat dokument "
+          f"({packing['seconds_per_document']:.2f} s anropstid per dokument){single}.")
+
+# Extraktions- och anropstider med de långsammaste filerna
+def print_timings(metrics):
+    summary = metrics.summary()
+    parts = []
+    if summary["slowest_extraction"]:
+        slowest = summary["slowest_extraction"][0]
+        total = sum(h["seconds"] for h in summary["extractors"].values())
+        count = sum(h["count"] for h in summary["extractors"].values())
+        parts.append(f"extraktion {count} filer på {total:.1f} s (långsammast {Path(slowest['path']).name}, "
+                     f"{slowest['seconds']:.1f} s)")
+    if summary["slowest_analysis"]:
+        api = summary["api"]
+        slowest = summary["slowest_analysis"][0]
+        parts.append(f"anrop median {api['p50_seconds']:.1f} s, p95 {api['p95_seconds']:.1f} s "
+                     f"(långsammast {Path(slowest['path']).name}, {slowest['seconds']:.1f} s)")
+    if parts:
+        print(f"Tider: {'; '.join(parts)}.")
+
+# Steg: skanna mapparna och uppdatera katalogindexet i loggen
+def cmd_scan(args, config, paths, metrics):
+    log = load_log(paths["log"])
+    with metrics.stage("scan"):
+        files = scan_config_folders(config, log, paths)
+    print(f"Filer som väntar på analys: {len(files)}")
+    log.close()
+
+# Steg: extrahera text för filer som väntar på analys till textcachen,
+# utan att anropa Claude
+def cmd_extract(args, config, paths, metrics):
+    text_cache = open_text_cache(config, paths)
+    if text_cache is None:
+        print("Textcachen är avstängd (text_cache_mb) – inget att spara extraherad text i.")
         return
+    stats = metrics.counters["analysis"] = new_stats()
+    log = load_log(paths["log"], stats)
+    retry_failed(args, log)
+    with metrics.stage("scan"):
+        files = scan_config_folders(config, log, paths)
+    extract_workers = max(1, args.extract_workers or config.get("extract_workers", 1))
+    signed = bool(config.get("near_duplicate_threshold"))
+
+    def uncached():
+        for filepath in files:
+            try:
+                file_hash = hash_file(filepath, stats)
+            except OSError as e:
+                print(f"  Kunde inte läsa {filepath}: {e}")
+                continue
+            if not log.has_analysis(file_hash) and log.failure(file_hash) is None:
+                yield filepath, file_hash
+
+    print(f"Filer att extrahera: {len(files)}\n")
+    lo_pool = open_lo_pool(config)
+    metrics.counters["libreoffice"] = lo_pool.stats
+    metrics.counters["text_cache"] = text_cache.stats
+    with lo_pool, metrics.stage("extract"):
+        for i, (filepath, _, content, _) in enumerate(
+            extract_ahead(uncached(), config, lo_pool, extract_workers, signed=signed, text_cache=text_cache,
+                          metrics=metrics, log=log), 1
+        ):
+            chars = len(content) if content else 0
+            print(f"[{i}] {Path(filepath).name}: {chars} tecken")
+    print_lo_stats(lo_pool)
+    print_text_cache_stats(text_cache)
+    print_timings(metrics)
+    text_cache.close()
+    log.close()
+
+# Steg: skanna, extrahera och analysera nya filer (eller skicka/hämta batcher)
+def cmd_analyze(args, config, paths, metrics):
+    stats = metrics.counters["analysis"] = new_stats()
+    log = load_log(paths["log"], stats)
+    if args.refresh:
+        log.clear()
+        print("Logg raderad - analyserar allt från scratch.")
+    retry_failed(args, log)
+
+    client = make_client()
+    workers = max(1, args.workers or config.get("workers", 1))
+    limiter = RateLimiter(
+        workers,
+        config.get("requests_per_minute"),
+        config.get("input_tokens_per_minute"),
+        config.get("max_retries", 6),
+    )
+    metrics.counters["rate_limiter"] = limiter.stats
+    extract_workers = max(1, args.extract_workers or config.get("extract_workers", 1))
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
+    print(f"Startar analys: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    print(f"Redan processade filer: {len(log)}")
 
-    print(f"Zotero RIS-fil sparad: {output_path} ({len(citable)} poster)")
+    # Indexet byggs efter skanningen, när ändrade och borttagna filer är glömda
+    threshold = config.get("near_duplicate_threshold")
+    text_cache = open_text_cache(config, paths)
+    lo_pool = open_lo_pool(config)
+    metrics.counters["libreoffice"] = lo_pool.stats
+    if text_cache is not None:
+        metrics.counters["text_cache"] = text_cache.stats
+
+    if args.batch:
+        if args.queue or config.get("work_queue"):
+            print("Arbetskön används inte med --batch.")
+        batch_path = paths["batches"]
+        batches = load_batches(batch_path)
+        with metrics.stage("collect_batches"):
+            results = collect_batches(client, batches, batch_path, log, stats,
+                                      config.get("default_author", "Okänd"), metrics)
+        queued = {fp for batch in batches.values() for fp in batch["requests"].values()}
+        with metrics.stage("scan"):
+            files = [fp for fp in scan_config_folders(config, log, paths) if fp not in queued]
+        near_index = NearDuplicateIndex(threshold, log.signatures()) if threshold else None
+        print(f"Nya filer att skicka: {len(files)} ({len(queued)} väntar redan i batcher)\n")
+        with lo_pool, metrics.stage("submit_batches"):
+            submit_batches(client, files, config, batches, batch_path, log, stats, lo_pool,
+                           config.get("batch_size", 1000), extract_workers, near_index, text_cache, metrics)
+    else:
+        with metrics.stage("scan"):
+            files = scan_config_folders(config, log, paths)
+        near_index = NearDuplicateIndex(threshold, log.signatures()) if threshold else None
+        print(f"Nya filer att processa: {len(files)}\n")
+        work_queue = open_work_queue(args, config)
+        if work_queue is not None:
+            metrics.counters["work_queue"] = work_queue.stats
+            print(f"Arbetskö: {work_queue.db_path} (arbetare {work_queue.worker})\n")
+        with lo_pool, metrics.stage("analyze"):
+            results = run_analysis(client, files, config, log, stats, lo_pool, workers, extract_workers,
+                                   config.get("extract_queue"), limiter, near_index, text_cache, metrics,
+                                   work_queue)
+
+    print_lo_stats(lo_pool)
+    if "work_queue" in metrics.counters:
+        wq = metrics.counters["work_queue"]
+        print(f"Arbetskö: {wq['claimed']} tagna här ({wq['taken_over']} övertagna efter utgången lease), "
+              f"{wq['from_queue']} analyserade av andra arbetare.")
 
+    print(f"\nKlart! {len(results)} dokument analyserade.")
+    print(f"Cache: {stats['hits']} träffar, {stats['misses']} missar, "
+          f"{stats['bytes_hashed'] / 1_000_000:.1f} MB hashade.")
+    if stats["baseline_tokens"]:
+        saved = stats["baseline_tokens"] - stats["excerpt_tokens"]
+        print(f"Utdrag: {stats['excerpt_tokens']} tokens skickade (uppskattat), {saved} sparade "
+              f"jämfört med de första 6000 tecknen ({saved / stats['baseline_tokens']:.0%}).")
+    if text_cache is not None:
+        print_text_cache_stats(text_cache)
+        text_cache.close()
+    if stats["extraction_failed"] or stats["failed_skipped"]:
+        print(f"Misslyckade: {stats['extraction_failed']} filer misslyckades vid extraktionen (timeout/minne) "
+              f"och sparades i loggen, "
+              f"{stats['failed_skipped']} tidigare misslyckade hoppades över. Kör med --retry-failed för att "
+              f"försöka igen.")
+    if near_index is not None:
+        clusters, near_total = log.near_duplicate_clusters()
+        print(f"Nära kopior: {stats['near_duplicates']} dokument fick en befintlig analys "
+              f"({stats['near_duplicates']} anrop sparade); totalt {near_total} kopior av "
+              f"{clusters} dokument i loggen.")
+    if limiter.stats["retries"] or limiter.stats["given_up"]:
+        rl = limiter.stats
+        print(f"Hastighet: {rl['retries']} omförsök ({rl['throttled']} strypta av API:t), "
+              f"{rl['given_up']} anrop gav upp, samtidighet ner till {rl['min_concurrency']} av {workers}.")
+    if stats.get("triaged"):
+        print_triage(metrics, config)
+    if stats.get("packs"):
+        print_packing(metrics)
+    if stats["calls"] or stats["failed"] or stats.get("triaged"):
+        prompt_tokens = stats["input_tokens"] + stats["cache_read_tokens"] + stats["cache_write_tokens"]
+        cost = f", uppskattad kostnad ${metrics.cost:.2f}" if metrics.input_price else ""
+        print(f"API: {stats['calls']} svar, {prompt_tokens} prompttokens varav {stats['cache_read_tokens']} "
+              f"från promptcachen ({stats['cache_read_tokens'] / max(prompt_tokens, 1):.0%}), "
+              f"{stats['output_tokens']} svarstokens{cost}.")
+        model = config["anthropic"]["model"]
+        if not cacheable_prefix(model):
+            print(f"Promptcache: prefixet är ca {prefix_tokens(ANALYSIS_TOOL)} tokens, under minimum "
+                  f"{min_cache_tokens(model)} för {model}, och cachas inte.")
+        # Dokument som stannade hos triagemodellen fick sitt enda svar där
+        answered = stats["calls"] + stats.get("triaged", 0) - stats.get("escalated", 0) + stats["failed"]
+        print(f"Tolkning: {stats['unstructured']} svar utan verktygsanrop, {stats['fixed_fields']} fält "
+              f"rättade lokalt, {stats['failed']} misslyckade ({stats['failed'] / answered:.1%}).")
+    print_timings(metrics)
+    log.close()
+
+# Steg: Word-rapport från loggen (läser inga dokument, anropar inte Claude)
+def cmd_report(args, config, paths, metrics):
+    log = open_existing_log(paths)
+    if log is None:
+        return
+    print(f"Totalt i rapport: {log.analysed_count()} dokument.")
+    with metrics.stage("report"):
+        generate_word_report(log, paths["report"], paths["folder_name"], config.get("report_writer", "docx"))
+    log.close()
+
+# Steg: Zotero RIS-export från loggen
+def cmd_export(args, config, paths, metrics):
+    log = open_existing_log(paths)
+    if log is None:
+        return
+    with metrics.stage("export"):
+        generate_zotero_export(log, paths["zotero"], paths["zotero_delta"], args.ris_full)
+    log.close()
+
+# Ta bort cachade analyser som ingen fil i loggen längre pekar på
+def cmd_prune(args, config, paths, metrics):
+    log = load_log(paths["log"])
+    removed = log.prune()
+    print(f"Cache rensad: {removed} analyser borttagna.")
+    log.close()
+
+# Hela kedjan: analyze, report och (utan --noris) export
+def cmd_all(args, config, paths, metrics):
+    if args.prune_cache:
+        return cmd_prune(args, config, paths, metrics)
+    cmd_analyze(args, config, paths, metrics)
+    cmd_report(args, config, paths, metrics)
+    if not args.noris:
+        cmd_export(args, config, paths, metrics)
+
+# Filerna som mätvärdena skrivs till: steg utan API-anrop får egna filer
+# med stegets namn, så att de inte skriver över analysens
+def metrics_paths(paths, config, command):
+    json_path = paths["metrics"]
+    prometheus_path = config.get("prometheus_textfile")
+    if command in API_COMMANDS:
+        return json_path, prometheus_path
+    if prometheus_path:
+        prometheus_path = Path(prometheus_path)
+        prometheus_path = str(prometheus_path.with_name(f"{prometheus_path.stem}-{command}{prometheus_path.suffix}"))
+    return json_path.with_name(f"metrics-{command}.json"), prometheus_path
 
 # Huvudfunktion
 def main():
-    # Hantera kommandoradsargument
-    parser = argparse.ArgumentParser(description="Analysera dokument i en mapp")
-    parser.add_argument("--folder", type=str, help="Mapp att analysera (överskriver config.yaml)")
+    # Hantera kommandoradsargument. Utan steg körs hela kedjan som tidigare.
+    # Flaggorna tar inga standardvärden i stegen, så att t.ex.
+    # `--folder X report` och `report --folder X` betyder samma sak.
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    common.add_argument("--folder", type=str, help="Mapp att analysera (överskriver config.yaml)")
+    common.add_argument("--data-dir", type=str,
+                        help="Mapp för logg, textcache och mätvärden på den här datorn (överskriver config.yaml)")
+    common.add_argument("--profile", action="store_true",
+                        help="Profilera körningen med cProfile och spara profile.prof i datamappen")
+
+    analysis = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    analysis.add_argument("--refresh", action="store_true", help="Radera loggen och analysera allt från scratch")
+    analysis.add_argument("--workers", type=int, help="Antal samtidiga anrop till Claude (överskriver config.yaml)")
+    analysis.add_argument("--batch", action="store_true", help="Skicka nya filer som Message Batches och hämta in klara batcher")
+    analysis.add_argument("--queue", type=str,
+                          help="Delad arbetskö (SQLite-fil) för flera processer eller datorer (överskriver config.yaml)")
+
+    extraction = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    extraction.add_argument("--extract-workers", type=int, help="Antal processer för textextraktion (överskriver config.yaml)")
+    extraction.add_argument("--retry-failed", action="store_true",
+                            help="Försök igen med filer vars extraktion (timeout/minne) eller batchanalys tidigare misslyckats")
+
+    export = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    export.add_argument("--ris-full", action="store_true",
+                        help="Skriv om hela RIS-filen i stället för att bara lägga till nya poster")
+
+    parser = argparse.ArgumentParser(description="Analysera dokument i en mapp",
+                                     parents=[common, analysis, extraction, export])
     parser.add_argument("--noris", action="store_true", help="Skapa ingen Zotero RIS-fil")
-    parser.add_argument("--refresh", action="store_true", help="Radera loggen och analysera allt från scratch")
-    args = parser.parse_args()
+    parser.add_argument("--prune-cache", action="store_true", help="Ta bort cachade analyser som ingen fil längre pekar på och avsluta")
+    parser.set_defaults(func=cmd_all, command="all")
+
+    stages = parser.add_subparsers(title="steg", metavar="STEG")
+    stage = stages.add_parser("scan", parents=[common], help="Skanna mapparna och uppdatera katalogindexet")
+    stage.set_defaults(func=cmd_scan, command="scan")
+    stage = stages.add_parser("extract", parents=[common, extraction],
+                              help="Extrahera text för nya filer till textcachen, utan API-anrop")
+    stage.set_defaults(func=cmd_extract, command="extract")
+    stage = stages.add_parser("analyze", parents=[common, analysis, extraction],
+                              help="Skanna, extrahera och analysera nya filer")
+    stage.set_defaults(func=cmd_analyze, command="analyze")
+    stage = stages.add_parser("report", parents=[common], help="Skapa Word-rapporten från loggen")
+    stage.set_defaults(func=cmd_report, command="report")
+    stage = stages.add_parser("export", parents=[common, export], help="Skapa Zotero RIS-filen från loggen")
+    stage.set_defaults(func=cmd_export, command="export")
+
+    args = parser.parse_args(namespace=argparse.Namespace(
+        folder=None, data_dir=None, profile=False, refresh=False, workers=None, batch=False, queue=None,
+        extract_workers=None, retry_failed=False, ris_full=False,
+    ))
 
     config = load_config()
 
-    # Använd default_author från config
-    default_author = config.get("default_author", "Okänd")
-
     # Överskrid config om --folder angivits
     if args.folder:
         config["folders"] = [str(Path(args.folder).resolve())]
-
-    # Definiera alla sökvägar tidigt
-    folder_name = Path(config["folders"][0]).name
-    base_output = Path(config["folders"][0]) / "analyzer"
-    log_path = str(base_output / "processed_files.json")
-    if args.refresh:
-        if Path(log_path).exists():
-            Path(log_path).unlink()
-            print("Logg raderad - analyserar allt från scratch.")
-        log = {}
-    else:
-        log = load_log(log_path)
-    report_path = str(base_output / f"analys-{folder_name}.docx")
-    zotero_path = str(base_output / f"zotero-import-{folder_name}.ris")
-
-    log = load_log(log_path)
-
-    client = anthropic.Anthropic()
-    model = config["anthropic"]["model"]
-    max_tokens = config["anthropic"]["max_tokens"]
-
-    print(f"Startar analys: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    print(f"Redan processade filer: {len(log)}")
-
-    files = find_files(config["folders"], config["extensions"], log)
-    print(f"Nya filer att processa: {len(files)}\n")
-
-    results = []
-
-    for i, filepath in enumerate(files, 1):
-        filename = Path(filepath).name
-        print(f"[{i}/{len(files)}] Analyserar: {filename}")
-
-        content = read_file(filepath, config)
-        if not content or len(content.strip()) < 50:
-            print(f"  Hoppar över – tomt eller oläsbart innehåll")
-            continue
-
-        try:
-            analysis = analyze_document(client, model, max_tokens, filepath, content, default_author)
-            analysis["filepath"] = filepath
-            results.append(analysis)
-
-            log[filepath] = {
-                "processed": datetime.now().isoformat(),
-                "title": analysis.get("title"),
-                "author": analysis.get("author"),
-                "analysis": analysis
-            }
-            save_log(log_path, log)
-            print(f"  ✓ {analysis.get('author', 'Okänd')} – {analysis.get('title', 'Utan titel')}")
-
-        except Exception as e:
-            print(f"  ✗ Fel vid analys: {e}")
-
-    print(f"\nKlart! {len(results)} dokument analyserade.")
-
-    # Bygg lista med alla resultat - nya + tidigare analyserade
-    all_results = []
-    for filepath, entry in log.items():
-        if "analysis" in entry:
-            all_results.append(entry["analysis"])
-
-    print(f"Totalt i rapport: {len(all_results)} dokument.")
-
-    generate_word_report(all_results, report_path, folder_name)
-    generate_word_report(all_results, report_path, folder_name)
-    if not args.noris:
-        generate_zotero_export(all_results, zotero_path)
+    if args.data_dir:
+        config["data_dir"] = str(Path(args.data_dir).resolve())
+
+    paths = output_paths(config)
+    adopt_shared_log(paths)
+    prices = config["anthropic"]
+    triage = config.get("triage") or {}
+    command = "prune" if getattr(args, "prune_cache", False) else args.command
+    metrics = Metrics(prices.get("input_price"), prices.get("output_price"), command,
+                      triage.get("input_price"), triage.get("output_price"))
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.stage("total"):
+            args.func(args, config, paths, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        # Mätvärden och profil skrivs även för avbrutna körningar, men bara
+        # om datamappen finns (prune eller report utan logg skapar den inte)
+        if paths["data"].exists():
+            json_path, prometheus_path = metrics_paths(paths, config, command)
+            metrics.write(json_path, prometheus_path)
+            print(f"Mätvärden sparade: {json_path}")
+            if profiler is not None:
+                profiler.dump_stats(paths["profile"])
+                print(f"Profil sparad: {paths['profile']} (visa med python -m pstats eller snakeviz)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,861 @@
+#!/usr/bin/env python3
+"""Benchmarks for analyzer.py.
+
+Usage:
+    benchmark.py extract [--pages 500]    # budgeted vs full text extraction
+    benchmark.py ooxml [--words 200000] [--slides 300] [--corpus DIR]
+                                          # DOCX/PPTX straight from the zip vs python-docx/-pptx
+    benchmark.py report [--entries 10000] # Word report writers, cold and cached
+    benchmark.py imports [--runs 5]       # startup time of the offline stages
+    benchmark.py corpus DIR [--files 1000] [--words 800] [--seed 1]
+                                          # write a reproducible multi-format corpus
+    benchmark.py suite [--files 1000] [--latency 0.05] [--error-rate 0.01] [--save] [--check]
+                                          # every stage end to end against the fake API
+    benchmark.py queue [--processes 3] [--kill-after 5] [--separate-logs]
+                                          # several analyzer workers sharing one work queue
+
+Synthetic input files are written to a temporary directory and removed
+afterwards; nothing touches the real archive.
+
+The suite generates a corpus (PDF, DOCX, PPTX, ODT, ODP, TXT and Ami Pro
+.sam), starts fake_claude.py in-process with the given latency and
+failure rates, and runs each stage (scan, extract, analyze, report,
+export, ris-sort, sam, and sam-skip, a second conversion that should find
+everything up to date) in a fresh process. It reports throughput,
+per-file latency percentiles and peak RSS per stage, and compares them
+with the last saved run with the same parameters in
+benchmark-results.jsonl (--save appends the run, --check exits with
+status 1 if a stage got slower or bigger than --tolerance).
+
+The queue benchmark runs several `analyze` workers at once over the same
+corpus and work queue (--separate-logs gives each its own log, as on
+separate machines), optionally kills one of them mid-run to check that
+its leases are taken over, and reports API calls against distinct
+contents. It exits with status 1 if any worker's log is missing a file.
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import runpy
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import analyzer
+from fake_claude import make_analysis, start_server
+
+WORDS = (
+    "guds rike nåd tro hopp kärlek församling helande bön ande kraft ord "
+    "evangelium lärjunge tjänst gemenskap profetia undervisning vittnesbörd"
+).split()
+
+
+def lorem(seed, words):
+    """Return deterministic filler text of the given length in words."""
+    return " ".join(WORDS[(seed * 7 + i * 13) % len(WORDS)] for i in range(words))
+
+
+def make_pdf(path, pages, lines_per_page=40, text=None):
+    """Write a minimal text PDF with one Helvetica content stream per page.
+
+    `text` is a list of lines per page; by default every page is filler.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    kids = []
+    if text is None:
+        text = [[lorem(page * lines_per_page + i, 12) for i in range(lines_per_page)] for page in range(pages)]
+    for page, page_lines in enumerate(text):
+        lines = [f"Sida {page + 1}"] + [
+            line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for line in page_lines
+        ]
+        content = " T* ".join(f"({line})'" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {content} ET".encode("cp1252", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    Path(path).write_bytes(bytes(out))
+
+
+def measure(func, *args, **kwargs):
+    """Run func once; return (result, seconds, peak traced bytes)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_extract(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdf = Path(tmpdir) / "bok.pdf"
+        make_pdf(pdf, args.pages)
+        print(f"{args.pages}-page PDF, {pdf.stat().st_size / 1_000_000:.1f} MB")
+
+        full, full_time, full_peak = measure(analyzer.read_file, str(pdf), budget=0)
+        rows = [("full", full, full_time, full_peak)]
+        for tail_pages in (0, 2):
+            text, elapsed, peak = measure(analyzer.read_file, str(pdf), budget=6000, tail_pages=tail_pages)
+            rows.append((f"budget 6000, tail {tail_pages}", text, elapsed, peak))
+
+    print(f"{'mode':<22}{'chars':>10}{'seconds':>10}{'peak MB':>10}{'speedup':>10}")
+    for name, text, elapsed, peak in rows:
+        print(f"{name:<22}{len(text):>10}{elapsed:>10.3f}{peak / 1_000_000:>10.1f}{full_time / elapsed:>9.1f}x")
+
+
+def existing_ooxml(path, budget):
+    """DOCX/PPTX text through python-docx/python-pptx, as before the zip fast path."""
+    return analyzer._take(analyzer.iter_text(path), budget)
+
+
+def bench_ooxml(args):
+    """Compare read_file's zip fast path with the python-docx/-pptx path.
+
+    Inputs are one large DOCX, one large PPTX and every DOCX/PPTX in the
+    corpus, each with the extract_chars budget and in full. "missing" counts
+    lines of the old full text that the fast path does not produce.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rng = random.Random(args.seed)
+        docx = Path(tmpdir) / "bok.docx"
+        write_docx(docx, "Stor bok", "Testsson, Test", paragraphs(rng, args.big_words))
+        pptx = Path(tmpdir) / "serie.pptx"
+        write_pptx(pptx, "Lång serie", "Testsson, Test", paragraphs(rng, args.slides * 60), args.slides)
+        corpus = Path(args.corpus or Path(tmpdir) / "korpus").resolve()
+        if not corpus.exists():
+            make_corpus(corpus, args.files, args.words, args.seed, args.duplicates)
+        files = sorted(str(path) for path in corpus.rglob("*")
+                       if path.suffix.lower() in (".docx", ".pptx") and "analyzer" not in path.parts)
+        inputs = [(f"docx {docx.stat().st_size / 1_000_000:.1f} MB", [str(docx)]),
+                  (f"pptx {args.slides} slides", [str(pptx)]),
+                  (f"corpus {len(files)} files", files)]
+
+        print(f"{'input':<22}{'budget':>8}{'mode':>10}{'chars':>11}{'seconds':>10}{'peak MB':>10}"
+              f"{'speedup':>10}{'missing':>9}")
+        for name, paths in inputs:
+            for budget in (args.budget, 0):
+                old, old_time, old_peak = measure(lambda: [existing_ooxml(path, budget) for path in paths])
+                new, new_time, new_peak = measure(lambda: [analyzer.read_file(path, budget=budget) for path in paths])
+                missing = "-"
+                if not budget:
+                    missing = 0
+                    for before, text in zip(old, new):
+                        lines = set(text.split("\n"))
+                        missing += sum(line not in lines for line in before.split("\n") if line.strip())
+                for mode, texts, elapsed, peak in (("existing", old, old_time, old_peak),
+                                                   ("zip", new, new_time, new_peak)):
+                    print(f"{name:<22}{budget or 'full':>8}{mode:>10}{sum(map(len, texts)):>11}{elapsed:>10.3f}"
+                          f"{peak / 1_000_000:>10.1f}{old_time / elapsed:>9.1f}x"
+                          f"{missing if mode == 'zip' else '':>9}")
+
+
+def bench_report(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log = analyzer.LogStore(Path(tmpdir) / "processed_files.db")
+        for i in range(args.entries):
+            analysis = {**make_analysis(f"dokument_{i}.pdf"), "summary": lorem(i, 80)}
+            log.record(f"/arkiv/mapp{i % 50}/dokument_{i}.pdf", f"hash{i}", analysis)
+        print(f"{args.entries} analyses in the log")
+
+        rows = []
+        for writer in ("docx", "ooxml"):
+            output = Path(tmpdir) / f"rapport-{writer}.docx"
+            for fragments in ("cold", "cached"):
+                if fragments == "cold":
+                    log.conn.execute("DELETE FROM report_fragments")
+                log.conn.execute("DELETE FROM reports")
+                log.conn.commit()
+                _, elapsed, peak = measure(analyzer.generate_word_report, log, str(output), "arkiv", writer)
+                rows.append((f"{writer}, {fragments}", elapsed, peak, output.stat().st_size))
+            _, elapsed, peak = measure(analyzer.generate_word_report, log, str(output), "arkiv", writer)
+            rows.append((f"{writer}, unchanged", elapsed, peak, output.stat().st_size))
+        log.close()
+
+    print(f"{'mode':<22}{'seconds':>10}{'peak MB':>10}{'size MB':>10}")
+    for name, elapsed, peak, size in rows:
+        print(f"{name:<22}{elapsed:>10.3f}{peak / 1_000_000:>10.1f}{size / 1_000_000:>10.1f}")
+
+
+# Modules that only the analyze stage may pull in
+HEAVY_MODULES = ("anthropic", "dotenv", "docx", "pypdf", "pptx", "odf")
+
+IMPORT_PROBE = """
+import sys, time
+started = time.perf_counter()
+import analyzer
+elapsed = time.perf_counter() - started
+heavy = {name.split('.')[0] for name in sys.modules} & set(sys.argv[1:])
+print(elapsed, *heavy)
+"""
+
+
+def bench_imports(args):
+    """Time `import analyzer` and `analyzer.py report --help` in fresh processes.
+
+    Fails (exit status 1) if importing analyzer loads a module that only
+    the analyze stage needs, or if startup exceeds --limit seconds.
+    """
+    here = Path(__file__).parent
+    imports, heavy = [], set()
+    for _ in range(args.runs):
+        elapsed, *loaded = subprocess.run([sys.executable, "-c", IMPORT_PROBE, *HEAVY_MODULES], cwd=here,
+                                          capture_output=True, text=True, check=True).stdout.split()
+        imports.append(float(elapsed))
+        heavy.update(loaded)
+
+    startups = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, str(here / "analyzer.py"), "report", "--help"],
+                       capture_output=True, check=True)
+        startups.append(time.perf_counter() - started)
+
+    print(f"{'measure':<30}{'median s':>10}{'max s':>10}")
+    print(f"{'import analyzer':<30}{statistics.median(imports):>10.3f}{max(imports):>10.3f}")
+    print(f"{'analyzer.py report --help':<30}{statistics.median(startups):>10.3f}{max(startups):>10.3f}")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: importing analyzer loads {', '.join(sorted(heavy))}")
+        failed = True
+    if statistics.median(startups) > args.limit:
+        print(f"FAIL: offline stage startup above {args.limit} s")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+# Synthetic corpus: formats with relative weights, interleaved in this order
+CORPUS_FORMATS = (("pdf", 5), ("docx", 5), ("txt", 3), ("pptx", 2), ("odt", 2), ("odp", 1), ("sam", 1))
+FILES_PER_FOLDER = 100
+WORDS_PER_PDF_LINE = 12
+PDF_LINES_PER_PAGE = 40
+ZIP_DATE = (2000, 1, 1, 0, 0, 0)  # fixed timestamps so the same seed gives identical files
+
+VOCABULARY = WORDS + (
+    "själ väg öga människa förlåtelse gärning frälsning rättfärdighet helighet vishet sanning ljus "
+    "mörker liv död uppståndelse himmel jord skapelse gåva tjänare herde får vingård säd skörd bröd "
+    "vin vatten källa klippa hus tempel altare offer löfte förbund vittne apostel profet kung folk "
+    "land stad berg öken hav fader son broder syster barn hjärta händer röst namn tid evighet"
+).split()
+AUTHORS = ("Lars Gunther", "Anna Öberg", "Per Åström", "Karin Lindqvist", "Erik Ährén", "Maria Nilsson")
+
+ODF_NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+    'xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0" '
+    'xmlns:presentation="urn:oasis:names:tc:opendocument:xmlns:presentation:1.0"'
+)
+ODF_MIMETYPES = {
+    "odt": "application/vnd.oasis.opendocument.text",
+    "odp": "application/vnd.oasis.opendocument.presentation",
+}
+# Ami Pro escape codes, the inverse of convert-sam-to-docx.py
+AMI_ESCAPES = {"ö": r"<\v>", "Ö": r"<\V>", "ä": r"<\d>", "Ä": r"<\D>", "å": r"<\e>", "Å": r"<\E>", "é": r"<\i>"}
+
+_pptx_templates = {}
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words)).capitalize()
+
+
+def paragraphs(rng, words):
+    """Return random paragraphs of about `words` words in total."""
+    result = []
+    while words > 0:
+        count = min(words, rng.randint(40, 120))
+        result.append(sentence(rng, count) + ".")
+        words -= count
+    return result
+
+
+def zip_write(package, name, data, compress=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, ZIP_DATE)
+    info.compress_type = compress
+    package.writestr(info, data)
+
+
+def write_txt(path, title, byline, paras):
+    Path(path).write_text("\n\n".join([title, byline, *paras]) + "\n", encoding="utf-8")
+
+
+def write_pdf(path, title, byline, paras):
+    words = " ".join([title, byline, *paras]).split()
+    lines = [" ".join(words[i:i + WORDS_PER_PDF_LINE]) for i in range(0, len(words), WORDS_PER_PDF_LINE)]
+    pages = [lines[i:i + PDF_LINES_PER_PAGE] for i in range(0, len(lines), PDF_LINES_PER_PAGE)]
+    make_pdf(path, len(pages), text=pages)
+
+
+def write_docx(path, title, byline, paras):
+    """Write a DOCX with the same package parts as analyzer's OOXML report writer."""
+    body = analyzer.ooxml_paragraph(title, "Title") + analyzer.ooxml_paragraph(byline, italic=True)
+    body += "".join(analyzer.ooxml_paragraph(text) for text in paras)
+    with zipfile.ZipFile(path, "w") as package:
+        zip_write(package, "[Content_Types].xml", analyzer.OOXML_CONTENT_TYPES)
+        zip_write(package, "_rels/.rels", analyzer.OOXML_RELS)
+        zip_write(package, "word/_rels/document.xml.rels", analyzer.OOXML_DOCUMENT_RELS)
+        zip_write(package, "word/styles.xml", analyzer.OOXML_STYLES)
+        zip_write(package, "word/document.xml",
+                  f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                  f'<w:document xmlns:w="{analyzer.W_NS}"><w:body>{body}</w:body></w:document>')
+
+
+def pptx_template(slides):
+    """Parts of a python-pptx deck with `slides` title-and-content slides.
+
+    The slide texts are placeholders (@TITLEn@, @BODYn@) that write_pptx
+    replaces, so python-pptx runs once per slide count, not once per file.
+    """
+    if slides not in _pptx_templates:
+        from pptx import Presentation
+
+        deck = Presentation()
+        for i in range(slides):
+            slide = deck.slides.add_slide(deck.slide_layouts[1])
+            slide.shapes.title.text = f"@TITLE{i}@"
+            slide.placeholders[1].text = f"@BODY{i}@"
+        buffer = io.BytesIO()
+        deck.save(buffer)
+        with zipfile.ZipFile(buffer) as package:
+            _pptx_templates[slides] = [(info.filename, package.read(info)) for info in package.infolist()]
+    return _pptx_templates[slides]
+
+
+def write_pptx(path, title, byline, paras, slides=12):
+    texts = [(title, byline)] + [(" ".join(text.split()[:5]), text) for text in paras[:slides - 1]]
+    with zipfile.ZipFile(path, "w") as package:
+        for name, data in pptx_template(len(texts)):
+            if name.startswith("ppt/slides/slide") and name.endswith(".xml"):
+                xml = data.decode("utf-8")
+                for i, (slide_title, slide_body) in enumerate(texts):
+                    xml = xml.replace(f"@TITLE{i}@", escape(slide_title)).replace(f"@BODY{i}@", escape(slide_body))
+                data = xml.encode("utf-8")
+            zip_write(package, name, data)
+
+
+def write_odf(path, kind, body):
+    mimetype = ODF_MIMETYPES[kind]
+    manifest = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+        'manifest:version="1.2">'
+        f'<manifest:file-entry manifest:full-path="/" manifest:media-type="{mimetype}"/>'
+        '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+        '</manifest:manifest>'
+    )
+    content = (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<office:document-content {ODF_NAMESPACES} '
+        f'office:version="1.2"><office:body>{body}</office:body></office:document-content>'
+    )
+    with zipfile.ZipFile(path, "w") as package:
+        # The mimetype must be the first entry, uncompressed
+        zip_write(package, "mimetype", mimetype, zipfile.ZIP_STORED)
+        zip_write(package, "META-INF/manifest.xml", manifest)
+        zip_write(package, "content.xml", content)
+
+
+def write_odt(path, title, byline, paras):
+    body = f'<text:h text:outline-level="1">{escape(title)}</text:h><text:p>{escape(byline)}</text:p>'
+    body += "".join(f"<text:p>{escape(text)}</text:p>" for text in paras)
+    write_odf(path, "odt", f"<office:text>{body}</office:text>")
+
+
+def write_odp(path, title, byline, paras):
+    pages = [(title, byline)] + [(" ".join(text.split()[:5]), text) for text in paras[:11]]
+    body = "".join(
+        f'<draw:page draw:name="sida{i + 1}">'
+        f'<draw:frame presentation:class="title" svg:x="2cm" svg:y="1cm" svg:width="24cm" svg:height="3cm">'
+        f"<draw:text-box><text:p>{escape(page_title)}</text:p></draw:text-box></draw:frame>"
+        f'<draw:frame presentation:class="outline" svg:x="2cm" svg:y="5cm" svg:width="24cm" svg:height="12cm">'
+        f"<draw:text-box><text:p>{escape(page_body)}</text:p></draw:text-box></draw:frame></draw:page>"
+        for i, (page_title, page_body) in enumerate(pages)
+    )
+    write_odf(path, "odp", f"<office:presentation>{body}</office:presentation>")
+
+
+def write_sam(path, title, byline, paras):
+    """Write an Ami Pro document: header sections, then the text after [edoc]
+    with paragraph styles (@Rubrik@), format codes and escaped letters."""
+    def ami(text):
+        return "".join(AMI_ESCAPES.get(char, char) for char in text)
+
+    lines = ["[ver]", "\t4", "[sty]", "\t[sty_]", "\t\tBody Text", "\t\tRubrik", "\t\tBibeltext", "[edoc]",
+             "@sidhuvud@" + ami(title), f"@Rubrik@<:f240,4Times New Roman,>{ami(title)}<:f>", ami(byline), ""]
+    for i, text in enumerate(paras):
+        lines.append(f"@Bibeltext@{ami(text)}" if i % 5 == 4 else ami(text))
+        lines.append("")
+    lines.append(">")
+    Path(path).write_text("\n".join(lines) + "\n", encoding="cp1252", errors="replace")
+
+
+CORPUS_WRITERS = {
+    "pdf": write_pdf, "docx": write_docx, "txt": write_txt, "pptx": write_pptx,
+    "odt": write_odt, "odp": write_odp, "sam": write_sam,
+}
+
+
+def make_corpus(root, files, words=800, seed=1, duplicates=0.05):
+    """Write `files` documents under root, FILES_PER_FOLDER per subfolder.
+
+    Document lengths are log-normal around `words`. A share `duplicates`
+    are byte-identical copies of earlier files under another name. The
+    same arguments always give the same files. Returns counts per format.
+    """
+    rng = random.Random(seed)
+    formats = [name for name, weight in CORPUS_FORMATS for _ in range(weight)]
+    written = []
+    counts = {}
+    for i in range(files):
+        folder = Path(root) / f"mapp{i // FILES_PER_FOLDER:03d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        if written and rng.random() < duplicates:
+            source = rng.choice(written)
+            shutil.copyfile(source, folder / f"kopia{i:05d}{source.suffix}")
+            counts["copies"] = counts.get("copies", 0) + 1
+            continue
+        kind = formats[i % len(formats)]
+        length = min(20 * words, max(60, int(rng.lognormvariate(math.log(words), 0.8))))
+        title = sentence(rng, rng.randint(3, 7))
+        byline = f"{rng.choice(AUTHORS)}, {rng.randint(1975, 2020)}"
+        path = folder / f"dokument{i:05d}.{kind}"
+        CORPUS_WRITERS[kind](path, title, byline, paragraphs(rng, length))
+        written.append(path)
+        counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def bench_corpus(args):
+    started = time.perf_counter()
+    counts = make_corpus(args.directory, args.files, args.words, args.seed, args.duplicates)
+    summary = ", ".join(f"{count} {kind}" for kind, count in counts.items())
+    print(f"{args.files} files in {args.directory} ({summary}) in {time.perf_counter() - started:.1f} s")
+
+
+SUITE_STAGES = ("scan", "extract", "analyze", "report", "export", "ris-sort", "sam", "sam-skip")
+
+# Settings that must not depend on the local config.yaml for runs to be comparable
+SUITE_CONFIG = {
+    "extensions": [".pdf", ".docx", ".txt", ".pptx", ".odt", ".odp"],
+    "include": [],
+    "exclude": ["analyzer"],
+    "text_cache_mb": 500,
+    "requests_per_minute": None,
+    "input_tokens_per_minute": None,
+    "prometheus_textfile": None,
+}
+
+STAGE_PROBE = "import sys, benchmark; benchmark.stage_child(*sys.argv[1:])"
+
+
+def peak_rss():
+    """Peak resident set size in bytes of this process and of its largest
+    waited-for child (the extraction processes)."""
+    try:
+        import resource
+    except ImportError:  # Windows: peak working set of this process only
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage",
+                )
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+        )
+        return counters.PeakWorkingSetSize
+    unit = 1 if sys.platform == "darwin" else 1024
+    return unit * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_stage(stage, config, paths, corpus):
+    """Run one stage; return (seconds, items processed, per-item latencies)."""
+    args = argparse.Namespace(folder=None, profile=False, refresh=False, workers=None, batch=False, queue=None,
+                              extract_workers=None, retry_failed=False, ris_full=True, noris=False,
+                              prune_cache=False)
+    metrics = analyzer.Metrics(command=stage)
+    here = Path(__file__).parent
+
+    if stage == "ris-sort":
+        items = sum(1 for line in open(paths["zotero"], encoding="utf-8") if line.startswith("ER  -"))
+        sys.argv = ["ris-sort.py", paths["zotero"], "-o", str(paths["base"] / "sorted.ris"), "--dedupe"]
+        started = time.perf_counter()
+        runpy.run_path(str(here / "ris-sort.py"), run_name="__main__")
+        return time.perf_counter() - started, items, []
+
+    if stage in ("sam", "sam-skip"):
+        # convert-sam-to-docx.py writes next to the input, so convert
+        # copies in a scratch folder of its own. It is run as a script, like
+        # from the command line, so that its process pool can pickle
+        # convert_file. sam-skip times a second run over the converted
+        # folder, which should skip every file.
+        with tempfile.TemporaryDirectory(prefix="sam") as workdir:
+            sources = sorted(Path(corpus).rglob("*.sam"))
+            for i, source in enumerate(sources):
+                shutil.copyfile(source, Path(workdir) / f"{i:05d}.sam")
+            sys.argv = ["convert-sam-to-docx.py", workdir, "--workers", str(config.get("extract_workers") or 1)]
+            runs = 2 if stage == "sam-skip" else 1
+            for _ in range(runs):
+                started = time.perf_counter()
+                runpy.run_path(str(here / "convert-sam-to-docx.py"), run_name="__main__")
+            return time.perf_counter() - started, len(sources), []
+
+    command = {"scan": analyzer.cmd_scan, "extract": analyzer.cmd_extract, "analyze": analyzer.cmd_analyze,
+               "report": analyzer.cmd_report, "export": analyzer.cmd_export}[stage]
+    started = time.perf_counter()
+    command(args, config, paths, metrics)
+    seconds = time.perf_counter() - started
+
+    documents = metrics.documents.values()
+    if stage == "extract":
+        latencies = [doc["extract_seconds"] for doc in documents if "extract_seconds" in doc]
+        return seconds, len(latencies), latencies
+    if stage == "analyze":
+        counters = metrics.counters["analysis"]
+        latencies = [doc["api_seconds"] for doc in documents if "api_seconds" in doc]
+        return seconds, counters["hits"] + counters["misses"], latencies
+    log = analyzer.load_log(paths["log"])
+    items = len(log.scan_index()) if stage == "scan" else log.analysed_count()
+    log.close()
+    return seconds, items, []
+
+
+def stage_child(stage, corpus, workers, result_path):
+    """Entry point of the per-stage process started by bench_suite."""
+    config = analyzer.load_config()
+    config.update(SUITE_CONFIG, folders=[corpus], workers=int(workers))
+    paths = analyzer.output_paths(config)
+    seconds, items, latencies = run_stage(stage, config, paths, corpus)
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump({"seconds": seconds, "items": items, "latencies": latencies, "peak_rss": peak_rss()}, f)
+
+
+def stage_row(result):
+    """Throughput, latency percentiles (None for stages without per-file
+    timings) and peak RSS for one stage result."""
+    latencies = sorted(result["latencies"])
+    return {
+        "seconds": round(result["seconds"], 3),
+        "items": result["items"],
+        "per_second": round(result["items"] / result["seconds"], 1) if result["seconds"] else 0.0,
+        **{f"p{q}_ms": round(1000 * analyzer._percentile(latencies, q), 1) if latencies else None
+           for q in (50, 95, 99)},
+        "peak_rss_mb": round(result["peak_rss"] / 1_000_000, 1),
+    }
+
+
+QUEUE_PROBE = "import sys, benchmark; benchmark.queue_child(*sys.argv[1:])"
+
+
+def queue_paths(config, tmpdir, index):
+    """Output paths of worker `index`; with a tmpdir, a log of its own."""
+    paths = analyzer.output_paths(config)
+    if tmpdir:
+        base = Path(tmpdir) / f"worker{index}"
+        paths.update(base=base, log=str(base / "processed_files.db"), text_cache=base / "text_cache.db",
+                     metrics=base / "metrics.json")
+    return paths
+
+
+def queue_config(corpus, queue_path, lease, workers):
+    config = analyzer.load_config()
+    config.update(SUITE_CONFIG, folders=[corpus], workers=int(workers), work_queue=queue_path,
+                  work_queue_lease=float(lease))
+    return config
+
+
+def queue_child(index, corpus, queue_path, lease, workers, logs_dir, result_path):
+    """Entry point of one worker process started by bench_queue."""
+    config = queue_config(corpus, queue_path, lease, workers)
+    paths = queue_paths(config, logs_dir, index)
+    args = argparse.Namespace(folder=None, profile=False, refresh=False, workers=None, batch=False, queue=None,
+                              extract_workers=None, retry_failed=False)
+    metrics = analyzer.Metrics(command="analyze")
+    started = time.perf_counter()
+    analyzer.cmd_analyze(args, config, paths, metrics)
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump({"seconds": time.perf_counter() - started, "calls": metrics.counters["analysis"]["calls"],
+                   **metrics.counters["work_queue"]}, f)
+
+
+def bench_queue(args):
+    server, base_url = start_server(0, args.latency, args.jitter, 0.0, 0.0, 0, 0.0, False, args.error_rate)
+    env = {**os.environ, "ANTHROPIC_BASE_URL": base_url, "ANTHROPIC_API_KEY": "fake"}
+    here = Path(__file__).parent
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = Path(args.corpus or Path(tmpdir) / "korpus").resolve()
+        if not corpus.exists():
+            make_corpus(corpus, args.files, args.words, args.seed, args.duplicates)
+        shutil.rmtree(corpus / "analyzer", ignore_errors=True)
+        queue_path = str(Path(tmpdir) / "work_queue.db")
+        logs_dir = tmpdir if args.separate_logs else ""
+
+        started = time.perf_counter()
+        processes = []
+        for index in range(args.processes):
+            output = open(Path(tmpdir) / f"worker{index}.log", "w+", encoding="utf-8")
+            command = [sys.executable, "-c", QUEUE_PROBE, str(index), str(corpus), queue_path, str(args.lease),
+                       str(args.workers), logs_dir, str(Path(tmpdir) / f"worker{index}.json")]
+            processes.append((subprocess.Popen(command, cwd=here, env=env, stdout=output, stderr=output), output))
+        if args.kill_after is not None:
+            time.sleep(args.kill_after)
+            processes[0][0].kill()
+            print(f"Killed worker 0 after {args.kill_after} s")
+        for process, output in processes:
+            process.wait()
+            output.close()
+        seconds = time.perf_counter() - started
+        server.shutdown()
+
+        print(f"{'worker':<12}{'seconds':>9}{'claimed':>9}{'taken over':>12}{'from queue':>12}{'calls':>7}")
+        for index, (process, _) in enumerate(processes):
+            result_path = Path(tmpdir) / f"worker{index}.json"
+            if not result_path.exists():
+                print(f"{index:<12}{'exited with ' + str(process.returncode):>49}")
+                continue
+            result = json.loads(result_path.read_text(encoding="utf-8"))
+            print(f"{index:<12}{result['seconds']:>9.1f}{result['claimed']:>9}{result['taken_over']:>12}"
+                  f"{result['from_queue']:>12}{result['calls']:>7}")
+
+        queue_db = analyzer.WorkQueue(queue_path, args.lease)
+        distinct = queue_db.conn.execute(
+            """SELECT COUNT(*) FROM work
+               WHERE analysis IS NOT NULL AND json_extract(analysis, '$.near_duplicate_of') IS NULL"""
+        ).fetchone()[0]
+        queue_db.close()
+        print(f"{args.processes} workers in {seconds:.1f} s: {server.calls} API calls for {distinct} distinct "
+              f"contents ({server.calls - distinct} repeated, {server.errors} failed)")
+
+        # Every surviving worker's log (or the shared one) should hold every file
+        config = queue_config(corpus, queue_path, args.lease, args.workers)
+        missing = 0
+        checked = range(1 if args.kill_after is not None else 0, args.processes) if logs_dir else [0]
+        for index in checked:
+            log = analyzer.load_log(queue_paths(config, logs_dir, index)["log"])
+            pending = analyzer.find_files(config["folders"], config["extensions"], log)
+            log.close()
+            if pending:
+                print(f"Log of worker {index} is missing {len(pending)} files")
+                missing += len(pending)
+    if missing:
+        sys.exit(1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_run(results_path, params):
+    """The last saved run with the same parameters, or None."""
+    if not Path(results_path).exists():
+        return None
+    previous = None
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["params"] == params:
+                previous = record
+    return previous
+
+
+def change(new, old):
+    return (new - old) / old if old else 0.0
+
+
+def bench_suite(args):
+    config = analyzer.load_config()
+    workers = args.workers or config.get("workers", 1)
+    params = {
+        "files": args.files, "words": args.words, "seed": args.seed, "duplicates": args.duplicates,
+        "latency": args.latency, "jitter": args.jitter, "malformed_rate": args.malformed_rate,
+        "overload_rate": args.overload_rate, "error_rate": args.error_rate, "workers": workers,
+        "report_writer": config.get("report_writer", "docx"),
+        "near_duplicate_threshold": config.get("near_duplicate_threshold"),
+    }
+    here = Path(__file__).parent
+    server, base_url = start_server(0, args.latency, args.jitter, 0.0, args.malformed_rate, 0,
+                                    args.overload_rate, False, args.error_rate)
+    env = {**os.environ, "ANTHROPIC_BASE_URL": base_url, "ANTHROPIC_API_KEY": "fake"}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = Path(args.corpus or Path(tmpdir) / "korpus").resolve()
+        if not corpus.exists():
+            started = time.perf_counter()
+            make_corpus(corpus, args.files, args.words, args.seed, args.duplicates)
+            print(f"Corpus of {args.files} files written in {time.perf_counter() - started:.1f} s")
+        shutil.rmtree(corpus / "analyzer", ignore_errors=True)
+
+        rows = {}
+        for stage in SUITE_STAGES:
+            result_path = Path(tmpdir) / f"{stage}.json"
+            with open(Path(tmpdir) / f"{stage}.log", "w+", encoding="utf-8") as output:
+                process = subprocess.run([sys.executable, "-c", STAGE_PROBE, stage, str(corpus), str(workers),
+                                          str(result_path)], cwd=here, env=env, stdout=output, stderr=output)
+                if process.returncode:
+                    output.seek(0)
+                    print(f"Stage {stage} failed:\n{output.read()[-2000:]}")
+                    sys.exit(1)
+            rows[stage] = stage_row(json.loads(result_path.read_text(encoding="utf-8")))
+    server.shutdown()
+
+    previous = previous_run(args.results, params)
+    print(f"{'stage':<10}{'items':>7}{'seconds':>9}{'items/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'peak MB':>9}" + (f"{'Δ time':>9}{'Δ RSS':>8}" if previous else ""))
+    regressions = []
+    for stage, row in rows.items():
+        percentiles = "".join(f"{'-' if row[key] is None else row[key]:>9}" for key in ("p50_ms", "p95_ms", "p99_ms"))
+        line = (f"{stage:<10}{row['items']:>7}{row['seconds']:>9.2f}{row['per_second']:>9.1f}"
+                f"{percentiles}{row['peak_rss_mb']:>9.1f}")
+        old = previous["stages"].get(stage) if previous else None
+        if old:
+            time_change = change(row["seconds"], old["seconds"])
+            rss_change = change(row["peak_rss_mb"], old["peak_rss_mb"])
+            line += f"{time_change:>+9.0%}{rss_change:>+8.0%}"
+            # Ignore differences too small to measure reliably
+            slower = time_change > args.tolerance and row["seconds"] - old["seconds"] > 0.05
+            if slower or rss_change > args.tolerance:
+                regressions.append(stage)
+                line += "  !"
+        print(line)
+    if previous:
+        print(f"Compared with {previous['commit'] or 'a run'} from {previous['timestamp']}.")
+
+    if args.save:
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+            "stages": rows,
+        }
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Saved to {args.results}")
+    if regressions:
+        print(f"Regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for analyzer.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="Budgeted vs full PDF text extraction")
+    extract.add_argument("--pages", type=int, default=500)
+    extract.set_defaults(func=bench_extract)
+
+    corpus_options = argparse.ArgumentParser(add_help=False)
+    corpus_options.add_argument("--files", type=int, default=1000)
+    corpus_options.add_argument("--words", type=int, default=800, help="Median words per document")
+    corpus_options.add_argument("--seed", type=int, default=1)
+    corpus_options.add_argument("--duplicates", type=float, default=0.05, help="Share of byte-identical copies")
+
+    ooxml = commands.add_parser("ooxml", help="DOCX/PPTX text from the zip vs python-docx/-pptx",
+                                parents=[corpus_options])
+    ooxml.add_argument("--corpus", help="Reuse (or create) the corpus in this directory")
+    ooxml.add_argument("--big-words", type=int, default=200000, help="Words in the large DOCX")
+    ooxml.add_argument("--slides", type=int, default=300, help="Slides in the large PPTX")
+    ooxml.add_argument("--budget", type=int, default=20000, help="Character budget (extract_chars)")
+    ooxml.set_defaults(func=bench_ooxml)
+
+    report = commands.add_parser("report", help="Word report build time and memory")
+    report.add_argument("--entries", type=int, default=10000)
+    report.set_defaults(func=bench_report)
+
+    imports = commands.add_parser("imports", help="Startup time of the offline stages")
+    imports.add_argument("--runs", type=int, default=5)
+    imports.add_argument("--limit", type=float, default=0.5, help="Maximum median startup in seconds")
+    imports.set_defaults(func=bench_imports)
+
+    corpus = commands.add_parser("corpus", help="Write a reproducible multi-format corpus",
+                                 parents=[corpus_options])
+    corpus.add_argument("directory")
+    corpus.set_defaults(func=bench_corpus)
+
+    suite = commands.add_parser("suite", help="All stages end to end against the fake API",
+                                parents=[corpus_options])
+    suite.add_argument("--corpus", help="Reuse (or create) the corpus in this directory")
+    suite.add_argument("--workers", type=int, help="Concurrent API calls (default: config.yaml)")
+    suite.add_argument("--latency", type=float, default=0.05, help="Seconds per fake API call")
+    suite.add_argument("--jitter", type=float, default=0.02)
+    suite.add_argument("--malformed-rate", type=float, default=0.0)
+    suite.add_argument("--overload-rate", type=float, default=0.0)
+    suite.add_argument("--error-rate", type=float, default=0.0)
+    suite.add_argument("--results", default=str(Path(__file__).parent / "benchmark-results.jsonl"))
+    suite.add_argument("--save", action="store_true", help="Append this run to the results file")
+    suite.add_argument("--check", action="store_true", help="Exit with status 1 on a regression")
+    suite.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown or growth (0.10 = 10%%)")
+    suite.set_defaults(func=bench_suite)
+
+    queue = commands.add_parser("queue", help="Several workers sharing one work queue",
+                                parents=[corpus_options])
+    queue.set_defaults(files=200)
+    queue.add_argument("--corpus", help="Reuse (or create) the corpus in this directory")
+    queue.add_argument("--processes", type=int, default=3, help="Worker processes")
+    queue.add_argument("--workers", type=int, default=4, help="Concurrent API calls per worker")
+    queue.add_argument("--lease", type=float, default=10, help="Lease in seconds")
+    queue.add_argument("--kill-after", type=float, help="Kill worker 0 after this many seconds")
+    queue.add_argument("--separate-logs", action="store_true",
+                       help="A log per worker, as on separate machines")
+    queue.add_argument("--latency", type=float, default=0.2, help="Seconds per fake API call")
+    queue.add_argument("--jitter", type=float, default=0.05)
+    queue.add_argument("--error-rate", type=float, default=0.0)
+    queue.set_defaults(func=bench_queue)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
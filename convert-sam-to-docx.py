@@ -1,9 +1,11 @@
-import re
-import sys
+import argparse
 import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from docx import Document
-from docx.shared import Pt
+from docx.shared import Cm
 
 # Mappning av Ami Pro escape-koder till Unicode
 ESCAPE_MAP = {
@@ -26,19 +28,16 @@ STYLE_MAP = {
     'Body Text':'Normal',
 }
 
-def replace_escapes(text):
-    for code, char in ESCAPE_MAP.items():
-        text = text.replace(code, char)
-    return text
+# Escape-koder och formateringskoder (<:f>, <:s>, <:#548,6151>, <*-> etc)
+# ersätts i ett enda pass: kända escape-koder blir tecken, allt annat tas bort
+AMI_CODE = re.compile(r'<[^>]*>')
+STYLE_LINE = re.compile(r'^@([^@]+)@(.*)')
+
+def replace_code(match):
+    return ESCAPE_MAP.get(match.group(), '')
 
 def clean_line(line):
-    # Ersätt escape-koder
-    line = replace_escapes(line)  # Först!
-    # Ta bort formateringskoder som <:f>, <:s>, <:#548,6151> etc
-    line = re.sub(r'<:[^>]*>', '', line)
-    # Ta bort <*-> och liknande
-    line = re.sub(r'<[^>]*>', '', line)
-    return line.strip()
+    return AMI_CODE.sub(replace_code, line).strip()
 
 def parse_sam(filepath):
     with open(filepath, 'r', encoding='cp1252', errors='replace') as f:
@@ -51,8 +50,6 @@ def parse_sam(filepath):
         body = content
     else:
         body = content[edoc_pos + len('[edoc]'):]
-    # Debug: visa råtext runt första escape-koden
-    pos = body.find('<\\')
 
     paragraphs = []
     for line in body.splitlines():
@@ -69,7 +66,7 @@ def parse_sam(filepath):
             continue
 
         # Kontrollera om raden börjar med ett styckeformat: @Rubrik@, @Bomb@ etc
-        style_match = re.match(r'^@([^@]+)@(.*)', line)
+        style_match = STYLE_LINE.match(line)
         if style_match:
             style_name = style_match.group(1).strip()
             text = clean_line(style_match.group(2))
@@ -83,14 +80,13 @@ def parse_sam(filepath):
 
     return paragraphs
 
-def convert(sam_path):
+# .docx-filen sparas bredvid källfilen, med filnamnet i lowercase. Bara
+# namnet: mapparna i sökvägen finns redan och ska inte byta skiftläge
+def output_path(sam_path):
     sam_path = Path(sam_path)
-    out_path = sam_path.with_suffix('.docx')
-    out_path = Path(str(out_path).lower())
-
-    print(f"Läser: {sam_path}")
-    paragraphs = parse_sam(sam_path)
+    return sam_path.with_name(sam_path.stem.lower() + '.docx')
 
+def write_docx(paragraphs, out_path):
     doc = Document()
 
     for style, text, style_name in paragraphs:
@@ -98,58 +94,127 @@ def convert(sam_path):
             p = doc.add_paragraph(text, style=style)
         except Exception:
             p = doc.add_paragraph(text)
-        
+
         if style_name in ('Bibeltext', 'Bibeltext2'):
             # Kursiv text
             for run in p.runs:
                 run.italic = True
             # Indrag
-            from docx.shared import Cm
             p.paragraph_format.left_indent = Cm(1.5)
 
     doc.save(out_path)
+
+# Konvertera en enstaka fil. .docx-filen får källans tidsstämplar, som vid
+# konvertering av en hel mapp, så att up_to_date känner igen den
+def convert(sam_path):
+    sam_path = Path(sam_path)
+    out_path = output_path(sam_path)
+
+    print(f"Läser: {sam_path}")
+    stat = sam_path.stat()
+    paragraphs = parse_sam(sam_path)
+    write_docx(paragraphs, out_path)
+    os.utime(out_path, (stat.st_atime, stat.st_mtime))
     print(f"Sparad: {out_path}")
     print(f"Antal stycken: {len(paragraphs)}")
 
-import os
-
-def convert_all(folder="."):
+# Konvertera en fil och ge .docx-filen källans tidsstämplar. Körs i en
+# arbetsprocess vid parallell konvertering, så fel returneras i stället
+# för att kastas
+def convert_file(sam_path):
+    sam_path = Path(sam_path)
+    try:
+        # Spara tidsstämplar
+        stat = sam_path.stat()
+        paragraphs = parse_sam(sam_path)
+        write_docx(paragraphs, output_path(sam_path))
+        # Återställ tidsstämplar på den nya .docx-filen
+        os.utime(output_path(sam_path), (stat.st_atime, stat.st_mtime))
+        return len(paragraphs), stat.st_size, None
+    except Exception as e:
+        return 0, 0, str(e)
+
+# Hitta .SAM-filer i mappen (och undermappar med recursive), en per
+# namn oavsett skiftläge i varje mapp
+def find_sam_files(folder, recursive=False):
     folder = Path(folder)
     seen = set()
     sam_files = []
-    for f in folder.iterdir():
-        if f.suffix.lower() == '.sam' and f.name.lower() not in seen:
-            seen.add(f.name.lower())
+    candidates = folder.rglob('*') if recursive else folder.iterdir()
+    for f in sorted(candidates):
+        key = (f.parent, f.name.lower())
+        if f.suffix.lower() == '.sam' and key not in seen and f.is_file():
+            seen.add(key)
             sam_files.append(f)
-    
+    return sam_files
+
+# En .docx som har källans tidsstämpel eller är nyare behöver inte
+# konverteras igen
+def up_to_date(sam_path):
+    try:
+        return output_path(sam_path).stat().st_mtime >= sam_path.stat().st_mtime
+    except OSError:
+        return False
+
+def convert_all(folder=".", recursive=False, workers=None, force=False):
+    started = time.perf_counter()
+    sam_files = find_sam_files(folder, recursive)
+
     if not sam_files:
         print("Inga .SAM-filer hittades.")
         return
-    
-    print(f"Hittade {len(sam_files)} filer.\n")
-    
-    for sam_path in sam_files:
-        try:
-            # Spara tidsstämplar
-            stat = sam_path.stat()
-            mtime = stat.st_mtime
-            atime = stat.st_atime
-
-            convert(sam_path)
 
-            # Återställ tidsstämplar på den nya .docx-filen
-            out_path = Path(str(sam_path.with_suffix('.docx')).lower())
-            os.utime(out_path, (atime, mtime))
+    todo = sam_files if force else [f for f in sam_files if not up_to_date(f)]
+    skipped = len(sam_files) - len(todo)
+    print(f"Hittade {len(sam_files)} filer, {skipped} redan konverterade.\n")
+
+    workers = workers or os.cpu_count() or 1
+    converted = failed = size = 0
+    failures = []
+
+    def done(sam_path, result):
+        nonlocal converted, failed, size
+        paragraphs, nbytes, error = result
+        if error:
+            failed += 1
+            failures.append(sam_path)
+            print(f"  ✗ Fel vid konvertering av {sam_path}: {error}")
+        else:
+            converted += 1
+            size += nbytes
+            print(f"  ✓ [{converted + failed}/{len(todo)}] {output_path(sam_path)} ({paragraphs} stycken)")
 
-        except Exception as e:
-            print(f"  ✗ Fel vid konvertering av {sam_path.name}: {e}")
+    if workers == 1 or len(todo) < 2:
+        for sam_path in todo:
+            done(sam_path, convert_file(sam_path))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            futures = {pool.submit(convert_file, sam_path): sam_path for sam_path in todo}
+            for future in as_completed(futures):
+                done(futures[future], future.result())
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"\nKonverterade: {converted}, överhoppade: {skipped}, misslyckade: {failed}"
+          f" på {elapsed:.1f} s ({converted / elapsed:.1f} filer/s, {size / 1e6 / elapsed:.2f} MB/s)")
+    if failures:
+        print("Misslyckade filer:")
+        for sam_path in failures:
+            print(f"  {sam_path}")
+    return {"converted": converted, "skipped": skipped, "failed": failed, "seconds": elapsed}
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        arg = sys.argv[1]
-        if arg.lower().endswith('.sam'):
-            convert(sys.argv[1])
-        else:
-            convert_all(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Konvertera Ami Pro .SAM-filer till DOCX")
+    parser.add_argument("path", nargs="?", default=".",
+                        help="En .SAM-fil eller en mapp (standard: aktuell mapp)")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Konvertera även filer i undermappar")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Antal parallella processer (standard: antal kärnor)")
+    parser.add_argument("--force", action="store_true",
+                        help="Konvertera även filer vars .docx redan är aktuell")
+    args = parser.parse_args()
+
+    if args.path.lower().endswith('.sam'):
+        convert(args.path)
     else:
-        convert_all()
+        convert_all(args.path, args.recursive, args.workers, args.force)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Anthropic Messages API.
+
+Serves just enough of /v1/messages and /v1/messages/batches for
+analyzer.py to run end-to-end without network access or cost, with
+configurable latency. Requests that offer tools are answered with a
+tool_use block, and cacheable system prompts long enough for the model's
+minimum are reported as prompt-cache writes and reads. --rpm enforces a
+per-minute request limit with 429 answers and rate-limit headers,
+--overload-rate injects 529s and --error-rate 500s. Batches are kept in
+memory and end --batch-delay seconds after they were created, so keep the
+server running across analyzer runs to exercise resumption.
+
+Tools that ask for a confidence (the triage tool) get one: low for
+--low-confidence-rate of the filenames, high for the rest. Models with
+"haiku" in the name answer after --fast-latency seconds, to mimic a
+two-tier setup.
+
+Packed requests (a tool with an "analyses" array) get one analysis per
+"Filnamn:" line; --malformed-rate then drops single entries instead of
+breaking the whole answer, and each extra document adds --document-latency
+seconds, since longer answers take longer to generate.
+
+Usage:
+    fake_claude.py [--port 8765] [--latency 0.5] [--jitter 0.2] [--batch-delay 5]
+                   [--malformed-rate 0.1] [--rpm 60] [--overload-rate 0.05] [--error-rate 0.01]
+                   [--low-confidence-rate 0.2] [--fast-latency 0.1] [--document-latency 0.1]
+
+Point analyzer.py at it with:
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=fake python analyzer.py ...
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TYPES = ["artikel", "uppsats", "bok", "predikan", "studie", "övrigt"]
+
+
+def make_analysis(filename):
+    """Return a deterministic, plausible analysis for a filename."""
+    digest = int(hashlib.sha1(filename.encode("utf-8")).hexdigest(), 16)
+    doc_type = TYPES[digest % len(TYPES)]
+    stem = filename.rsplit(".", 1)[0]
+    return {
+        "title": stem.replace("_", " ").replace("-", " ").capitalize(),
+        "author": "Testsson, Test",
+        "summary": f"Automatiskt genererad sammanfattning av {filename}.",
+        "type": doc_type,
+        "year": 1950 + digest % 70,
+        "date_full": None,
+        "is_citable": doc_type not in ("predikan", "övrigt"),
+        "publication": "Testtidskriften" if doc_type == "artikel" else None,
+        "publisher": "Testförlaget" if doc_type == "bok" else None,
+        "publisher_place": "Stockholm" if doc_type == "bok" else None,
+        "isbn": None,
+        "pages_total": 10 + digest % 300,
+        "edition": None,
+        "institution": "Testuniversitetet" if doc_type == "uppsats" else None,
+        "institution_place": "Uppsala" if doc_type == "uppsats" else None,
+        "thesis_type": "Masteruppsats" if doc_type == "uppsats" else None,
+    }
+
+
+def prompt_text(body):
+    """Flatten the text parts of a Messages API request body."""
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content if block.get("type") == "text")
+    return "\n".join(parts)
+
+
+def system_text(body):
+    """Return the system prompt text and whether it is marked for caching."""
+    system = body.get("system") or ""
+    if isinstance(system, str):
+        return system, False
+    text = "\n".join(block.get("text", "") for block in system)
+    return text, any(block.get("cache_control") for block in system)
+
+
+# Shortest prefix (tools + system prompt) the API caches, by model family;
+# other models cache from 1024 tokens.
+MIN_CACHE_TOKENS = [("haiku-4-5", 4096), ("opus-4-5", 4096), ("3-5-haiku", 2048), ("3-haiku", 2048)]
+
+
+def min_cache_tokens(model):
+    return next((tokens for family, tokens in MIN_CACHE_TOKENS if family in model), 1024)
+
+
+def malform(answer):
+    """Damage a JSON answer the way models occasionally do."""
+    return f"Här är analysen:\n```json\n{answer[:-1]},\n}}\n```"
+
+
+def filenames(text):
+    """Return the documents' filenames in a prompt, in order."""
+    return [name.strip() for name in re.findall(r"^Filnamn: (.+)$", text, re.MULTILINE)]
+
+
+def tool_use(tool, data):
+    return {"type": "tool_use", "id": f"toolu_fake_{uuid.uuid4().hex[:24]}", "name": tool["name"], "input": data}
+
+
+def make_message(server, body):
+    """Build a Messages API response for a request body.
+
+    Answers with a tool_use block when the request offers tools, otherwise
+    with JSON text; packed requests get an array with one analysis per
+    document. A cacheable system prompt is billed as a cache write the
+    first time it is seen and as a cache read afterwards, but only when the
+    prefix reaches the model's minimum cacheable length; shorter prefixes
+    are billed as plain input, as the API does.
+    """
+    text = prompt_text(body)
+    names = filenames(text) or ["okänd.txt"]
+    filename = names[0]
+    analysis = make_analysis(filename)
+    answer = json.dumps(analysis, ensure_ascii=False)
+    tool = body["tools"][0] if body.get("tools") else None
+    if tool and "analyses" in tool["input_schema"]["properties"]:
+        packed = {"analyses": [{"filename": name, **make_analysis(name)} for name in names
+                               if random.random() >= server.malformed_rate]}
+        answer = json.dumps(packed, ensure_ascii=False)
+        content = [tool_use(tool, packed)]
+    elif random.random() < server.malformed_rate:
+        content = [{"type": "text", "text": malform(answer)}]
+    elif tool:
+        if "confidence" in tool["input_schema"]["properties"]:
+            digest = int(hashlib.sha1(f"confidence:{filename}".encode("utf-8")).hexdigest(), 16)
+            low = digest % 1000 < server.low_confidence_rate * 1000
+            analysis = {**analysis, "confidence": 0.3 + digest % 30 / 100 if low else 0.75 + digest % 25 / 100}
+        content = [tool_use(tool, analysis)]
+    else:
+        content = [{"type": "text", "text": answer}]
+
+    system, cacheable = system_text(body)
+    prefix_tokens = (len(system) + len(json.dumps(body.get("tools") or []))) // 4
+    cache_read = cache_write = 0
+    if cacheable and prefix_tokens >= min_cache_tokens(body.get("model", "")):
+        key = hashlib.sha1(system.encode("utf-8")).hexdigest()
+        with server.lock:
+            seen = key in server.cached_prefixes
+            server.cached_prefixes.add(key)
+        cache_read, cache_write = (prefix_tokens, 0) if seen else (0, prefix_tokens)
+        prefix_tokens = 0
+    return {
+        "id": f"msg_fake_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "fake"),
+        "content": content,
+        "stop_reason": "tool_use" if content[0]["type"] == "tool_use" else "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": len(text) // 4 + prefix_tokens,
+            "output_tokens": len(answer) // 4,
+            "cache_creation_input_tokens": cache_write,
+            "cache_read_input_tokens": cache_read,
+        },
+    }
+
+
+def take_request(server):
+    """Take one request from the server's per-minute bucket.
+
+    Returns (allowed, headers) with Anthropic-style rate-limit headers,
+    including retry-after when the request is refused.
+    """
+    if not server.rpm:
+        return True, {}
+    with server.lock:
+        now = time.monotonic()
+        server.bucket = min(server.rpm, server.bucket + (now - server.bucket_updated) * server.rpm / 60)
+        server.bucket_updated = now
+        allowed = server.bucket >= 1
+        if allowed:
+            server.bucket -= 1
+        refill = (server.rpm - server.bucket) * 60 / server.rpm
+        headers = {
+            "anthropic-ratelimit-requests-limit": str(server.rpm),
+            "anthropic-ratelimit-requests-remaining": str(int(server.bucket)),
+            "anthropic-ratelimit-requests-reset": _timestamp(time.time() + refill),
+        }
+        if not allowed:
+            server.throttled += 1
+            headers["retry-after"] = str(math.ceil((1 - server.bucket) * 60 / server.rpm))
+    return allowed, headers
+
+
+def _timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+def batch_object(server, batch):
+    """Build a MessageBatch response, ending the batch once its delay has passed."""
+    ended = time.time() >= batch["created"] + server.batch_delay
+    total = len(batch["requests"])
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else total,
+            "succeeded": total - len(batch["errored"]) if ended else 0,
+            "errored": len(batch["errored"]) if ended else 0,
+            "canceled": 0,
+            "expired": 0,
+        },
+        "created_at": _timestamp(batch["created"]),
+        "expires_at": _timestamp(batch["created"] + 86400),
+        "ended_at": _timestamp(batch["created"] + server.batch_delay) if ended else None,
+        "archived_at": None,
+        "cancel_initiated_at": None,
+        "results_url": f"{base_url}/v1/messages/batches/{batch['id']}/results" if ended else None,
+    }
+
+
+class FakeClaudeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up or was killed mid-call
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sleep(self, model="", documents=1):
+        server = self.server
+        latency = server.fast_latency if "haiku" in model and server.fast_latency is not None else server.latency
+        latency += (documents - 1) * server.document_latency
+        time.sleep(max(0.0, latency + random.uniform(-server.jitter, server.jitter)))
+
+    def _not_found(self):
+        self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/v1/messages":
+            allowed, headers = take_request(self.server)
+            if not allowed:
+                return self._send_json(429, {"type": "error", "error": {
+                    "type": "rate_limit_error", "message": "Number of requests has exceeded your rate limit"}},
+                    headers)
+            if random.random() < self.server.overload_rate:
+                with self.server.lock:
+                    self.server.overloaded += 1
+                return self._send_json(529, {"type": "error", "error": {
+                    "type": "overloaded_error", "message": "Overloaded"}})
+            if random.random() < self.server.error_rate:
+                with self.server.lock:
+                    self.server.errors += 1
+                return self._send_json(500, {"type": "error", "error": {
+                    "type": "api_error", "message": "Internal server error"}})
+            self._sleep(body.get("model", ""), max(1, len(filenames(prompt_text(body)))))
+            with self.server.lock:
+                self.server.calls += 1
+            self._send_json(200, make_message(self.server, body), headers)
+        elif path == "/v1/messages/batches":
+            requests = body.get("requests", [])
+            batch = {
+                "id": f"msgbatch_fake_{uuid.uuid4().hex[:24]}",
+                "created": time.time(),
+                "requests": requests,
+                # Decided up front, so that the counts and the results agree
+                "errored": {request["custom_id"] for request in requests
+                            if random.random() < self.server.error_rate},
+            }
+            with self.server.lock:
+                self.server.batches[batch["id"]] = batch
+                self.server.batched_requests += len(batch["requests"])
+            self._send_json(200, batch_object(self.server, batch))
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) not in (4, 5):
+            return self._not_found()
+        batch = self.server.batches.get(parts[3])
+        if batch is None:
+            return self._not_found()
+        if len(parts) == 4:
+            return self._send_json(200, batch_object(self.server, batch))
+        if parts[4] != "results" or batch_object(self.server, batch)["processing_status"] != "ended":
+            return self._not_found()
+
+        lines = [
+            json.dumps({
+                "custom_id": request["custom_id"],
+                "result": {"type": "errored", "error": {"type": "error", "error": {
+                    "type": "api_error", "message": "Internal server error"}}}
+                if request["custom_id"] in batch["errored"]
+                else {"type": "succeeded", "message": make_message(self.server, request["params"])},
+            }, ensure_ascii=False)
+            for request in batch["requests"]
+        ]
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(port=0, latency=0.5, jitter=0.0, batch_delay=5.0, malformed_rate=0.0, rpm=0,
+                 overload_rate=0.0, verbose=False, error_rate=0.0, low_confidence_rate=0.2, fast_latency=None,
+                 document_latency=0.1):
+    """Start the fake API in a background thread; return (server, base_url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeClaudeHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.batch_delay = batch_delay
+    server.malformed_rate = malformed_rate
+    server.rpm = rpm
+    server.bucket = float(rpm)
+    server.bucket_updated = time.monotonic()
+    server.overload_rate = overload_rate
+    server.error_rate = error_rate
+    server.low_confidence_rate = low_confidence_rate
+    server.fast_latency = fast_latency
+    server.document_latency = document_latency
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.batches = {}
+    server.batched_requests = 0
+    server.cached_prefixes = set()
+    server.throttled = 0
+    server.overloaded = 0
+    server.errors = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake of the Anthropic Messages API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- seconds per call")
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="Seconds until a batch ends")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of answers sent as broken JSON text instead of a tool call")
+    parser.add_argument("--rpm", type=int, default=0,
+                        help="Requests per minute before answering 429 (0 = unlimited)")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="Share of calls answered with 529")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of calls answered with 500 and of batch requests that end errored")
+    parser.add_argument("--low-confidence-rate", type=float, default=0.2,
+                        help="Share of files the triage tool is unsure about")
+    parser.add_argument("--fast-latency", type=float, help="Seconds per call for haiku models (default: --latency)")
+    parser.add_argument("--document-latency", type=float, default=0.1,
+                        help="Extra seconds per additional document in a packed request")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.port, args.latency, args.jitter, args.batch_delay,
+                                    args.malformed_rate, args.rpm, args.overload_rate, args.verbose,
+                                    args.error_rate, args.low_confidence_rate, args.fast_latency,
+                                    args.document_latency)
+    print(f"Fake Claude API on {base_url} (Ctrl-C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"{server.calls} calls answered, {server.throttled} throttled, {server.overloaded} overloaded, "
+              f"{server.errors} failed")
+
+
+if __name__ == "__main__":
+    main()
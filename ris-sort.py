@@ -1,13 +1,31 @@
 #!/usr/bin/env python3
-"""Sort a RIS file by author (AU), date (DA/PY), and title (TI).
+"""Sort RIS files by author (AU), date (DA/PY), and title (TI).
+
+Authors and titles are compared in Swedish alphabetical order (å, ä, ö
+after z). Files are read one record at a time and sorted in runs of
+bounded size that are merged from temporary files, so libraries larger
+than memory can be sorted.
 
 Usage:
-    ris-sort.py file.ris      # sort specified file
-    ris-sort.py               # sort the single .ris file in current directory
+    ris-sort.py file.ris                  # sort specified file
+    ris-sort.py                           # sort the single .ris file in current directory
+    ris-sort.py a.ris b.ris -o all.ris    # merge and sort several files into one
+    ris-sort.py a.ris b.ris --dedupe      # ... dropping duplicate title/author/year
 """
 
-import sys
+import argparse
 import glob
+import heapq
+import json
+import os
+import re
+import sys
+import tempfile
+import unicodedata
+
+# Swedish order: å, ä, ö sort after z; æ/ø as ä/ö and ü as y
+SWEDISH_LETTERS = str.maketrans({"å": "{", "ä": "|", "æ": "|", "ö": "}", "ø": "}", "ü": "y"})
+NON_WORD = re.compile(r"[^\w{|}]+")
 
 
 def find_ris_file():
@@ -22,74 +40,166 @@ def find_ris_file():
     sys.exit(1)
 
 
-def parse_ris(path):
-    with open(path, encoding="utf-8") as f:
-        lines = f.readlines()
-
-    records = []
+def iter_records(path):
+    """Yield the records of a RIS file one at a time, as lists of lines."""
     current = []
-
-    for line in lines:
-        stripped = line.rstrip("\r\n")
-        if not stripped.strip():
-            continue  # skip blank lines between records
-        current.append(stripped)
-        if stripped[:2] == "ER":
-            records.append(current)
-            current = []
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            stripped = line.rstrip("\r\n")
+            if not stripped.strip():
+                continue  # skip blank lines between records
+            current.append(stripped)
+            if stripped[:2] == "ER":
+                yield current
+                current = []
 
     if current:  # trailing incomplete record
-        records.append(current)
-
-    return records
+        yield current
 
 
-def extract_field(record_lines, *tags):
-    """Return value of the first matching tag, in tag-priority order."""
+def first_fields(record_lines, tags):
+    """Return the first value of each wanted tag, scanning the record once."""
     found = {}
     for line in record_lines:
         if len(line) >= 6 and line[2:6] == "  - ":
             tag = line[:2]
             if tag in tags and tag not in found:
                 found[tag] = line[6:].strip()
-    for tag in tags:
-        if tag in found:
-            return found[tag]
-    return ""
+    return found
+
+
+def swedish(text):
+    """Collation key for Swedish text: case-insensitive, å/ä/ö after z,
+    other accents ignored, punctuation folded to single spaces."""
+    text = unicodedata.normalize("NFC", text).casefold().translate(SWEDISH_LETTERS)
+    text = "".join(c for c in unicodedata.normalize("NFD", text) if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", text).strip()
 
 
 def sort_key(record_lines):
-    au = extract_field(record_lines, "AU").lower()
-    date = extract_field(record_lines, "DA", "PY").lower()
-    ti = extract_field(record_lines, "TI").lower()
+    fields = first_fields(record_lines, ("AU", "DA", "PY", "TI"))
+    au = swedish(fields.get("AU", ""))
+    date = (fields.get("DA") or fields.get("PY") or "").lower()
+    ti = swedish(fields.get("TI", ""))
     return (au, date, ti)
 
 
-def write_ris(records, path):
+def sorted_runs(records, run_bytes, tmpdir):
+    """Sort records in runs of about run_bytes of text.
+
+    Yields the sorted (key, record) pairs directly when everything fits in
+    one run; otherwise writes each run to a temporary file and yields the
+    k-way merge of the runs.
+    """
+    runs = []
+    run = []
+    size = 0
+    for record in records:
+        run.append((sort_key(record), record))
+        size += sum(len(line) + 1 for line in record)
+        if size >= run_bytes:
+            runs.append(write_run(run, tmpdir))
+            run, size = [], 0
+
+    run.sort(key=lambda entry: entry[0])
+    if not runs:
+        yield from run
+        return
+    if run:
+        runs.append(write_run(run, tmpdir))
+
+    files = [open(path, encoding="utf-8") for path in runs]
+    try:
+        streams = [(json.loads(line) for line in f) for f in files]
+        for key, record in heapq.merge(*streams, key=lambda entry: entry[0]):
+            yield tuple(key), record
+    finally:
+        for f in files:
+            f.close()
+
+
+def write_run(run, tmpdir):
+    """Sort one run and write it as JSON lines; return the file path."""
+    run.sort(key=lambda entry: entry[0])
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for entry in run:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return path
+
+
+def dedupe_key(key, record_lines):
+    """Normalized (author, year, title) identifying the same work."""
+    fields = first_fields(record_lines, ("DA", "PY"))
+    year = re.search(r"\d{4}", fields.get("DA") or fields.get("PY") or "")
+    return (key[0], year.group() if year else "", key[2])
+
+
+def dedupe(entries, stats):
+    """Drop records already seen with the same author, year, and title.
+
+    Entries arrive sorted by author, so only the current author's group
+    has to be remembered.
+    """
+    author = None
+    seen = set()
+    for key, record in entries:
+        if key[0] != author:
+            author, seen = key[0], set()
+        ident = dedupe_key(key, record)
+        if ident in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(ident)
+        yield key, record
+
+
+def write_ris(entries, path):
+    """Write records separated by blank lines; return the number written."""
+    count = 0
     with open(path, "w", encoding="utf-8", newline="\n") as f:
-        for i, record in enumerate(records):
+        for _, record in entries:
+            if count:
+                f.write("\n")
             for line in record:
                 f.write(line + "\n")
-            if i < len(records) - 1:
-                f.write("\n")
+            count += 1
+    return count
 
 
 def main():
-    if len(sys.argv) == 2:
-        path = sys.argv[1]
-    elif len(sys.argv) == 1:
-        path = find_ris_file()
+    parser = argparse.ArgumentParser(description="Sort RIS files by author, date, and title")
+    parser.add_argument("files", nargs="*", help="RIS files (default: the single .ris file here)")
+    parser.add_argument("-o", "--output", help="Output file (default: [name]-sorted.ris, "
+                                               "or merged-sorted.ris for several files)")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Drop records with the same normalized author, year, and title")
+    parser.add_argument("--run-mb", type=int, default=64,
+                        help="Size of each in-memory sort run in MB (default 64)")
+    args = parser.parse_args()
+
+    paths = args.files or [find_ris_file()]
+    if args.output:
+        out_path = args.output
+    elif len(paths) == 1:
+        stem = paths[0][:-4] if paths[0].lower().endswith(".ris") else paths[0]
+        out_path = stem + "-sorted.ris"
     else:
-        print("Usage: ris-sort.py [file.ris]", file=sys.stderr)
-        sys.exit(1)
-
-    stem = path[:-4] if path.lower().endswith(".ris") else path
-    out_path = stem + "-sorted.ris"
-
-    records = parse_ris(path)
-    records.sort(key=sort_key)
-    write_ris(records, out_path)
-    print(f"Sorted {len(records)} records → {out_path}")
+        out_path = "merged-sorted.ris"
+
+    records = (record for path in paths for record in iter_records(path))
+    stats = {"duplicates": 0}
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmpdir:
+        entries = sorted_runs(records, args.run_mb * 1_000_000, tmpdir)
+        if args.dedupe:
+            entries = dedupe(entries, stats)
+        tmp_out = os.path.join(tmpdir, "sorted.ris")
+        count = write_ris(entries, tmp_out)
+        os.replace(tmp_out, out_path)
+
+    removed = f" ({stats['duplicates']} duplicates removed)" if args.dedupe else ""
+    print(f"Sorted {count} records → {out_path}{removed}")
 
 
 if __name__ == "__main__":
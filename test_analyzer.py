@@ -0,0 +1,443 @@
+"""Tests for analyzer.py against the fake Claude API in fake_claude.py,
+and for ris-sort.py.
+
+Run with `python -m pytest`. The fake server runs in-process, so no API
+key or network access is needed; the corpora are small .txt files in a
+temporary directory.
+"""
+
+import argparse
+import runpy
+import subprocess
+import sys
+import time
+from concurrent.futures import wait
+from pathlib import Path
+
+import pytest
+
+import analyzer
+from benchmark import HEAVY_MODULES
+from fake_claude import start_server
+
+RIS_SORT = Path(__file__).parent / "ris-sort.py"
+
+ESCALATE_TYPES = ["bok", "uppsats"]
+
+
+@pytest.fixture(scope="module")
+def server():
+    server, base_url = start_server(0, latency=0.01, batch_delay=0.5, document_latency=0.0)
+    server.base_url = base_url
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def api(server, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", server.base_url)
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "fake")
+    server.calls = 0
+    server.batched_requests = 0
+    return server
+
+
+def make_config(folder, **overrides):
+    config = analyzer.load_config()
+    config.update(
+        folders=[str(folder)], extensions=[".txt"], include=[], exclude=["analyzer"], workers=4,
+        extract_workers=1, requests_per_minute=None, input_tokens_per_minute=None, prometheus_textfile=None,
+        near_duplicate_threshold=None, work_queue=None, pack_max_tokens=None,
+    )
+    config["triage"] = {**config["triage"], "model": None}
+    config.update(overrides)
+    return config
+
+
+def write_corpus(folder, count, words=400):
+    """Text files with distinct contents; returns their paths in order."""
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = folder / f"dokument_{i:02d}.txt"
+        path.write_text(f"Dokument nummer {i}.\n" + " ".join(f"ord{i}_{j}" for j in range(words)), encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def analyze(config, files, log, metrics=None, workers=4):
+    """Run run_analysis the way cmd_analyze does; returns (results, stats, metrics)."""
+    metrics = metrics or analyzer.Metrics(command="analyze")
+    stats = metrics.counters["analysis"] = analyzer.new_stats()
+    with analyzer.open_lo_pool(config) as lo_pool:
+        results = analyzer.run_analysis(analyzer.make_client(), files, config, log, stats, lo_pool, workers,
+                                        metrics=metrics)
+    return results, stats, metrics
+
+
+def cmd_analyze(config, batch=False):
+    """Run the analyze step like the command line; returns its metrics."""
+    args = argparse.Namespace(folder=None, profile=False, refresh=False, workers=None, batch=batch, queue=None,
+                              extract_workers=None, retry_failed=False)
+    metrics = analyzer.Metrics(command="analyze")
+    analyzer.cmd_analyze(args, config, analyzer.output_paths(config), metrics)
+    return metrics
+
+
+def test_default_mode_analyzes_each_file_once(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 8)
+    config = make_config(tmp_path / "korpus")
+    log = analyzer.LogStore(tmp_path / "log.db")
+
+    results, stats, _ = analyze(config, files, log)
+    assert sorted(r["filepath"] for r in results) == files
+    assert all(path in log for path in files)
+    assert api.calls == stats["calls"] == len(files)
+    assert stats["input_tokens"] > 0
+
+    # A second run finds every content in the log and sends nothing
+    api.calls = 0
+    _, stats, _ = analyze(config, files, log)
+    assert api.calls == 0
+    assert stats["hits"] == len(files)
+    log.close()
+
+
+def test_prompt_cache_is_used_only_above_the_minimum_prefix_length(api, tmp_path, monkeypatch):
+    files = write_corpus(tmp_path / "korpus", 4)
+    config = make_config(tmp_path / "korpus")
+    model = config["anthropic"]["model"]
+
+    # The real prefix is shorter than the model's minimum: no cache_control
+    # is sent and nothing is billed as a cache read or write
+    assert not analyzer.cacheable_prefix(model)
+    assert "cache_control" not in analyzer.request_params(model, 100, files[0], "")["system"][0]
+    log = analyzer.LogStore(tmp_path / "log.db")
+    _, stats, _ = analyze(config, files, log)
+    assert stats["cache_read_tokens"] == stats["cache_write_tokens"] == 0
+    log.close()
+
+    # A prefix long enough is written once and read by the other calls
+    monkeypatch.setattr(analyzer, "SYSTEM_PROMPT", analyzer.SYSTEM_PROMPT * 4)
+    assert analyzer.cacheable_prefix(model)
+    assert not analyzer.cacheable_prefix("claude-haiku-4-5")
+    log = analyzer.LogStore(tmp_path / "log2.db")
+    _, stats, _ = analyze(config, files, log, workers=1)
+    assert stats["cache_write_tokens"] > 0
+    assert stats["cache_read_tokens"] == 3 * stats["cache_write_tokens"]
+    log.close()
+
+
+def test_triage_escalates_some_documents(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 20)
+    config = make_config(tmp_path / "korpus")
+    config["triage"].update(model="claude-haiku-4-5", min_confidence=0.7, escalate_types=ESCALATE_TYPES)
+    log = analyzer.LogStore(tmp_path / "log.db")
+
+    results, stats, metrics = analyze(config, files, log)
+    triage = metrics.summary()["triage"]
+    assert len(results) == len(files)
+    assert triage["documents"] == len(files)
+    assert 0 < triage["escalated"] < len(files)
+    assert api.calls == len(files) + triage["escalated"]
+    assert stats["triage_input_tokens"] > 0
+    # Escalated documents are answered by the main model, without the
+    # triage tool's confidence field
+    assert not any("confidence" in r for r in results)
+    log.close()
+
+
+def test_pack_mode_sends_short_documents_together(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 12, words=20)
+    config = make_config(tmp_path / "korpus", pack_max_tokens=300, pack_budget=4000, pack_size=4)
+    log = analyzer.LogStore(tmp_path / "log.db")
+
+    results, _, metrics = analyze(config, files, log)
+    packing = metrics.summary()["packing"]
+    assert sorted(r["filepath"] for r in results) == files
+    assert packing["documents"] == len(files)
+    assert packing["requests"] < len(files)
+    assert api.calls == packing["requests"]
+    log.close()
+
+
+def test_batch_mode_resumes_pending_batches(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 6)
+    config = make_config(tmp_path / "korpus")
+    paths = analyzer.output_paths(config)
+
+    def run():
+        return cmd_analyze(config, batch=True).counters["analysis"]
+
+    # First run submits everything; the batch is still processing
+    run()
+    assert api.batched_requests == len(files)
+    assert len(analyzer.load_batches(paths["batches"])) == 1
+
+    # A restart before the batch ends resubmits nothing
+    run()
+    assert api.batched_requests == len(files)
+
+    time.sleep(api.batch_delay)
+    stats = run()
+    assert api.batched_requests == len(files)
+    assert stats["calls"] == len(files)
+    assert analyzer.load_batches(paths["batches"]) == {}
+    log = analyzer.LogStore(paths["log"])
+    assert all(path in log for path in files)
+    log.close()
+
+
+def test_batch_errors_are_counted_and_recorded_as_failures(api, tmp_path, monkeypatch):
+    files = write_corpus(tmp_path / "korpus", 6)
+    config = make_config(tmp_path / "korpus")
+    paths = analyzer.output_paths(config)
+    monkeypatch.setattr(api, "error_rate", 1.0)
+    cmd_analyze(config, batch=True)
+    monkeypatch.setattr(api, "error_rate", 0.0)
+    time.sleep(api.batch_delay)
+
+    stats = cmd_analyze(config, batch=True).counters["analysis"]
+    assert stats["failed"] == len(files)
+    log = analyzer.LogStore(paths["log"])
+    assert all(log.failure(analyzer.hash_file(path)) == "batch_errored" for path in files)
+    log.close()
+
+    # Skipped on the next run, sent again with --retry-failed
+    stats = cmd_analyze(config, batch=True).counters["analysis"]
+    assert stats["failed_skipped"] == len(files)
+    assert api.batched_requests == len(files)
+
+
+def test_docx_breaks_with_attributes_separate_words(tmp_path):
+    from docx import Document
+    from docx.enum.text import WD_BREAK
+    from docx.shared import Cm
+
+    document = Document()
+    paragraph = document.add_paragraph()
+    paragraph.paragraph_format.tab_stops.add_tab_stop(Cm(2))
+    run = paragraph.add_run("före")
+    run.add_break(WD_BREAK.PAGE)
+    run.add_text("efter")
+    run.add_break(WD_BREAK.COLUMN)
+    run.add_text("spalt")
+    path = tmp_path / "brytningar.docx"
+    document.save(path)
+
+    assert analyzer.read_file(str(path)).split() == ["före", "efter", "spalt"]
+
+
+def test_work_queue_lease_is_taken_over_after_expiry(tmp_path):
+    db_path = tmp_path / "work_queue.db"
+    first = analyzer.WorkQueue(db_path, lease=0.4)
+    second = analyzer.WorkQueue(db_path, lease=0.4)
+    second.worker = "other:1"
+
+    assert first.claim("abc", "a.txt") == ("claimed", None)
+    assert second.claim("abc", "a.txt") == ("leased", None)
+
+    # The heartbeat keeps a live worker's lease from expiring
+    time.sleep(0.6)
+    assert second.claim("abc", "a.txt") == ("leased", None)
+
+    # A worker that stops renewing (killed) loses the lease
+    first.stopped.set()
+    first.heartbeat.join()
+    time.sleep(0.6)
+    assert second.claim("abc", "a.txt") == ("claimed", None)
+    assert second.stats["taken_over"] == 1
+
+    second.complete("abc", "a.txt", {"title": "A"})
+    assert first.claim("abc", "a.txt") == ("done", {"title": "A"})
+    first.conn.close()
+    second.close()
+
+
+def test_extraction_pool_fails_queued_files_when_a_worker_cannot_start(tmp_path, monkeypatch):
+    def broken_start(self, context):
+        raise RuntimeError("kan inte starta")
+
+    monkeypatch.setattr(analyzer.ExtractionPool, "_start", broken_start)
+    files = write_corpus(tmp_path / "korpus", 4)
+    with analyzer.ExtractionPool(make_config(tmp_path / "korpus")) as pool:
+        futures = [pool.submit(path) for path in files]
+        done, pending = wait(futures, timeout=10)
+        assert not pending
+        assert all(isinstance(future.exception(), RuntimeError) for future in futures)
+        assert isinstance(pool.submit(files[0]).exception(timeout=1), RuntimeError)
+
+
+def edit(path, old, new):
+    text = Path(path).read_text(encoding="utf-8")
+    Path(path).write_text(text.replace(old, new, 1), encoding="utf-8")
+
+
+def test_edited_file_is_analyzed_again_not_matched_to_its_old_content(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 2)
+    config = make_config(tmp_path / "korpus", near_duplicate_threshold=0.85)
+    cmd_analyze(config)
+    assert api.calls == 2
+
+    # One word changed: the new content is almost identical to the old
+    edit(files[0], "ord0_5 ", "ändrat ")
+    api.calls = 0
+    stats = cmd_analyze(config).counters["analysis"]
+    assert api.calls == 1
+    assert stats["near_duplicates"] == 0
+    log = analyzer.LogStore(analyzer.output_paths(config)["log"])
+    assert "near_duplicate_of" not in log.results()[-1]
+    assert len(list(log.signatures())) == 2
+    log.close()
+
+
+def test_near_duplicate_is_linked_and_detached_when_its_source_is_deleted(api, tmp_path):
+    files = write_corpus(tmp_path / "korpus", 1)
+    copy = tmp_path / "korpus" / "kopia.txt"
+    copy.write_text(Path(files[0]).read_text(encoding="utf-8").replace("ord0_5 ", "ändrat "), encoding="utf-8")
+    config = make_config(tmp_path / "korpus", near_duplicate_threshold=0.85)
+    paths = analyzer.output_paths(config)
+    cmd_analyze(config)
+    assert api.calls == 1
+
+    log = analyzer.LogStore(paths["log"])
+    linked = {item["filepath"]: item for item in log.results()}[str(copy)]
+    assert linked["near_duplicate_of"] == files[0]
+    analyzer.generate_zotero_export(log, paths["zotero"], paths["zotero_delta"])
+    records = Path(paths["zotero"]).read_text(encoding="utf-8").count("ER  -")
+    assert records == 1
+    log.close()
+
+    Path(files[0]).unlink()
+    cmd_analyze(config)
+    log = analyzer.LogStore(paths["log"])
+    [item] = log.results()
+    assert item["filepath"] == str(copy)
+    assert "near_duplicate_of" not in item and "similarity" not in item
+    # The copy is now a document of its own and replaces its source in the RIS file
+    analyzer.generate_zotero_export(log, paths["zotero"], paths["zotero_delta"])
+    assert Path(paths["zotero"]).read_text(encoding="utf-8").count("ER  -") == records
+    log.close()
+
+
+def test_each_host_keeps_its_own_log_and_adopts_the_shared_one(tmp_path):
+    folder = tmp_path / "korpus"
+    paths = analyzer.output_paths(make_config(folder))
+    assert paths["data"].parent == folder / "analyzer"
+    assert Path(paths["log"]).parent == paths["data"]
+    assert Path(paths["report"]).parent == folder / "analyzer"
+
+    # data_dir moves the log out of the analysed (synced) folder
+    elsewhere = analyzer.output_paths(make_config(folder, data_dir=str(tmp_path / "lokal")))
+    assert elsewhere["data"].parent == tmp_path / "lokal"
+    assert Path(elsewhere["report"]).parent == folder / "analyzer"
+
+    # A log from before the data directories is copied, not moved
+    legacy = analyzer.LogStore(folder / "analyzer" / "processed_files.db")
+    legacy.record(str(folder / "a.txt"), "abc", {"title": "A"})
+    legacy.close()
+    analyzer.adopt_shared_log(elsewhere)
+    log = analyzer.LogStore(elsewhere["log"])
+    assert str(folder / "a.txt") in log
+    log.close()
+    assert (folder / "analyzer" / "processed_files.db").exists()
+
+
+def test_importing_analyzer_loads_no_api_or_config_libraries():
+    # Offline stages must start without anthropic, dotenv or yaml; the
+    # check runs in a fresh interpreter, since this one has loaded them
+    probe = "import sys, analyzer; print(*sorted({name.split('.')[0] for name in sys.modules}))"
+    loaded = set(subprocess.run([sys.executable, "-c", probe], cwd=Path(__file__).parent,
+                                capture_output=True, text=True, check=True).stdout.split())
+    assert not loaded & {"anthropic", "yaml", "dotenv", *HEAVY_MODULES}
+
+
+def test_scan_finds_new_changed_and_deleted_files(tmp_path):
+    folder = tmp_path / "korpus"
+    files = write_corpus(folder, 3)
+    log = analyzer.LogStore(tmp_path / "log.db")
+    new, changed, unchanged, deleted = analyzer.scan_folders([folder], [".txt"], log)
+    assert sorted(new) == files and not changed and not unchanged and not deleted
+    for i, path in enumerate(files):
+        log.record(path, f"hash{i}", {"title": f"Dokument {i}"})
+
+    # Nothing changed: the files come from the index, and none are pending
+    new, changed, unchanged, deleted = analyzer.scan_folders([folder], [".txt"], log)
+    assert sorted(unchanged) == files and not new and not changed and not deleted
+    assert analyzer.find_files([folder], [".txt"], log) == []
+
+    edit(files[0], "Dokument", "Ändrat dokument")
+    Path(files[1]).unlink()
+    added = write_corpus(tmp_path / "extra", 4)[3]
+    Path(added).rename(folder / "nytt.txt")
+    pending = analyzer.find_files([folder], [".txt"], log)
+    assert sorted(pending) == sorted([files[0], str(folder / "nytt.txt")])
+    # The edited and the deleted file are forgotten; the untouched one is kept
+    assert files[0] not in log and files[1] not in log and files[2] in log
+    assert files[1] not in log.scan_index()
+    log.close()
+
+
+def citable(i):
+    return {"title": f"Titel {i}", "author": f"Författare, F{i}", "year": "2001", "type": "artikel",
+            "is_citable": True}
+
+
+def test_ris_export_appends_new_records_and_rewrites_when_stale(tmp_path):
+    log = analyzer.LogStore(tmp_path / "log.db")
+    out, delta = tmp_path / "zotero.ris", tmp_path / "zotero-nya.ris"
+    for i in range(2):
+        log.record(str(tmp_path / f"d{i}.txt"), f"hash{i}", citable(i))
+    analyzer.generate_zotero_export(log, out, delta)
+    assert out.read_text(encoding="utf-8").count("ER  -") == 2
+    assert delta.read_text(encoding="utf-8").count("ER  -") == 2
+
+    # Only the new record is appended and written to the delta file
+    log.record(str(tmp_path / "d2.txt"), "hash2", citable(2))
+    analyzer.generate_zotero_export(log, out, delta)
+    text = out.read_text(encoding="utf-8")
+    assert text.count("ER  -") == 3 and text.index("Titel 0") < text.index("Titel 2")
+    assert delta.read_text(encoding="utf-8").count("ER  -") == 1
+    assert "TI  - Titel 2" in delta.read_text(encoding="utf-8")
+
+    # An exported file that left the log makes the RIS file stale: it is
+    # rewritten without it, and the delta file is left as it was
+    log.forget([str(tmp_path / "d0.txt")])
+    assert not log.export_current(out)
+    analyzer.generate_zotero_export(log, out, delta)
+    text = out.read_text(encoding="utf-8")
+    assert text.count("ER  -") == 2 and "Titel 0" not in text
+    assert "TI  - Titel 2" in delta.read_text(encoding="utf-8")
+    assert log.export_current(out)
+    log.close()
+
+
+def ris(*records):
+    return "\n".join(f"TY  - JOUR\nAU  - {author}\nPY  - {year}\nTI  - {title}\nER  - \n"
+                     for author, year, title in records)
+
+
+def test_ris_sort_merges_in_swedish_order_and_drops_duplicates(tmp_path):
+    (tmp_path / "a.ris").write_text(ris(("Öberg, Anna", "1990", "Om öar"), ("Zetterberg, Bo", "2001", "Zoologi"),
+                                        ("Åberg, Carl", "1985", "Åren")), encoding="utf-8")
+    (tmp_path / "b.ris").write_text(ris(("Ärlig, Eva", "1970", "Ärlighet"), ("Ahlin, Dan", "2010", "Alfa"),
+                                        ("zetterberg, bo", "2001-05-01", "Zoologi.")), encoding="utf-8")
+    result = subprocess.run([sys.executable, str(RIS_SORT), "a.ris", "b.ris", "-o", "alla.ris", "--dedupe"],
+                            cwd=tmp_path, capture_output=True, text=True, check=True)
+    assert "(1 duplicates removed)" in result.stdout
+    authors = [line[6:] for line in (tmp_path / "alla.ris").read_text(encoding="utf-8").splitlines()
+               if line.startswith("AU")]
+    assert authors == ["Ahlin, Dan", "Zetterberg, Bo", "Åberg, Carl", "Ärlig, Eva", "Öberg, Anna"]
+
+
+def test_ris_sort_external_merge_matches_in_memory_sort(tmp_path):
+    ris_sort = runpy.run_path(str(RIS_SORT))
+    path = tmp_path / "stor.ris"
+    names = ["Öberg", "Zetterberg", "Åberg", "Ahlin", "Ärlig"]
+    path.write_text(ris(*((names[i % 5], str(1900 + i % 9), f"Titel {i}") for i in range(40))), encoding="utf-8")
+    in_memory = list(ris_sort["sorted_runs"](ris_sort["iter_records"](path), 10**9, tmp_path))
+    # Runs of one record each are written to disk and merged
+    merged = list(ris_sort["sorted_runs"](ris_sort["iter_records"](path), 1, tmp_path))
+    assert len(list(tmp_path.glob("*.run"))) == 40
+    assert [record for _, record in merged] == [record for _, record in in_memory]
+    assert [key for key, _ in merged] == sorted(key for key, _ in in_memory)